@@ -0,0 +1,267 @@
+import socket
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util import connection, parse_url
+
+from proxyfinder.metrics import record_phase
+from proxyfinder.protocols import (
+    PROTOCOL_SOCKS4,
+    resolve_ipv4,
+    run_handshake,
+    socks_handshake,
+)
+
+# Connections to proxies opened by this process, so the checks in flight can
+# be interrupted from another thread (see `abort_connections`).
+_open_connections: "weakref.WeakSet" = weakref.WeakSet()
+_open_connections_lock = threading.Lock()
+
+
+def abort_connections() -> int:
+    """
+    Shuts down the sockets of the connections to proxies that are still open,
+    which wakes up the threads blocked on them with an error. Returns how many
+    were shut down.
+    """
+    with _open_connections_lock:
+        connections = list(_open_connections)
+    aborted = 0
+    for connection in connections:
+        sock = getattr(connection, "sock", None)
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+            aborted += 1
+        except OSError:
+            pass
+    return aborted
+
+
+def _register(conn):
+    with _open_connections_lock:
+        _open_connections.add(conn)
+
+
+class PhaseTimingMixin:
+    """
+    Records the phases of a connection through a proxy with `record_phase`:
+    the TCP connect, the CONNECT tunnel and the time to the head of the
+    response. `TimedHTTPSConnection` adds the TLS handshake. Connections are
+    also registered for `abort_connections`.
+    """
+
+    _connect_time = 0.0
+    _tunnel_time = 0.0
+    _request_sent_at = 0.0
+
+    def _new_conn(self):
+        _register(self)
+        start_time = time.perf_counter()
+        sock = super()._new_conn()  # type: ignore
+        self._connect_time = time.perf_counter() - start_time
+        record_phase("connect", self._connect_time)
+        return sock
+
+    def _tunnel(self):
+        start_time = time.perf_counter()
+        super()._tunnel()  # type: ignore
+        self._tunnel_time = time.perf_counter() - start_time
+        record_phase("tunnel", self._tunnel_time)
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)  # type: ignore
+        self._request_sent_at = time.perf_counter()
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)  # type: ignore
+        record_phase("ttfb", time.perf_counter() - self._request_sent_at)
+        return response
+
+
+class TimedHTTPConnection(PhaseTimingMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(PhaseTimingMixin, HTTPSConnection):
+    def connect(self):
+        # The handshake is what `connect` does after the TCP connect and the tunnel.
+        self._connect_time = self._tunnel_time = 0.0
+        start_time = time.perf_counter()
+        super().connect()
+        elapsed = time.perf_counter() - start_time
+        record_phase("tls", elapsed - self._connect_time - self._tunnel_time)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class SocksConnectionMixin:
+    """
+    Connects through the SOCKS4 or SOCKS5 proxy of the `_socks_options` of the
+    pool: `_new_conn` opens the TCP connection to the proxy and runs the
+    handshake that tunnels it to the host of the connection. Like the CONNECT
+    tunnel of an HTTP proxy, the handshake is bounded by the connect timeout.
+    Goes before `PhaseTimingMixin`, whose phases it records itself.
+    """
+
+    def __init__(self, *args, _socks_options: dict, **kwargs):
+        self._socks_options = _socks_options
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        _register(self)
+        protocol = self._socks_options["protocol"]
+        proxy_host = self._socks_options["host"]
+        start_time = time.perf_counter()
+        try:
+            sock = connection.create_connection(
+                (proxy_host, self._socks_options["port"]),
+                self.timeout,  # type: ignore
+                source_address=self.source_address,  # type: ignore
+                socket_options=self.socket_options,  # type: ignore
+            )
+        except socket.timeout as e:
+            raise ConnectTimeoutError(
+                self,
+                f"Connection to {proxy_host} timed out. "
+                f"(connect timeout={self.timeout})",  # type: ignore
+            ) from e
+        except OSError as e:
+            raise NewConnectionError(
+                self, f"Failed to establish a new connection: {e}"  # type: ignore
+            ) from e
+        self._connect_time = time.perf_counter() - start_time
+        record_phase("connect", self._connect_time)
+
+        start_time = time.perf_counter()
+        host, port = self.host, self.port  # type: ignore
+        try:
+            ip = resolve_ipv4(host) if protocol == PROTOCOL_SOCKS4 else None
+            run_handshake(sock, socks_handshake(protocol, host, port, ip))
+        except socket.timeout as e:
+            sock.close()
+            raise ConnectTimeoutError(
+                self,
+                f"{protocol.upper()} handshake with {proxy_host} timed out. "
+                f"(connect timeout={self.timeout})",  # type: ignore
+            ) from e
+        except OSError as e:
+            sock.close()
+            raise NewConnectionError(self, str(e)) from e  # type: ignore
+        self._tunnel_time = time.perf_counter() - start_time
+        record_phase("tunnel", self._tunnel_time)
+        return sock
+
+
+class TimedSocksHTTPConnection(SocksConnectionMixin, TimedHTTPConnection):
+    pass
+
+
+class TimedSocksHTTPSConnection(SocksConnectionMixin, TimedHTTPSConnection):
+    pass
+
+
+class TimedSocksHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedSocksHTTPConnection
+
+
+class TimedSocksHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedSocksHTTPSConnection
+
+
+class SocksProxyManager(PoolManager):
+    """
+    `PoolManager` whose connections go through the SOCKS proxy at `proxy_url`
+    ("socks4://ip:port" or "socks5://ip:port"). Does the same as urllib3's
+    `SOCKSProxyManager` without depending on PySocks.
+    """
+
+    def __init__(self, proxy_url: str, **kwargs):
+        proxy = parse_url(proxy_url)
+        kwargs["_socks_options"] = {
+            "protocol": proxy.scheme,
+            "host": proxy.host,
+            "port": proxy.port,
+        }
+        super().__init__(**kwargs)
+        self.proxy_url = proxy_url
+        self.pool_classes_by_scheme = {
+            "http": TimedSocksHTTPConnectionPool,
+            "https": TimedSocksHTTPSConnectionPool,
+        }
+
+
+class ProxyPoolAdapter(HTTPAdapter):
+    """
+    `HTTPAdapter` that keeps at most `max_proxies` upstream proxy managers.
+
+    `requests` creates a urllib3 `ProxyManager`, with its own connection
+    pools, for every distinct proxy URL and keeps it for the lifetime of the
+    adapter. A check goes through each proxy once, so here the managers are
+    kept in LRU order and the least recently used one is closed when there are
+    too many. `release` closes the manager of a proxy as soon as its check is
+    done, so its sockets are not left idle until the end of the run.
+
+    The connections through the proxies record their phases (see
+    `PhaseTimingMixin`), and "socks4://" and "socks5://" proxies are served by
+    a `SocksProxyManager`.
+    """
+
+    def __init__(self, max_proxies: int = 100, **kwargs):
+        self.max_proxies = max_proxies
+        self.evictions = 0
+        self._lock = threading.Lock()
+        super().__init__(**kwargs)
+        self.proxy_manager = OrderedDict()
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        with self._lock:
+            if proxy in self.proxy_manager:
+                self.proxy_manager.move_to_end(proxy)
+                return self.proxy_manager[proxy]
+            if proxy.lower().startswith("socks"):
+                manager = SocksProxyManager(
+                    proxy,
+                    num_pools=self._pool_connections,
+                    maxsize=self._pool_maxsize,
+                    block=self._pool_block,
+                    **proxy_kwargs,
+                )
+                self.proxy_manager[proxy] = manager
+            else:
+                manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+                manager.pool_classes_by_scheme = {
+                    "http": TimedHTTPConnectionPool,
+                    "https": TimedHTTPSConnectionPool,
+                }
+            while len(self.proxy_manager) > self.max_proxies:
+                _, evicted = self.proxy_manager.popitem(last=False)
+                evicted.clear()
+                self.evictions += 1
+            return manager
+
+    def release(self, proxy: str):
+        """Closes the connections to `proxy` and forgets its manager."""
+        with self._lock:
+            manager = self.proxy_manager.pop(proxy, None)
+        if manager is not None:
+            manager.clear()
+
+    def close(self):
+        with self._lock:
+            super().close()
+            self.proxy_manager.clear()
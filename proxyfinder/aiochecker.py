@@ -0,0 +1,442 @@
+import asyncio
+import logging
+import random
+import ssl
+import time
+from collections import deque
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import requests.certs
+
+from proxyfinder.concurrency import OUTCOME_OK, ConcurrencyController, classify_error
+from proxyfinder.database import Proxy
+from proxyfinder.geo import INVALID_EGRESS_IP_ERROR, parse_egress_ip
+from proxyfinder.metrics import METRICS
+from proxyfinder.prefilter import TcpPrefilter
+from proxyfinder.protocols import (
+    PROTOCOL_HTTP,
+    PROTOCOL_SOCKS4,
+    SocksError,
+    is_mismatch,
+    probe_order,
+    record_detection,
+    resolve_ipv4,
+    socks_handshake,
+)
+from proxyfinder.utils import DEADLINE_FLAG, STOP_FLAG
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEAD_SIZE = 64 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class ProbeError(Exception):
+    """
+    Error raised while probing a proxy. The message follows the format that
+    `REGEX_GET_HTTP_ERROR` extracts from `requests` exceptions, so both engines
+    store comparable values in `Proxy.error`.
+    """
+
+
+class ResponseReader:
+    """
+    Reads an HTTP response from a `StreamReader` with `timeout` on every read
+    of the socket, like `requests`, instead of on the whole response: a proxy
+    that keeps sending bytes is not cut off, one that stops sending is.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, timeout: float):
+        self.reader = reader
+        self.timeout = timeout
+        self.buffer = bytearray()
+
+    async def _fill(self) -> bool:
+        """Reads what the socket has into the buffer. False at the end of it."""
+        try:
+            chunk = await asyncio.wait_for(
+                self.reader.read(READ_CHUNK_SIZE), self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise ProbeError(f"'Read timed out. (read timeout={self.timeout})'")
+        self.buffer += chunk
+        return bool(chunk)
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def readuntil(self, separator: bytes, limit: int = MAX_HEAD_SIZE) -> bytes:
+        start = 0
+        while True:
+            end = self.buffer.find(separator, start)
+            if end >= 0:
+                return self._take(end + len(separator))
+            if len(self.buffer) > limit:
+                raise ProbeError("'Invalid HTTP response'")
+            start = max(0, len(self.buffer) - len(separator) + 1)
+            if not await self._fill():
+                raise ProbeError("'Remote end closed connection without response'")
+
+    async def readexactly(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            if not await self._fill():
+                raise ProbeError("'Remote end closed connection without response'")
+        return self._take(size)
+
+    async def read(self, limit: int) -> bytes:
+        """Reads up to `limit` bytes or until the end of the response."""
+        while len(self.buffer) < limit and await self._fill():
+            pass
+        return self._take(limit)
+
+
+class AsyncChecker:
+    """
+    Proxy checker built on asyncio and non-blocking sockets.
+
+    It performs the same verification as `ProxyFinderUtils._check_proxy`
+    (an HTTP proxy, with a CONNECT tunnel for https test URLs, or a SOCKS4/5
+    proxy, whose answer holds the egress IP) but keeps thousands of probes in
+    flight from a single thread. The number of probes in flight follows
+    `controller.limit`.
+
+    Like `requests`, `connect_timeout` bounds the connection to the proxy,
+    the CONNECT tunnel or SOCKS handshake and the TLS handshake, and
+    `read_timeout` every read of the response (see `ResponseReader`).
+    """
+
+    DEADLINE_POLL_INTERVAL = 0.5
+
+    def __init__(
+        self,
+        test_urls: List[dict],
+        user_agents: List[str],
+        connect_timeout: float = 5,
+        read_timeout: float = 10,
+        controller: Optional[ConcurrencyController] = None,
+    ):
+        self.test_urls = test_urls
+        self.user_agents = user_agents
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.controller = controller or ConcurrencyController(limit=500)
+        self.ssl_context = ssl.create_default_context(cafile=requests.certs.where())
+
+    async def _start_tls(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        hostname: str,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if hasattr(writer, "start_tls"):  # Python 3.11+
+            await writer.start_tls(self.ssl_context, server_hostname=hostname)
+            return reader, writer
+
+        loop = asyncio.get_running_loop()
+        new_reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(new_reader)
+        transport = await loop.start_tls(
+            writer.transport, protocol, self.ssl_context, server_hostname=hostname
+        )
+        new_writer = asyncio.StreamWriter(transport, protocol, new_reader, loop)
+        return new_reader, new_writer
+
+    async def _read_head(self, reader: ResponseReader) -> Tuple[int, dict]:
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("iso-8859-1").split("\r\n")
+        parts = lines[0].split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ProbeError("'Invalid HTTP response'")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return int(parts[1]), headers
+
+    async def _read_body(self, reader: ResponseReader, headers: dict) -> bytes:
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            body = b""
+            while True:
+                size_line = await reader.readuntil(b"\r\n")
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    break
+                body += await reader.readexactly(size + 2)
+                body = body[:-2]
+                if len(body) > MAX_BODY_SIZE:
+                    raise ProbeError("'Response body too large'")
+            return body
+        if "content-length" in headers:
+            length = int(headers["content-length"])
+            if length > MAX_BODY_SIZE:
+                raise ProbeError("'Response body too large'")
+            return await reader.readexactly(length)
+        return await reader.read(MAX_BODY_SIZE)
+
+    async def _socks_handshake(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        protocol: str,
+        host: str,
+        port: int,
+    ):
+        """Runs a `socks_handshake` to `host:port` on the connection to the proxy."""
+        ip = None
+        if protocol == PROTOCOL_SOCKS4:
+            loop = asyncio.get_running_loop()
+            ip = await loop.run_in_executor(None, resolve_ipv4, host)
+        handshake = socks_handshake(protocol, host, port, ip)
+        try:
+            data, size = next(handshake)
+            while True:
+                if data:
+                    writer.write(data)
+                try:
+                    reply = await reader.readexactly(size)
+                except asyncio.IncompleteReadError as e:
+                    reply = e.partial
+                data, size = handshake.send(reply)
+        except StopIteration:
+            pass
+
+    async def _request(
+        self,
+        address: str,
+        config: dict,
+        phases: Optional[dict] = None,
+        protocol: str = PROTOCOL_HTTP,
+    ) -> Tuple[int, bytes]:
+        """
+        Sends a GET request for `config` through the proxy at `address`, which
+        speaks `protocol` (see PROTOCOLS). The duration of each phase (see
+        PROBE_PHASES) is stored in `phases`.
+        """
+        phases = {} if phases is None else phases
+        url = urlsplit(config["url"])
+        is_https = url.scheme == "https"
+        host = url.hostname or ""
+        port = url.port or (443 if is_https else 80)
+        query = url.query
+        if config.get("params"):
+            query = "&".join(filter(None, [query, urlencode(config["params"])]))
+        path = (url.path or "/") + (f"?{query}" if query else "")
+
+        ip, proxy_port = address.rsplit(":", 1)
+        phase_start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, int(proxy_port)), self.connect_timeout
+            )
+        except asyncio.TimeoutError:
+            raise ProbeError(
+                f"'Connection to {ip} timed out. "
+                f"(connect timeout={self.connect_timeout})'"
+            )
+        except OSError as e:
+            raise ProbeError(f"'Failed to establish a new connection: {e}'")
+        phases["connect"] = time.perf_counter() - phase_start
+
+        try:
+            tunnel = is_https or protocol != PROTOCOL_HTTP
+            phase_start = time.perf_counter()
+            if protocol != PROTOCOL_HTTP:
+                try:
+                    await asyncio.wait_for(
+                        self._socks_handshake(reader, writer, protocol, host, port),
+                        self.connect_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    raise ProbeError(
+                        f"'{protocol.upper()} handshake with {ip} timed out. "
+                        f"(connect timeout={self.connect_timeout})'"
+                    )
+                phases["tunnel"] = time.perf_counter() - phase_start
+            elif is_https:
+                writer.write(
+                    f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode()
+                )
+                status, _ = await self._read_head(
+                    ResponseReader(reader, self.connect_timeout)
+                )
+                if status != 200:
+                    raise ProbeError(f"'Tunnel connection failed: {status}'")
+                phases["tunnel"] = time.perf_counter() - phase_start
+            if is_https:
+                phase_start = time.perf_counter()
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        self._start_tls(reader, writer, host), self.connect_timeout
+                    )
+                except asyncio.TimeoutError:
+                    raise ProbeError(f"'_ssl.c: The handshake operation timed out'")
+                phases["tls"] = time.perf_counter() - phase_start
+            target = path if tunnel else f"http://{host}:{port}{path}"
+
+            headers = {
+                "Host": host,
+                "User-Agent": random.choice(self.user_agents),
+                "Accept": "*/*",
+                "Connection": "close",
+            }
+            headers.update(config.get("headers") or {})
+            request = f"GET {target} HTTP/1.1\r\n"
+            request += "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+            writer.write((request + "\r\n").encode())
+            await writer.drain()
+
+            phase_start = time.perf_counter()
+            response = ResponseReader(reader, self.read_timeout)
+            status, response_headers = await self._read_head(response)
+            phases["ttfb"] = time.perf_counter() - phase_start
+            body = await self._read_body(response, response_headers)
+            return status, body
+        except (ssl.SSLError, ConnectionError, SocksError) as e:
+            raise ProbeError(f"'{e}'")
+        finally:
+            writer.close()
+
+    async def check_proxy(self, proxy: Proxy) -> Optional[Proxy]:
+        """
+        Verifies if a proxy is functional and detects the protocol it speaks.
+        Mirrors `ProxyFinderUtils._check_proxy`.
+        """
+        if STOP_FLAG.is_set():
+            return None
+
+        logger.debug(f"Checking proxy: {proxy.proxy}")
+        config = random.choice(self.test_urls)
+        proxy.is_checked = True  # type: ignore
+        proxy.updated_at = datetime.now()
+        METRICS.probe_started()
+        phases = {}
+        check_start = time.perf_counter()
+        protocols = probe_order(proxy.protocol)  # type: ignore
+        for attempt, protocol in enumerate(protocols):
+            tunnel = protocol != PROTOCOL_HTTP or config["url"].startswith("https")
+            if attempt:
+                METRICS.inc("proxyfinder_protocol_fallbacks_total")
+                phases.clear()  # only the phases of the last attempt count
+            start_time = time.perf_counter()
+            try:
+                status, body = await self._request(
+                    proxy.proxy, config, phases, protocol  # type: ignore
+                )
+                if status >= 400:
+                    raise ProbeError(f"'{status} Error for url: {config['url']}'")
+                egress_ip = parse_egress_ip(body)
+                if egress_ip is None:
+                    raise ProbeError(f"'{INVALID_EGRESS_IP_ERROR}'")
+            except asyncio.CancelledError:
+                METRICS.probe_cancelled()
+                raise
+            except ProbeError as e:
+                error = str(e)
+            except Exception as e:
+                error = f"'{type(e).__name__}: {e}'"
+            else:
+                elapsed = time.perf_counter() - start_time
+                proxy.latency = round(elapsed * 1000, 2)  # type: ignore
+                proxy.is_working = True  # type: ignore
+                proxy.egress_ip = egress_ip  # type: ignore
+                proxy.error = None  # type: ignore
+                record_detection(proxy, protocol, None, tunnel)
+                self.controller.record(OUTCOME_OK)
+                METRICS.probe_finished(None, phases, time.perf_counter() - check_start)
+                logger.info(
+                    f"Proxy {proxy.proxy} is working ({proxy.latency} ms, {protocol}) status: {status}"
+                )
+                return proxy
+
+            if (
+                is_mismatch(error)
+                and attempt + 1 < len(protocols)
+                and not STOP_FLAG.is_set()
+            ):
+                continue
+            record_detection(proxy, protocol, error, tunnel)
+            proxy.is_working = False  # type: ignore
+            proxy.error = error  # type: ignore
+            self.controller.record(classify_error(error))
+            METRICS.probe_finished(error, phases, time.perf_counter() - check_start)
+            logger.debug(f"Proxy {proxy.proxy} connection failed.")
+            return proxy
+
+    async def check_proxies(
+        self, proxies: Iterable[Proxy], prefilter: Optional[TcpPrefilter] = None
+    ):
+        """
+        Checks the proxies keeping up to `controller.limit` probes in flight.
+        Yields the checked proxies in completion order.
+
+        With a `prefilter`, up to `prefilter.concurrency` TCP connects run ahead
+        of the HTTP checks; rejected proxies are yielded without an HTTP check.
+        When DEADLINE_FLAG is set, the probes in flight are cancelled.
+        """
+        iterator = iter(proxies)
+        connecting = set()
+        checking = set()
+        accepted = deque()
+        exhausted = False
+        try:
+            while True:
+                while (
+                    prefilter
+                    and not exhausted
+                    and len(connecting) < prefilter.concurrency
+                    and len(accepted) < self.controller.limit
+                    and not STOP_FLAG.is_set()
+                ):
+                    proxy = next(iterator, None)
+                    if proxy is None:
+                        exhausted = True
+                        break
+                    connecting.add(asyncio.ensure_future(prefilter.probe_item(proxy)))
+
+                while len(checking) < self.controller.limit and not STOP_FLAG.is_set():
+                    if accepted:
+                        proxy = accepted.popleft()
+                    elif not prefilter and not exhausted:
+                        proxy = next(iterator, None)
+                        if proxy is None:
+                            exhausted = True
+                            break
+                    else:
+                        break
+                    checking.add(asyncio.ensure_future(self.check_proxy(proxy)))
+
+                if not connecting and not checking:
+                    break
+                done, _ = await asyncio.wait(
+                    connecting | checking,
+                    timeout=self.DEADLINE_POLL_INTERVAL,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task in connecting:
+                        connecting.remove(task)
+                        proxy, passed = task.result()
+                        if passed:
+                            accepted.append(proxy)
+                        else:
+                            yield proxy
+                    else:
+                        checking.remove(task)
+                        yield task.result()
+                if DEADLINE_FLAG.is_set() and (connecting or checking):
+                    logger.info(
+                        f"Deadline reached: cancelling "
+                        f"{len(connecting) + len(checking)} checks in flight."
+                    )
+                    break
+        finally:
+            for task in connecting | checking:
+                task.cancel()
+            # Lets them handle the cancellation before the loop is closed.
+            await asyncio.gather(*connecting, *checking, return_exceptions=True)
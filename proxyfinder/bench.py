@@ -0,0 +1,850 @@
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from proxyfinder.database import Proxy, ResultWriter, db, percentile
+from proxyfinder.export import open_output
+from proxyfinder.parsers import new_parser
+from proxyfinder.utils import (
+    ProxyStatus,
+    count_open_fds,
+    dedupe_proxy_keys,
+    new_proxy_keys,
+    pack_proxy,
+    peak_rss_mb,
+)
+
+logger = logging.getLogger(__name__)
+
+# "all" runs the benchmarks of the hot paths: the ones that do not need more
+# than this process (startup) or a proxy farm (check).
+SUITE_TARGETS = ["parse", "dedupe", "ingest", "write", "query", "export", "geo"]
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+QUERY_PAGE_SIZE = 100
+QUERY_RUNS = 5
+# Runs of every other measurement. The best one is reported: the noise of a
+# busy machine only ever adds time.
+BENCH_RUNS = 5
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_SECONDS = 0.005
+PARSE_SIZES = [1_000, 10_000, 100_000]
+PARSE_CHUNK_SIZE = 64 * 1024
+CHECK_SIZES = [1_000, 5_000]
+CHECK_ENGINES = ["thread", "async"]
+CHECK_CONCURRENCY = 200
+CHECK_TIMEOUT = 3
+GEO_LOOKUPS = 100_000
+GEO_COUNTRIES = ["US", "DE", "BR", "IN", "CN", "RU", "FR", "ID", "VN", "CO"]
+
+# Modules that `import proxyfinder.cli` must not load: the commands that need
+# them import them when they run.
+STARTUP_HEAVY_MODULES = [
+    "asyncio",
+    "bs4",
+    "curses",
+    "requests",
+    "proxyfinder.bench",
+    "proxyfinder.proxyfinder",
+]
+STARTUP_BUDGET_MS = 100
+STARTUP_RUNS = 10
+STARTUP_IMPORT_SCRIPT = (
+    "import sys, time\n"
+    "start = time.perf_counter()\n"
+    "import proxyfinder.cli\n"
+    "print(time.perf_counter() - start)\n"
+    "print(','.join(name for name in sys.argv[1:] if name in sys.modules))\n"
+)
+
+
+@contextmanager
+def temporary_database():
+    """
+    Points `db`, and so every model and the `ResultWriter`, to an empty
+    database in a temporary directory.
+    """
+    directory = tempfile.mkdtemp(prefix="proxyfinder-bench-")
+    original = db.database
+    db.close()
+    db.init(str(Path(directory) / "bench.db"))
+    try:
+        db.connect()
+        yield db
+    finally:
+        db.close()
+        db.init(original)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextmanager
+def quiet_loggers(*names: str, level: int = logging.WARNING):
+    """Raises the level of the per-proxy loggers while a benchmark runs."""
+    loggers = [logging.getLogger(name) for name in names]
+    levels = [item.level for item in loggers]
+    for item in loggers:
+        item.setLevel(level)
+    try:
+        yield
+    finally:
+        for item, previous in zip(loggers, levels):
+            item.setLevel(previous)
+
+
+def synthetic_proxies(count: int, seed: int = 0) -> List[str]:
+    """Returns `count` distinct, reproducible `ip:port` strings."""
+    rng = random.Random(seed)
+    proxies = []
+    for key in rng.sample(range(1 << 40), count):
+        ip = ".".join(str(key >> shift & 255) for shift in (32, 24, 16, 8))
+        proxies.append(f"{ip}:{1024 + (key & 255) * 200}")
+    return proxies
+
+
+def _timed(func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def _best_timed(func, *args, runs: int = BENCH_RUNS, **kwargs):
+    """Like `_timed`, with the best time of `runs` calls."""
+    times = []
+    for _ in range(runs):
+        result, elapsed = _timed(func, *args, **kwargs)
+        times.append(elapsed)
+    return result, min(times)
+
+
+def bench_ingest(sizes: List[int]) -> List[dict]:
+    """
+    Times `Proxy.save_proxies` for each size: first into an empty table, then
+    again with the same candidates plus as many new ones (half duplicates).
+    Each run starts from a new database.
+    """
+    results = []
+    for size in sizes:
+        candidates = synthetic_proxies(size * 2, seed=size)
+        first = candidates[:size]
+        second = candidates[: size // 2] + candidates[size : size + size // 2]
+        times = {"ingest.empty": [], "ingest.half_duplicates": []}
+        new_rows = {}
+        for _ in range(BENCH_RUNS):
+            with temporary_database():
+                for name, proxies in [
+                    ("ingest.empty", first),
+                    ("ingest.half_duplicates", second),
+                ]:
+                    new_rows[name], elapsed = _timed(Proxy.save_proxies, proxies)
+                    times[name].append(elapsed)
+        for name, proxies in [
+            ("ingest.empty", first),
+            ("ingest.half_duplicates", second),
+        ]:
+            elapsed = min(times[name])
+            results.append(
+                {
+                    "name": name,
+                    "size": len(proxies),
+                    "seconds": round(elapsed, 4),
+                    "rows_per_second": round(len(proxies) / elapsed),
+                    "new_rows": new_rows[name],
+                }
+            )
+    return results
+
+
+def _peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_dedupe(sizes: List[int], sources: int = 20) -> List[dict]:
+    """
+    Compares merging `sources` overlapping source lists (a third of each list
+    is repeated in the next one) as "ip:port" strings and as packed keys.
+    """
+
+    def dedupe_strings(groups):
+        all_proxies = []
+        for proxies in groups:
+            all_proxies.extend(proxies)
+        return list(set(all_proxies))
+
+    results = []
+    for size in sizes:
+        proxies = synthetic_proxies(size, seed=size)
+        step = max(1, size // sources)
+        string_groups = [
+            proxies[i : i + step + step // 3] for i in range(0, size, step)
+        ]
+        key_groups = [
+            new_proxy_keys(pack_proxy(proxy) for proxy in group)  # type: ignore
+            for group in string_groups
+        ]
+        for name, func, groups in [
+            ("dedupe.strings", dedupe_strings, string_groups),
+            ("dedupe.packed", dedupe_proxy_keys, key_groups),
+        ]:
+            unique, elapsed = _best_timed(func, groups)
+            results.append(
+                {
+                    "name": name,
+                    "size": size,
+                    "seconds": round(elapsed, 4),
+                    "rows_per_second": round(size / elapsed),
+                    "unique": len(unique),
+                    "input_bytes": sum(
+                        sys.getsizeof(group) + sum(map(sys.getsizeof, group))
+                        if name == "dedupe.strings"
+                        else sys.getsizeof(group)
+                        for group in groups
+                    ),
+                    "peak_bytes": _peak_memory(func, groups),
+                }
+            )
+    return results
+
+
+def synthetic_page(parser_type: str, count: int, seed: int = 0) -> bytes:
+    """
+    Returns a page with `count` proxies laid out like the sources in
+    `sources.json`: a free-proxy-list.net style table, or a plain list.
+    """
+    proxies = synthetic_proxies(count, seed)
+    if parser_type == "plain":
+        return "".join(f"{proxy}\r\n" for proxy in proxies).encode()
+
+    head = (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Free Proxy List</title>"
+        "<style>.hm{display:none} td,th{padding:2px 4px}</style>"
+        "<script>window.dataLayer = window.dataLayer || []; "
+        "function gtag(){dataLayer.push(arguments);} if (1 < 2 && 3 > 2) {}</script>"
+        "</head><body><nav><ul>"
+        + "".join(f"<li><a href='/p{i}'>Page &amp; {i}</a></li>" for i in range(30))
+        + "</ul></nav><div class='table-responsive fpl-list'>"
+        "<table class='table table-striped table-bordered'><thead><tr>"
+        + "".join(
+            f"<th>{name}</th>"
+            for name in [
+                "IP Address",
+                "Port",
+                "Code",
+                "Country",
+                "Anonymity",
+                "Google",
+                "Https",
+                "Last Checked",
+            ]
+        )
+        + "</tr></thead><tbody>"
+    )
+    rows = [
+        f"<tr><td>{ip}</td><td>{port}</td><td>US</td>"
+        f"<td class='hm'>United States</td><td>elite proxy</td>"
+        f"<td class='hm'>no</td><td class='hx'>yes</td>"
+        f"<td class='hm'>{index % 60} mins ago</td></tr>\n"
+        for index, (ip, port) in enumerate(proxy.split(":") for proxy in proxies)
+    ]
+    tail = (
+        "</tbody></table></div><textarea class='form-control' readonly>"
+        + "\n".join(proxies)
+        + "</textarea><footer><p>&copy; Free Proxy List</p></footer></body></html>"
+    )
+    return (head + "".join(rows) + tail).encode()
+
+
+def reference_parse(content: bytes, parser_type: str) -> "array[int]":
+    """The BeautifulSoup + regex parsing that `TableProxyParser` replaces."""
+    from bs4 import BeautifulSoup, Tag
+
+    text = content.decode("utf-8", errors="replace")
+    proxies = []
+    if parser_type == "table":
+        soup = BeautifulSoup(text, "html.parser")
+        table = soup.find("table")
+        if isinstance(table, Tag):
+            for row in table.find_all("tr")[1:]:
+                if (
+                    isinstance(row, Tag)
+                    and (cols := row.find_all("td"))
+                    and len(cols) >= 2
+                ):
+                    proxies.append(f"{cols[0].text.strip()}:{cols[1].text.strip()}")
+    elif parser_type == "plain":
+        proxies = [
+            line.strip()
+            for line in text.split("\n")
+            if ":" in line and "." in line.split(":")[0]
+        ]
+    return new_proxy_keys(
+        key for proxy in proxies if (key := pack_proxy(proxy)) is not None
+    )
+
+
+def stream_parse(content: bytes, parser_type: str) -> "array[int]":
+    """Feeds `content` to the incremental parser as `requests` would stream it."""
+    parser = new_parser(parser_type)
+    for start in range(0, len(content), PARSE_CHUNK_SIZE):
+        parser.feed(content[start : start + PARSE_CHUNK_SIZE])
+    return parser.close()
+
+
+def bench_parse(sizes: List[int], pages: Optional[List[str]] = None) -> List[dict]:
+    """
+    Compares `reference_parse` and `stream_parse` over synthetic pages of
+    `sizes` proxies of each source type, or over saved `pages` (files ending in
+    ".html" or ".htm" are table sources, the rest plain lists).
+    """
+    if pages:
+        fixtures = [
+            (
+                Path(page).name,
+                "table" if Path(page).suffix.lower() in (".html", ".htm") else "plain",
+                Path(page).read_bytes(),
+            )
+            for page in pages
+        ]
+    else:
+        fixtures = [
+            (
+                f"synthetic-{parser_type}-{size}",
+                parser_type,
+                synthetic_page(parser_type, size, seed=size),
+            )
+            for parser_type in ["table", "plain"]
+            for size in sizes
+        ]
+
+    results = []
+    for page, parser_type, content in fixtures:
+        expected, reference_elapsed = _best_timed(
+            reference_parse, content, parser_type
+        )
+        keys, elapsed = _best_timed(stream_parse, content, parser_type)
+        for name, seconds in [
+            (f"parse.{parser_type}.bs4", reference_elapsed),
+            (f"parse.{parser_type}.stream", elapsed),
+        ]:
+            results.append(
+                {
+                    "name": name,
+                    "page": page,
+                    "bytes": len(content),
+                    "proxies": len(expected),
+                    "seconds": round(seconds, 4),
+                    "mb_per_second": round(len(content) / seconds / 1e6, 2),
+                }
+            )
+        # The BeautifulSoup timings are a reference, not code of this package.
+        results[-2]["reference"] = True
+        results[-1]["speedup"] = round(reference_elapsed / elapsed, 1)
+        results[-1]["same"] = keys == expected
+    return results
+
+
+def _run_python(args: List[str], env: dict) -> float:
+    start_time = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *args],
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start_time
+
+
+def bench_startup(runs: int = STARTUP_RUNS) -> List[dict]:
+    """
+    Measures, in fresh interpreters, `import proxyfinder.cli` and a whole
+    `proxyfinder show --count` on an empty database in a temporary directory.
+    Warns if the import loads any of STARTUP_HEAVY_MODULES or takes more than
+    STARTUP_BUDGET_MS.
+    """
+    directory = tempfile.mkdtemp(prefix="proxyfinder-bench-")
+    env = dict(os.environ, APPDATA=directory)
+    try:
+        import_times = []
+        heavy_modules = ""
+        script = [sys.executable, "-c", STARTUP_IMPORT_SCRIPT]
+        for _ in range(runs):
+            output = subprocess.run(
+                script + STARTUP_HEAVY_MODULES,
+                env=env,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.split("\n")
+            import_times.append(float(output[0]))
+            heavy_modules = output[1]
+
+        interpreter_times = [_run_python(["-c", "pass"], env) for _ in range(runs)]
+        command = ["-m", "proxyfinder.cli", "show", "--count"]
+        _run_python(command, env)  # creates the database
+        command_times = [_run_python(command, env) for _ in range(runs)]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    import_ms = statistics.median(import_times) * 1000
+    results = [
+        {
+            "name": "startup.import",
+            "median_ms": round(import_ms, 1),
+            "min_ms": round(min(import_times) * 1000, 1),
+            "heavy_modules": heavy_modules or "none",
+        },
+        {
+            "name": "startup.show_count",
+            "median_ms": round(statistics.median(command_times) * 1000, 1),
+            "min_ms": round(min(command_times) * 1000, 1),
+            "interpreter_ms": round(statistics.median(interpreter_times) * 1000, 1),
+        },
+    ]
+    if heavy_modules:
+        logger.warning(f"Importing the CLI loads: {heavy_modules}")
+    if import_ms > STARTUP_BUDGET_MS:
+        logger.warning(
+            f"Importing the CLI takes {import_ms:.0f} ms "
+            f"(budget: {STARTUP_BUDGET_MS} ms)"
+        )
+    return results
+
+
+def fill_database(size: int):
+    """
+    Saves `size` synthetic proxies and gives them reproducible check results
+    and statistics, derived from their id: 90% checked, a third of those
+    working, updated over the last 30 days.
+    """
+    Proxy.save_proxies(synthetic_proxies(size, seed=size))
+    with db.atomic():
+        db.execute_sql(
+            "UPDATE proxy SET"
+            " is_checked = id % 10 != 0,"
+            " is_working = id % 10 != 0 AND id * 2654435761 % 3 = 0,"
+            " latency = CASE WHEN id % 10 != 0 THEN id * 7919 % 5000 ELSE latency END,"
+            " success_ratio = CASE WHEN id % 10 != 0 THEN id * 104729 % 21 / 20.0 END,"
+            " ewma_latency = CASE WHEN id % 10 != 0 THEN id * 7919 % 4000 + 50.5 END,"
+            " p95_latency = CASE WHEN id % 10 != 0 THEN id * 7919 % 5000 + 500 END,"
+            " consecutive_failures = id * 31 % 5,"
+            " updated_at = datetime('now', '-' || (id % 30) || ' days')"
+        )
+
+
+def bench_write(sizes: List[int]) -> List[dict]:
+    """
+    Times the result-write path of `check_proxies`: `ResultWriter` upserting
+    `size` checked proxies, appending their history and updating their rolling
+    statistics. Each run starts from a new database.
+    """
+    results = []
+    for size in sizes:
+        times = []
+        for _ in range(BENCH_RUNS):
+            written, elapsed = _write_results(size)
+            times.append(elapsed)
+        elapsed = min(times)
+        results.append(
+            {
+                "name": "write.results",
+                "size": size,
+                "seconds": round(elapsed, 4),
+                "rows_per_second": round(size / elapsed),
+                "written": written,
+            }
+        )
+    return results
+
+
+def _write_results(size: int) -> Tuple[int, float]:
+    """One run of `bench_write`: the rows written and the time it took."""
+    with temporary_database():
+        Proxy.save_proxies(synthetic_proxies(size, seed=size))
+        now = datetime.now()
+        rows = [
+            (
+                proxy_id,
+                (
+                    proxy,
+                    True,
+                    proxy_id % 3 == 0,
+                    proxy_id * 7919 % 5000,
+                    now,
+                    proxy.split(":")[0] if proxy_id % 3 == 0 else None,
+                    None if proxy_id % 3 == 0 else "'Connection refused'",
+                    "http" if proxy_id % 3 == 0 else None,
+                    True if proxy_id % 3 == 0 else None,
+                ),
+                0,
+                None,
+            )
+            for proxy_id, proxy in Proxy.select(Proxy.id, Proxy.proxy).tuples()
+        ]
+        start_time = time.perf_counter()
+        with ResultWriter() as writer:
+            for row in rows:
+                writer.put_row(row)
+        elapsed = time.perf_counter() - start_time
+        return writer.written, elapsed
+
+
+def bench_query(sizes: List[int]) -> List[dict]:
+    """
+    Times the queries of `show` and `export` (see `select_proxies`): the count
+    of working proxies and the first page of every sort order, in both
+    directions.
+    """
+    from proxyfinder.cli import SORT_FIELDS, select_proxies
+
+    results = []
+    for size in sizes:
+        with temporary_database():
+            fill_database(size)
+            queries = [
+                (
+                    "query.count",
+                    lambda: select_proxies(ProxyStatus.WORKING).count(),
+                )
+            ]
+            for sort_by in SORT_FIELDS:
+                for reverse in (False, True):
+                    queries.append(
+                        (
+                            f"query.top{QUERY_PAGE_SIZE}.{sort_by}"
+                            f"{'.desc' if reverse else ''}",
+                            partial(
+                                lambda sort_by, reverse: list(
+                                    select_proxies(
+                                        ProxyStatus.WORKING,
+                                        limit=QUERY_PAGE_SIZE,
+                                        sort_by=sort_by,
+                                        reverse=reverse,
+                                    )
+                                ),
+                                sort_by,
+                                reverse,
+                            ),
+                        )
+                    )
+            for name, query in queries:
+                query()  # warms the page cache
+                times = [_timed(query)[1] for _ in range(QUERY_RUNS)]
+                results.append(
+                    {
+                        "name": name,
+                        "size": size,
+                        "seconds": round(statistics.median(times), 6),
+                    }
+                )
+    return results
+
+
+def bench_export(sizes: List[int]) -> List[dict]:
+    """Times `export_query` of all the proxies to a file in every format."""
+    from proxyfinder.export import EXPORT_FORMATS, export_query
+
+    results = []
+    for size in sizes:
+        with temporary_database():
+            fill_database(size)
+            directory = Path(db.database).parent
+            for export_format in EXPORT_FORMATS:
+                output = directory / f"export.{export_format}"
+                query = Proxy.select().order_by(Proxy.id)
+                with quiet_loggers("proxyfinder.export"):
+                    rows, elapsed = _best_timed(
+                        export_query, query, str(output), export_format
+                    )
+                results.append(
+                    {
+                        "name": f"export.{export_format}",
+                        "size": size,
+                        "seconds": round(elapsed, 4),
+                        "rows_per_second": round(rows / elapsed),
+                        "bytes": output.stat().st_size,
+                    }
+                )
+                output.unlink()
+    return results
+
+
+def synthetic_geo_dataset(path: Path, count: int):
+    """
+    Writes a gzipped dataset of `count` IP ranges in the format of
+    `GeoIndex`, spread over the IPv4 space with a gap after each one.
+    """
+    import gzip
+    import ipaddress
+
+    step = (1 << 32) // count
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for i in range(count):
+            start = i * step
+            f.write(
+                f"{ipaddress.IPv4Address(start)}\t"
+                f"{ipaddress.IPv4Address(start + step // 2)}\t"
+                f"{i % 60000 + 1}\t{GEO_COUNTRIES[i % len(GEO_COUNTRIES)]}\t"
+                f"AS-{i}\n"
+            )
+
+
+def bench_geo(sizes: List[int]) -> List[dict]:
+    """
+    Times the local geolocation (see `proxyfinder.geo`) for each size: building
+    the index of a dataset of `size` ranges, GEO_LOOKUPS lookups of random
+    addresses, and `enrich_proxies` of a database of `size` proxies.
+    """
+    from proxyfinder.geo import GeoIndex, enrich_proxies
+
+    rng = random.Random(0)
+    addresses = [
+        ".".join(str(rng.randrange(256)) for _ in range(4)) for _ in range(GEO_LOOKUPS)
+    ]
+    results = []
+    for size in sizes:
+        with temporary_database():
+            dataset = Path(db.database).parent / "ranges.tsv.gz"
+            synthetic_geo_dataset(dataset, size)
+            index, elapsed = _best_timed(GeoIndex.from_file, dataset)
+            results.append(
+                {
+                    "name": "geo.load",
+                    "size": size,
+                    "seconds": round(elapsed, 4),
+                    "ranges_per_second": round(size / elapsed),
+                }
+            )
+            _, elapsed = _best_timed(
+                lambda: [index.lookup(ip) for ip in addresses]
+            )
+            results.append(
+                {
+                    "name": "geo.lookup",
+                    "size": size,
+                    "seconds": round(elapsed, 4),
+                    "lookups_per_second": round(GEO_LOOKUPS / elapsed),
+                }
+            )
+            fill_database(size)
+            times = []
+            for _ in range(BENCH_RUNS):
+                Proxy.update(country=None, asn=None).execute()
+                with quiet_loggers("proxyfinder.geo"):
+                    changed, elapsed = _timed(enrich_proxies, index=index)
+                times.append(elapsed)
+            elapsed = min(times)
+            results.append(
+                {
+                    "name": "geo.enrich",
+                    "size": size,
+                    "seconds": round(elapsed, 4),
+                    "rows_per_second": round(size / elapsed),
+                    "changed": changed,
+                }
+            )
+    return results
+
+
+def bench_check(
+    sizes: List[int],
+    engines: Iterable[str] = CHECK_ENGINES,
+    concurrency: int = CHECK_CONCURRENCY,
+    timeout: float = CHECK_TIMEOUT,
+) -> List[dict]:
+    """
+    Runs `check_proxies` with each engine against a `ProxyFarm` of each size,
+    with its judge as the only test URL. Reports the throughput, the latency
+    percentiles measured by the checker, the CPU time of this process, the
+    peak RSS and the file descriptors left open.
+    """
+    from proxyfinder.proxyfinder import ProxyFinder
+    from proxyfinder.simulator import ProxyFarm
+
+    results = []
+    for size in sizes:
+        with ProxyFarm(size, seed=size) as farm:
+            finder_class = type(
+                "BenchProxyFinder",
+                (ProxyFinder,),
+                {"TEST_URLS": [{"url": farm.judge_url}]},
+            )
+            for engine in engines:
+                with temporary_database(), quiet_loggers(
+                    "proxyfinder.proxyfinder", "proxyfinder.aiochecker"
+                ):
+                    Proxy.save_proxies(farm.proxies)
+                    with finder_class(
+                        concurrency=concurrency,
+                        connect_timeout=timeout,
+                        read_timeout=timeout,
+                    ) as pf:
+                        cpu_start = time.process_time()
+                        _, elapsed = _timed(
+                            pf.check_proxies,
+                            Proxy.select().where(Proxy.is_checked == False),
+                            engine=engine,
+                        )
+                        cpu = time.process_time() - cpu_start
+                    latencies = sorted(
+                        latency
+                        for (latency,) in Proxy.select(Proxy.latency)
+                        .where(Proxy.is_working == True)
+                        .tuples()
+                    )
+                    rss = peak_rss_mb()
+                    results.append(
+                        {
+                            "name": f"check.{engine}",
+                            "size": size,
+                            "concurrency": concurrency,
+                            "seconds": round(elapsed, 2),
+                            "checks_per_second": round(size / elapsed, 1),
+                            "working": len(latencies),
+                            "expected_working": farm.expected_working(timeout),
+                            "p50_ms": percentile(latencies, 0.5),
+                            "p95_ms": percentile(latencies, 0.95),
+                            "p99_ms": percentile(latencies, 0.99),
+                            "cpu_seconds": round(cpu, 2),
+                            "peak_rss_mb": round(rss) if rss is not None else None,
+                            "open_files": count_open_fds(),
+                        }
+                    )
+    return results
+
+
+def _run_target(
+    target: str, sizes: Optional[List[int]], pages: Optional[List[str]]
+) -> List[dict]:
+    if target == "ingest":
+        return bench_ingest(sizes or DEFAULT_SIZES)
+    elif target == "dedupe":
+        return bench_dedupe(sizes or DEFAULT_SIZES)
+    elif target == "parse":
+        return bench_parse(sizes or PARSE_SIZES, pages)
+    elif target == "write":
+        return bench_write(sizes or DEFAULT_SIZES)
+    elif target == "query":
+        return bench_query(sizes or DEFAULT_SIZES)
+    elif target == "export":
+        return bench_export(sizes or DEFAULT_SIZES)
+    elif target == "geo":
+        return bench_geo(sizes or DEFAULT_SIZES)
+    elif target == "startup":
+        return bench_startup()
+    elif target == "check":
+        return bench_check(sizes or CHECK_SIZES)
+    raise ValueError(f"Invalid benchmark: {target}")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result: dict) -> str:
+    """Identifies the same measurement in two reports."""
+    return " ".join(
+        str(result[field]) for field in ("name", "page", "size") if field in result
+    )
+
+
+def compare_reports(baseline: dict, report: dict) -> List[str]:
+    """
+    Returns the measurements of `report` that are more than
+    REGRESSION_THRESHOLD slower than in `baseline` (and at least
+    REGRESSION_MIN_SECONDS, to ignore the noise of very fast ones). The
+    "reference" measurements, of code outside this package, are left out.
+    """
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(result_key(result))
+        if old is None or result.get("reference"):
+            continue
+        if "seconds" in result:
+            new_time, old_time = result["seconds"], old.get("seconds")
+        else:
+            new_time = result.get("median_ms", 0) / 1000
+            old_time = old.get("median_ms", 0) / 1000
+        if (
+            old_time
+            and new_time > old_time * (1 + REGRESSION_THRESHOLD)
+            and new_time - old_time >= REGRESSION_MIN_SECONDS
+        ):
+            regressions.append(
+                f"{result_key(result)}: {old_time:.4f} s -> {new_time:.4f} s "
+                f"(+{(new_time / old_time - 1):.0%})"
+            )
+    return regressions
+
+
+def run_bench(
+    target: str,
+    sizes: Optional[List[int]] = None,
+    pages: Optional[List[str]] = None,
+    output: Optional[str] = None,
+    baseline: Optional[str] = None,
+) -> dict:
+    """
+    Runs the benchmarks of `target` ("all" runs SUITE_TARGETS) and returns a
+    report with the results and where they were measured. The report is
+    written as JSON to `output` ("-" for stdout) and compared with the report
+    in `baseline`, if given; regressions are logged as warnings and listed in
+    the report.
+    """
+    results = []
+    for name in SUITE_TARGETS if target == "all" else [target]:
+        for result in _run_target(name, sizes, pages):
+            logger.info(" ".join(f"{key}={value}" for key, value in result.items()))
+            results.append(result)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "target": target,
+        "results": results,
+    }
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            regressions = compare_reports(json.load(f), report)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if not regressions:
+            logger.info(f"No regressions against {baseline}.")
+        report["regressions"] = regressions
+    if output:
+        with open_output(output) as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    return report
@@ -1,26 +1,71 @@
 import argparse
-import csv
-import json
 import logging
-import os
 import signal
 import sys
-from curses import wrapper
 from datetime import datetime, timedelta
-from pathlib import Path
 
-from peewee import fn
+from proxyfinder.database import STATS_FIELDS, Proxy
+from proxyfinder.export import EXPORT_FORMATS
+from proxyfinder.protocols import PROTOCOLS
+from proxyfinder.utils import (
+    ProxyStatus,
+    setup_logging,
+    signal_handler,
+    start_deadline,
+    unpack_proxy,
+)
 
-from proxyfinder.database import Proxy
-from proxyfinder.proxyfinder import ProxyFinder
-from proxyfinder.utils import ProxyDisplay, ProxyStatus, signal_handler
+# The modules of the commands (curses, requests, asyncio...) are imported by
+# the functions that run them, so that light commands like `show --count`
+# start fast. Check it with `proxyfinder bench startup`.
 
 logger = logging.getLogger(__name__)
 
+SORT_FIELDS = ["latency", "created_at", "updated_at"] + STATS_FIELDS
+# "all" runs the targets of `proxyfinder.bench.SUITE_TARGETS`.
+BENCH_TARGETS = [
+    "parse",
+    "dedupe",
+    "ingest",
+    "write",
+    "query",
+    "export",
+    "geo",
+    "startup",
+    "check",
+    "all",
+]
+
+
+def concurrency_type(value: str):
+    """Parses `--concurrency`: a positive number or "auto"."""
+    if value == "auto":
+        return value
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid concurrency: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError("concurrency must be at least 1")
+    return number
+
+
+def duration_type(value: str) -> float:
+    """Parses `--deadline`: seconds, or a number with an s, m or h suffix."""
+    units = {"s": 1, "m": 60, "h": 3600}
+    unit = units.get(value[-1:].lower())
+    try:
+        seconds = float(value[:-1] if unit else value) * (unit or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration: {value!r}")
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError("duration must be positive")
+    return seconds
+
 
 def config_args():
     parser = argparse.ArgumentParser(
-        description="CLI to find, check, and manage HTTP proxies."
+        description="CLI to find, check, and manage HTTP and SOCKS proxies."
     )
     subparsers = parser.add_subparsers(dest="action", required=True)
 
@@ -29,6 +74,44 @@ def config_args():
     find_parser.add_argument(
         "--concurrency", type=int, default=10, help="Number of threads for searching."
     )
+    find_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Download and parse every source even if it did not change.",
+    )
+    find_parser.add_argument(
+        "--fetch-connect-timeout",
+        type=float,
+        default=None,
+        help="Seconds to connect to a source (default: 10).",
+    )
+    find_parser.add_argument(
+        "--fetch-read-timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for each read of a source page (default: 30).",
+    )
+    find_parser.add_argument(
+        "--deadline",
+        type=duration_type,
+        default=None,
+        help=(
+            "Time budget of the run, e.g. 900, 15m or 1h. When it runs out no new "
+            "work is started, the checks in flight are cancelled and the results "
+            "so far are saved."
+        ),
+    )
+    find_parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write the metrics of the run in the Prometheus text format to this file.",
+    )
+    find_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics of the run at http://127.0.0.1:PORT/metrics.",
+    )
 
     # 'check' command
     check_parser = subparsers.add_parser("check", help="Check the status of proxies.")
@@ -44,7 +127,16 @@ def config_args():
         help="Filter proxies by status.",
     )
     check_parser.add_argument(
-        "--concurrency", type=int, default=10, help="Number of threads for checking."
+        "--concurrency",
+        type=concurrency_type,
+        default=10,
+        help='Number of checks in flight, or "auto" to adapt it to the network.',
+    )
+    check_parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="Hard ceiling for --concurrency (defaults to 500 with auto).",
     )
     check_parser.add_argument(
         "--older-than",
@@ -52,6 +144,92 @@ def config_args():
         default=0,
         help="Only check proxies older than N days.",
     )
+    check_parser.add_argument(
+        "--budget",
+        type=int,
+        default=None,
+        help=(
+            "Check the N proxies most worth checking now, by their recheck "
+            "schedule, instead of selecting them by --status."
+        ),
+    )
+    check_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes that check proxies, each with --concurrency "
+            "checks in flight. Results are saved by a single writer."
+        ),
+    )
+    check_parser.add_argument(
+        "--shard-id",
+        type=int,
+        default=0,
+        help="Only check the proxies of this shard, from 0 to --shard-count - 1.",
+    )
+    check_parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=1,
+        help="Number of shards the proxies are split into, e.g. one per host.",
+    )
+    check_parser.add_argument(
+        "--engine",
+        choices=["thread", "async"],
+        default="thread",
+        help="Checking engine: a thread pool or an asyncio event loop.",
+    )
+    check_parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Try a plain TCP connect first and only HTTP-check proxies that accept it.",
+    )
+    check_parser.add_argument(
+        "--prefilter-timeout",
+        type=float,
+        default=3,
+        help="Timeout in seconds of the TCP connect prefilter.",
+    )
+    check_parser.add_argument(
+        "--prefilter-concurrency",
+        type=int,
+        default=1000,
+        help="Number of TCP connects in flight in the prefilter.",
+    )
+    check_parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=None,
+        help="Seconds to connect to a proxy, tunnel and TLS included (default: 5).",
+    )
+    check_parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for each read of the answer of a proxy (default: 10).",
+    )
+    check_parser.add_argument(
+        "--deadline",
+        type=duration_type,
+        default=None,
+        help=(
+            "Time budget of the run, e.g. 900, 15m or 1h. When it runs out no new "
+            "work is started, the checks in flight are cancelled and the results "
+            "so far are saved."
+        ),
+    )
+    check_parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write the metrics of the run in the Prometheus text format to this file.",
+    )
+    check_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics of the run at http://127.0.0.1:PORT/metrics.",
+    )
 
     # 'show' command
     show_parser = subparsers.add_parser("show", help="Display stored proxies.")
@@ -74,9 +252,15 @@ def config_args():
         action="store_true",
         help="Show the number of proxies in the database.",
     )
+    show_parser.add_argument(
+        "--refresh",
+        type=float,
+        metavar="SECONDS",
+        help="Read the proxies on screen again every N seconds, e.g. while a check runs.",
+    )
     show_parser.add_argument(
         "--sort-by",
-        choices=["latency", "created_at", "updated_at"],
+        choices=SORT_FIELDS,
         default="latency",
         help="Sort proxies by a specific field.",
     )
@@ -86,12 +270,49 @@ def config_args():
     show_parser.add_argument(
         "--older-than", type=int, default=0, help="Filter proxies older than N days."
     )
+    show_parser.add_argument(
+        "--protocol",
+        nargs="+",
+        choices=PROTOCOLS,
+        default=None,
+        help="Only proxies that speak one of these protocols, as detected by check.",
+    )
+    show_parser.add_argument(
+        "--supports-connect",
+        action="store_true",
+        help="Only proxies that opened a tunnel to the test URL (CONNECT or SOCKS).",
+    )
+    show_parser.add_argument(
+        "--country",
+        nargs="+",
+        type=str.upper,
+        metavar="CODE",
+        help="Only proxies in one of these countries (ISO codes, e.g. US DE).",
+    )
+    show_parser.add_argument(
+        "--asn",
+        nargs="+",
+        type=int,
+        metavar="N",
+        help="Only proxies in one of these autonomous systems (AS numbers).",
+    )
 
     # 'export' command
     export_parser = subparsers.add_parser(
-        "export", help="Export proxies to a CSV file."
+        "export", help="Export proxies to a file or to stdout."
+    )
+    export_parser.add_argument(
+        "output",
+        type=str,
+        help='Output file (.csv, .json, .jsonl, .txt, optionally .gz) or "-" for stdout.',
+    )
+    export_parser.add_argument(
+        "--format",
+        dest="export_format",
+        choices=EXPORT_FORMATS,
+        default=None,
+        help="Output format. Detected from the file name by default, txt for stdout.",
     )
-    export_parser.add_argument("output", type=str, help="Output file.")
     export_parser.add_argument(
         "--status",
         choices=[
@@ -108,7 +329,7 @@ def config_args():
     )
     export_parser.add_argument(
         "--sort-by",
-        choices=["latency", "created_at", "updated_at"],
+        choices=SORT_FIELDS,
         default="latency",
         help="Sort proxies by a specific field.",
     )
@@ -118,33 +339,329 @@ def config_args():
     export_parser.add_argument(
         "--older-than", type=int, default=0, help="Filter proxies older than N days."
     )
+    export_parser.add_argument(
+        "--protocol",
+        nargs="+",
+        choices=PROTOCOLS,
+        default=None,
+        help="Only proxies that speak one of these protocols, as detected by check.",
+    )
+    export_parser.add_argument(
+        "--supports-connect",
+        action="store_true",
+        help="Only proxies that opened a tunnel to the test URL (CONNECT or SOCKS).",
+    )
+    export_parser.add_argument(
+        "--country",
+        nargs="+",
+        type=str.upper,
+        metavar="CODE",
+        help="Only proxies in one of these countries (ISO codes, e.g. US DE).",
+    )
+    export_parser.add_argument(
+        "--asn",
+        nargs="+",
+        type=int,
+        metavar="N",
+        help="Only proxies in one of these autonomous systems (AS numbers).",
+    )
 
     # 'update' command
     update_parser = subparsers.add_parser("update", help="Find and check new proxies.")
     update_parser.add_argument(
-        "--concurrency", type=int, default=10, help="Number of threads for updating."
+        "--concurrency",
+        type=concurrency_type,
+        default=10,
+        help='Number of checks in flight, or "auto" to adapt it to the network.',
+    )
+    update_parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="Hard ceiling for --concurrency (defaults to 500 with auto).",
+    )
+    update_parser.add_argument(
+        "--engine",
+        choices=["thread", "async"],
+        default="thread",
+        help="Checking engine: a thread pool or an asyncio event loop.",
+    )
+    update_parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Try a plain TCP connect first and only HTTP-check proxies that accept it.",
+    )
+    update_parser.add_argument(
+        "--prefilter-timeout",
+        type=float,
+        default=3,
+        help="Timeout in seconds of the TCP connect prefilter.",
+    )
+    update_parser.add_argument(
+        "--prefilter-concurrency",
+        type=int,
+        default=1000,
+        help="Number of TCP connects in flight in the prefilter.",
+    )
+    update_parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=None,
+        help="Seconds to connect to a proxy, tunnel and TLS included (default: 5).",
+    )
+    update_parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for each read of the answer of a proxy (default: 10).",
+    )
+    update_parser.add_argument(
+        "--fetch-connect-timeout",
+        type=float,
+        default=None,
+        help="Seconds to connect to a source (default: 10).",
+    )
+    update_parser.add_argument(
+        "--fetch-read-timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for each read of a source page (default: 30).",
+    )
+    update_parser.add_argument(
+        "--deadline",
+        type=duration_type,
+        default=None,
+        help=(
+            "Time budget of the run, e.g. 900, 15m or 1h. When it runs out no new "
+            "work is started, the checks in flight are cancelled and the results "
+            "so far are saved."
+        ),
+    )
+    update_parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write the metrics of the run in the Prometheus text format to this file.",
+    )
+    update_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics of the run at http://127.0.0.1:PORT/metrics.",
+    )
+
+    # 'serve' command
+    serve_parser = subparsers.add_parser(
+        "serve", help="Keep finding and checking proxies until stopped."
+    )
+    serve_parser.add_argument(
+        "--concurrency",
+        type=concurrency_type,
+        default=10,
+        help='Number of checks in flight, or "auto" to adapt it to the network.',
+    )
+    serve_parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="Hard ceiling for --concurrency (defaults to 500 with auto).",
+    )
+    serve_parser.add_argument(
+        "--engine",
+        choices=["thread", "async"],
+        default="thread",
+        help="Checking engine: a thread pool or an asyncio event loop.",
+    )
+    serve_parser.add_argument(
+        "--find-interval",
+        type=float,
+        default=60,
+        help="Minutes between two scrapes of the sources.",
+    )
+    serve_parser.add_argument(
+        "--batch",
+        type=int,
+        default=1000,
+        help="Maximum number of due proxies checked in each round.",
+    )
+    serve_parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Maximum average number of checks started per second (0: no limit).",
+    )
+    serve_parser.add_argument(
+        "--idle",
+        type=float,
+        default=30,
+        help="Maximum seconds to sleep when no proxy is due.",
+    )
+    serve_parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Try a plain TCP connect first and only HTTP-check proxies that accept it.",
+    )
+    serve_parser.add_argument(
+        "--prefilter-timeout",
+        type=float,
+        default=3,
+        help="Timeout in seconds of the TCP connect prefilter.",
+    )
+    serve_parser.add_argument(
+        "--prefilter-concurrency",
+        type=int,
+        default=1000,
+        help="Number of TCP connects in flight in the prefilter.",
+    )
+    serve_parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=None,
+        help="Seconds to connect to a proxy, tunnel and TLS included (default: 5).",
+    )
+    serve_parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for each read of the answer of a proxy (default: 10).",
+    )
+    serve_parser.add_argument(
+        "--fetch-connect-timeout",
+        type=float,
+        default=None,
+        help="Seconds to connect to a source (default: 10).",
+    )
+    serve_parser.add_argument(
+        "--fetch-read-timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for each read of a source page (default: 30).",
+    )
+    serve_parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write the metrics of the run in the Prometheus text format to this file.",
+    )
+    serve_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics of the run at http://127.0.0.1:PORT/metrics.",
     )
 
-    args = parser.parse_args(["check", "--status", "working"])
-    if hasattr(args, "concurrency"):
-        concurrency = os.cpu_count() or 2
-        concurrency += 2
-        max_concurrency = min(concurrency, args.concurrency)
-        setattr(args, "concurrency", max_concurrency)
+    # 'gateway' command
+    gateway_parser = subparsers.add_parser(
+        "gateway",
+        help="Serve the working proxies as a local rotating proxy and a JSON API.",
+    )
+    gateway_parser.add_argument(
+        "--host", default="127.0.0.1", help="Address to listen on."
+    )
+    gateway_parser.add_argument(
+        "--port", type=int, default=8899, help="Port to listen on."
+    )
+    gateway_parser.add_argument(
+        "--refresh",
+        type=float,
+        default=10,
+        help="Seconds between two reads of the proxies updated in the database.",
+    )
+    gateway_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10,
+        help="Timeout in seconds to connect to an upstream proxy and get its response.",
+    )
+    gateway_parser.add_argument(
+        "--spread",
+        type=int,
+        default=10,
+        help="Each request goes through one of the N fastest proxies, at random.",
+    )
+
+    # 'geo' command
+    geo_parser = subparsers.add_parser(
+        "geo",
+        help="Fill in the country and ASN of the stored proxies from an IP dataset.",
+    )
+    geo_parser.add_argument(
+        "--download",
+        action="store_true",
+        help="Download the latest IP dataset first (from iptoasn.com).",
+    )
+    geo_parser.add_argument(
+        "--dataset",
+        metavar="FILE",
+        help=(
+            "IP dataset to use, in the ip2asn TSV format, optionally gzipped "
+            "(default: the downloaded one)."
+        ),
+    )
+
+    # 'bench' command
+    bench_parser = subparsers.add_parser(
+        "bench", help="Run benchmarks on a temporary database."
+    )
+    bench_parser.add_argument("target", choices=BENCH_TARGETS, help="What to measure.")
+    bench_parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        help=(
+            "Comma-separated dataset sizes, up to millions of rows (default: "
+            "10000,100000,1000000, 1000,10000,100000 proxies per page for "
+            "parse and 1000,5000 fake proxies for check)."
+        ),
+    )
+    bench_parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="Write the results and the environment as JSON to FILE ('-' for stdout).",
+    )
+    bench_parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help=(
+            "Compare with the JSON results of a previous run and exit with "
+            "status 1 if a measurement got slower."
+        ),
+    )
+    bench_parser.add_argument(
+        "--pages",
+        nargs="+",
+        help=(
+            "Saved source pages to use for parse instead of synthetic ones. "
+            "Files ending in .html are table sources, the rest plain lists."
+        ),
+    )
+
+    args = parser.parse_args()
+
+    if args.action == "check":
+        if args.workers < 1:
+            parser.error("--workers must be at least 1")
+        if not 0 <= args.shard_id < args.shard_count:
+            parser.error("--shard-id must be between 0 and --shard-count - 1")
 
     if hasattr(args, "status"):
         setattr(args, "status", ProxyStatus(args.status))
     return args
 
 
-def show_proxies(
+def select_proxies(
     status: ProxyStatus,
     limit=None,
-    count=False,
     sort_by="latency",
     reverse=False,
     older_than=0,
+    protocols=None,
+    supports_connect=False,
+    countries=None,
+    asns=None,
 ):
+    """
+    Builds the query used by `show` and `export`. Filtering, sorting and
+    limiting are all done by SQLite, backed by the indexes created in
+    `database.py`.
+    """
     if status == ProxyStatus.WORKING:
         proxies = Proxy.select().where(
             Proxy.is_working == True, Proxy.is_checked == True
@@ -160,54 +677,135 @@ def show_proxies(
     else:
         raise ValueError(f"Invalid status: {status}")
 
+    if older_than > 0 and status != ProxyStatus.ALL:
+        cutoff = datetime.now() - timedelta(days=older_than)
+        proxies = proxies.where(Proxy.updated_at < cutoff)  # type: ignore
+
+    if protocols:
+        proxies = proxies.where(Proxy.protocol.in_(protocols))  # type: ignore
+    if supports_connect:
+        proxies = proxies.where(Proxy.supports_connect == True)
+    if countries:
+        proxies = proxies.where(Proxy.country.in_(countries))  # type: ignore
+    if asns:
+        proxies = proxies.where(Proxy.asn.in_(asns))  # type: ignore
+
+    field = getattr(Proxy, sort_by)
+    # Proxies without statistics yet go last in both directions.
+    nulls = "LAST" if sort_by in STATS_FIELDS else None
+    if reverse:
+        proxies = proxies.order_by(field.desc(nulls=nulls), Proxy.id.desc())
+    else:
+        proxies = proxies.order_by(field.asc(nulls=nulls), Proxy.id.asc())
+
     if limit:
         proxies = proxies.limit(limit)
+    return proxies
 
-    if older_than > 0 and status != ProxyStatus.ALL:
-        a_day_ago = datetime.now() - timedelta(days=older_than)
-        proxies = proxies.where(Proxy.updated_at > a_day_ago)  # type: ignore
+
+def show_proxies(
+    status: ProxyStatus,
+    limit=None,
+    count=False,
+    sort_by="latency",
+    reverse=False,
+    older_than=0,
+    protocols=None,
+    supports_connect=False,
+    countries=None,
+    asns=None,
+    refresh=None,
+):
+    proxies = select_proxies(
+        status,
+        limit=limit,
+        sort_by=sort_by,
+        reverse=reverse,
+        older_than=older_than,
+        protocols=protocols,
+        supports_connect=supports_connect,
+        countries=countries,
+        asns=asns,
+    )
 
     if count:
         print(
-            f"Total proxies: {len(proxies)}{f' {status}' if status != 'all' else ''} in the database"
+            f"Total proxies: {proxies.count()}{f' {status.value}' if status != ProxyStatus.ALL else ''} in the database"
         )
         return
 
-    proxies = sorted(proxies, key=lambda x: getattr(x, sort_by), reverse=reverse)
+    from curses import wrapper
+
+    from proxyfinder.viewer import ProxyDisplay, ProxyPager
+
+    pager = ProxyPager(proxies, sort_by=sort_by, reverse=reverse, limit=limit)
 
     def func(stdscr):
-        display = ProxyDisplay(stdscr, proxies)
+        display = ProxyDisplay(stdscr, pager, refresh=refresh)
         display.navigate()
 
     wrapper(func)
 
 
-def ckeck_proxies(concurrency, status=ProxyStatus.UNCHECKED, older_than=0):
-    with ProxyFinder(concurrency=concurrency) as pf:
+def ckeck_proxies(
+    concurrency,
+    status=ProxyStatus.UNCHECKED,
+    older_than=0,
+    engine="thread",
+    max_concurrency=None,
+    prefilter=False,
+    prefilter_timeout=3,
+    prefilter_concurrency=1000,
+    budget=None,
+    workers=1,
+    shard=(0, 1),
+    connect_timeout=None,
+    read_timeout=None,
+):
+    from proxyfinder.prefilter import TcpPrefilter
+    from proxyfinder.proxyfinder import ProxyFinder
+    from proxyfinder.workers import check_candidates, check_in_workers
+
+    if workers > 1:
+        prefilter_options = None
+        if prefilter:
+            prefilter_options = {
+                "timeout": prefilter_timeout,
+                "concurrency": prefilter_concurrency,
+            }
+        check_in_workers(
+            workers,
+            concurrency,
+            status=status,
+            older_than=older_than,
+            budget=budget,
+            engine=engine,
+            max_concurrency=max_concurrency,
+            prefilter_options=prefilter_options,
+            shard=shard,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
+        return
 
-        if status == ProxyStatus.WORKING:
-            proxies = Proxy.select().where(
-                Proxy.is_working == True,
-                Proxy.is_checked == True,
+    with ProxyFinder(
+        concurrency=concurrency,
+        max_concurrency=max_concurrency,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+    ) as pf:
+        tcp_prefilter = None
+        if prefilter:
+            tcp_prefilter = TcpPrefilter(
+                timeout=prefilter_timeout, concurrency=prefilter_concurrency
             )
-        elif status == ProxyStatus.BROKEN:
-            proxies = Proxy.select().where(
-                Proxy.is_working == False,
-                Proxy.is_checked == True,
-                Proxy.error.contains("connect timeout"),
-            )
-        elif status == ProxyStatus.UNCHECKED:
-            proxies = Proxy.select().where(Proxy.is_checked == False)
-        elif status == ProxyStatus.ALL:
-            proxies = Proxy.select()
-        else:
-            raise ValueError(f"Invalid status: {status}")
-
-        if older_than > 0:
-            a_day_ago = datetime.now() - timedelta(days=older_than)
-            proxies = proxies.where(Proxy.updated_at > a_day_ago)  # type: ignore
 
-        pf.check_proxies(proxies)
+        proxies, total = check_candidates(
+            status, older_than=older_than, budget=budget, shard=shard
+        )
+        if budget:
+            logging.info(f"{total} proxies are due for a check (budget: {budget}).")
+        pf.check_proxies(proxies, engine=engine, prefilter=tcp_prefilter, total=total)
 
     # latency_mean = Proxy.select(fn.AVG(Proxy.latency)).where(Proxy.is_working == True).scalar()  # type: ignore
     # latency_mean = round(latency_mean, 2)
@@ -217,10 +815,21 @@ def ckeck_proxies(concurrency, status=ProxyStatus.UNCHECKED, older_than=0):
     # )
 
 
-def find_proxies(concurrency):
-    with ProxyFinder(concurrency=concurrency) as pf:
+def find_proxies(
+    concurrency, use_cache=True, fetch_connect_timeout=None, fetch_read_timeout=None
+):
+    from proxyfinder.proxyfinder import ProxyFinder
+
+    if concurrency == "auto":
+        concurrency = 10
+    with ProxyFinder(
+        concurrency=concurrency,
+        use_source_cache=use_cache,
+        fetch_connect_timeout=fetch_connect_timeout,
+        fetch_read_timeout=fetch_read_timeout,
+    ) as pf:
         news_proxies = pf.get_proxies_from_multiple_sources()
-        count_new_proxies = Proxy.save_proxies(news_proxies)
+        count_new_proxies = Proxy.save_proxies(map(unpack_proxy, news_proxies))
         logging.info(f"Obtained {count_new_proxies} new proxies from multiple sources.")
 
 
@@ -231,91 +840,158 @@ def export_proxies(
     older_than=0,
     sort_by="latency",
     reverse=False,
+    export_format=None,
+    protocols=None,
+    supports_connect=False,
+    countries=None,
+    asns=None,
 ):
-    output = Path(output) if isinstance(output, str) else output
-    if status == ProxyStatus.WORKING:
-        proxies = Proxy.select().where(
-            Proxy.is_working == True, Proxy.is_checked == True
-        )
-    elif status == ProxyStatus.BROKEN:
-        proxies = Proxy.select().where(
-            Proxy.is_working == False, Proxy.is_checked == True
-        )
-    elif status == ProxyStatus.UNCHECKED:
-        proxies = Proxy.select().where(Proxy.is_checked == False)
-    elif status == ProxyStatus.ALL:
-        proxies = Proxy.select()
-    else:
-        raise ValueError(f"Invalid status: {status}")
+    from proxyfinder.export import detect_format, export_query
 
-    if limit:
-        proxies = proxies.limit(limit)
+    output = str(output)
+    proxies = select_proxies(
+        status,
+        limit=limit,
+        sort_by=sort_by,
+        reverse=reverse,
+        older_than=older_than,
+        protocols=protocols,
+        supports_connect=supports_connect,
+        countries=countries,
+        asns=asns,
+    )
+    if export_format is None and output != "-":
+        export_format = detect_format(output)
 
-    if older_than > 0 and status != ProxyStatus.ALL:
-        a_day_ago = datetime.now() - timedelta(days=older_than)
-        proxies = proxies.where(Proxy.updated_at > a_day_ago)  # type: ignore
+    try:
+        export_query(proxies, output, export_format)
+    except OSError as e:
+        logging.error(f"Error exporting proxies: {e}")
+        sys.exit(1)
 
-    proxies = sorted(proxies, key=lambda x: getattr(x, sort_by), reverse=reverse)
 
-    output.parent.mkdir(parents=True, exist_ok=True)
-    if output.suffix == ".csv":
-        try:
-            with open(output, "w", newline="", encoding="utf-8") as csvfile:
-                fieldnames = [
-                    "proxy",
-                    "is_working",
-                    "latency",
-                    "is_checked",
-                    "created_at",
-                    "updated_at",
-                    "note",
-                ]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-
-                for proxy in proxies:
-                    writer.writerow(
-                        {
-                            "proxy": proxy.proxy,
-                            "is_working": proxy.is_working,
-                            "latency": proxy.latency,
-                            "is_checked": proxy.is_checked,
-                            "created_at": proxy.created_at,
-                            "updated_at": proxy.updated_at,
-                            "note": proxy.note,
-                        }
-                    )
-            logging.info(f"Proxies successfully exported to {output}")
-        except Exception as e:
-            logging.error(f"Error exporting proxies: {e}")
-    elif output.suffix == ".json":
-        try:
-            with open(output, "w", encoding="utf-8") as f:
-                json.dump([proxy.to_dict() for proxy in proxies], f, indent=4)
-            logging.info(f"Proxies successfully exported to {output}")
-        except Exception as e:
-            logging.error(f"Error exporting proxies: {e}")
-    elif output.suffix == ".txt":
+def update_proxies(
+    concurrency,
+    engine="thread",
+    max_concurrency=None,
+    prefilter=False,
+    prefilter_timeout=3,
+    prefilter_concurrency=1000,
+    connect_timeout=None,
+    read_timeout=None,
+    fetch_connect_timeout=None,
+    fetch_read_timeout=None,
+):
+    find_proxies(
+        concurrency=concurrency,
+        fetch_connect_timeout=fetch_connect_timeout,
+        fetch_read_timeout=fetch_read_timeout,
+    )
+    ckeck_proxies(
+        concurrency=concurrency,
+        status=ProxyStatus.UNCHECKED,
+        engine=engine,
+        max_concurrency=max_concurrency,
+        prefilter=prefilter,
+        prefilter_timeout=prefilter_timeout,
+        prefilter_concurrency=prefilter_concurrency,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+    )
+
+
+def serve(
+    concurrency,
+    engine="thread",
+    max_concurrency=None,
+    find_interval=60,
+    batch_size=1000,
+    rate=0,
+    idle_interval=30,
+    prefilter=False,
+    prefilter_timeout=3,
+    prefilter_concurrency=1000,
+    connect_timeout=None,
+    read_timeout=None,
+    fetch_connect_timeout=None,
+    fetch_read_timeout=None,
+):
+    from proxyfinder.daemon import ProxyDaemon
+    from proxyfinder.prefilter import TcpPrefilter
+    from proxyfinder.proxyfinder import ProxyFinder
+
+    with ProxyFinder(
+        concurrency=concurrency,
+        max_concurrency=max_concurrency,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        fetch_connect_timeout=fetch_connect_timeout,
+        fetch_read_timeout=fetch_read_timeout,
+    ) as pf:
+        tcp_prefilter = None
+        if prefilter:
+            tcp_prefilter = TcpPrefilter(
+                timeout=prefilter_timeout, concurrency=prefilter_concurrency
+            )
+        daemon = ProxyDaemon(
+            pf,
+            find_interval=find_interval * 60,
+            batch_size=batch_size,
+            rate=rate,
+            idle_interval=idle_interval,
+            engine=engine,
+            prefilter=tcp_prefilter,
+        )
+        daemon.run()
+
+
+def geolocate_proxies(download=False, dataset=None):
+    from proxyfinder.geo import download_dataset, enrich_proxies, load_geo_index
+
+    if download:
         try:
-            with open(output, "w", encoding="utf-8") as f:
-                f.write("\n".join([proxy.proxy for proxy in proxies]))
-            logging.info(f"Proxies successfully exported to {output}")
+            download_dataset(path=dataset)
         except Exception as e:
-            logging.error(f"Error exporting proxies: {e}")
-    else:
-        raise ValueError(f"Invalid output format: {output.suffix}")
+            logging.error(f"Error downloading the IP dataset: {e}")
+            return
+    index = load_geo_index(dataset)
+    if index is None:
+        logging.error("No IP dataset: run `proxyfinder geo --download` first.")
+        return
+    logging.info(f"IP dataset with {len(index)} ranges.")
+    enrich_proxies(index=index)
+
 
+def run_gateway(host="127.0.0.1", port=8899, refresh=10, timeout=10, spread=10):
+    from proxyfinder.gateway import Gateway, HotPool
 
-def update_proxies(concurrency):
-    find_proxies(concurrency=concurrency)
-    ckeck_proxies(concurrency=concurrency, status=ProxyStatus.UNCHECKED)
+    gateway = Gateway(
+        HotPool(),
+        host=host,
+        port=port,
+        refresh_interval=refresh,
+        timeout=timeout,
+        spread=spread,
+    )
+    gateway.run()
 
 
 def main():
+    setup_logging()
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     args = config_args()
 
+    exporter = None
+    if getattr(args, "metrics_file", None) or getattr(args, "metrics_port", None):
+        from proxyfinder.metrics import MetricsExporter
+
+        exporter = MetricsExporter(path=args.metrics_file, port=args.metrics_port)
+        exporter.start()
+    if getattr(args, "deadline", None):
+        start_deadline(args.deadline)
+
     try:
         logger.debug(f"Action: {args.action} args: {args}")
         if args.action == "check":
@@ -323,6 +999,16 @@ def main():
                 concurrency=args.concurrency,
                 status=args.status,
                 older_than=args.older_than,
+                engine=args.engine,
+                max_concurrency=args.max_concurrency,
+                prefilter=args.prefilter,
+                prefilter_timeout=args.prefilter_timeout,
+                prefilter_concurrency=args.prefilter_concurrency,
+                budget=args.budget,
+                workers=args.workers,
+                shard=(args.shard_id, args.shard_count),
+                connect_timeout=args.connect_timeout,
+                read_timeout=args.read_timeout,
             )
         elif args.action == "export":
             export_proxies(
@@ -332,24 +1018,88 @@ def main():
                 sort_by=args.sort_by,
                 reverse=args.reverse,
                 older_than=args.older_than,
+                export_format=args.export_format,
+                protocols=args.protocol,
+                supports_connect=args.supports_connect,
+                countries=args.country,
+                asns=args.asn,
             )
         elif args.action == "find":
-            find_proxies(concurrency=args.concurrency)
+            find_proxies(
+                concurrency=args.concurrency,
+                use_cache=not args.no_cache,
+                fetch_connect_timeout=args.fetch_connect_timeout,
+                fetch_read_timeout=args.fetch_read_timeout,
+            )
         elif args.action == "update":
-            update_proxies(concurrency=args.concurrency)
+            update_proxies(
+                concurrency=args.concurrency,
+                engine=args.engine,
+                max_concurrency=args.max_concurrency,
+                prefilter=args.prefilter,
+                prefilter_timeout=args.prefilter_timeout,
+                prefilter_concurrency=args.prefilter_concurrency,
+                connect_timeout=args.connect_timeout,
+                read_timeout=args.read_timeout,
+                fetch_connect_timeout=args.fetch_connect_timeout,
+                fetch_read_timeout=args.fetch_read_timeout,
+            )
+        elif args.action == "serve":
+            serve(
+                concurrency=args.concurrency,
+                engine=args.engine,
+                max_concurrency=args.max_concurrency,
+                find_interval=args.find_interval,
+                batch_size=args.batch,
+                rate=args.rate,
+                idle_interval=args.idle,
+                prefilter=args.prefilter,
+                prefilter_timeout=args.prefilter_timeout,
+                prefilter_concurrency=args.prefilter_concurrency,
+                connect_timeout=args.connect_timeout,
+                read_timeout=args.read_timeout,
+                fetch_connect_timeout=args.fetch_connect_timeout,
+                fetch_read_timeout=args.fetch_read_timeout,
+            )
+        elif args.action == "gateway":
+            run_gateway(
+                host=args.host,
+                port=args.port,
+                refresh=args.refresh,
+                timeout=args.timeout,
+                spread=args.spread,
+            )
+        elif args.action == "geo":
+            geolocate_proxies(download=args.download, dataset=args.dataset)
+        elif args.action == "bench":
+            from proxyfinder.bench import run_bench
+
+            report = run_bench(
+                args.target, args.sizes, args.pages, args.output, args.compare
+            )
+            if report.get("regressions"):
+                sys.exit(1)
         elif args.action == "show":
             show_proxies(
                 status=args.status,
                 limit=args.limit,
                 count=args.count,
+                refresh=args.refresh,
                 sort_by=args.sort_by,
                 reverse=args.reverse,
                 older_than=args.older_than,
+                protocols=args.protocol,
+                supports_connect=args.supports_connect,
+                countries=args.country,
+                asns=args.asn,
             )
 
     except KeyboardInterrupt:
         logging.info("Proceso interrumpido por el usuario.")
         sys.exit(0)
+    finally:
+        if exporter is not None:
+            exporter.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+import errno
+import logging
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+OUTCOME_OK = "ok"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_ERROR = "error"
+OUTCOME_LOCAL = "local"
+
+# Errors raised by our own machine, not by the proxy: too many open files,
+# ephemeral port exhaustion, no buffer space.
+LOCAL_ERRNOS = [
+    errno.EMFILE,
+    errno.ENFILE,
+    errno.EADDRNOTAVAIL,
+    errno.EADDRINUSE,
+    errno.ENOBUFS,
+]
+LOCAL_ERROR_MARKERS = [f"[Errno {code}]" for code in LOCAL_ERRNOS] + [
+    "Too many open files",
+    "Cannot assign requested address",
+    "[WinError 10024]",
+    "[WinError 10048]",
+    "[WinError 10055]",
+]
+
+
+def classify_error(message: str) -> str:
+    """Classifies the text of a failed check into one of the OUTCOME_* values."""
+    if any(marker in message for marker in LOCAL_ERROR_MARKERS):
+        return OUTCOME_LOCAL
+    if "timed out" in message or "timeout" in message.lower():
+        return OUTCOME_TIMEOUT
+    return OUTCOME_ERROR
+
+
+class ConcurrencyController:
+    """
+    Decides how many checks may be in flight.
+
+    With `adaptive=False` the limit is fixed. With `adaptive=True` the limit is
+    re-evaluated every `interval` seconds from the outcomes recorded in that
+    window: local socket errors halve it, a rising timeout rate reduces it, an
+    increase that did not improve throughput is undone and otherwise it grows
+    by 25%. It never exceeds `maximum`.
+    """
+
+    def __init__(
+        self,
+        limit: int = 10,
+        maximum: Optional[int] = None,
+        adaptive: bool = False,
+        minimum: int = 1,
+        interval: float = 2.0,
+        min_samples: int = 20,
+    ):
+        self.maximum = maximum or limit
+        self.minimum = min(minimum, self.maximum)
+        self.adaptive = adaptive
+        self.interval = interval
+        self.min_samples = min_samples
+        self._limit = max(self.minimum, min(limit, self.maximum))
+        self._lock = threading.Lock()
+        self._last_step = 0
+        self._previous = None  # (throughput, timeout_rate) of the last window
+        self._reset_window(time.monotonic())
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def _reset_window(self, now: float):
+        self._window_start = now
+        self._counts = {
+            OUTCOME_OK: 0,
+            OUTCOME_TIMEOUT: 0,
+            OUTCOME_ERROR: 0,
+            OUTCOME_LOCAL: 0,
+        }
+
+    def record(self, outcome: str):
+        """Records the outcome of a finished check."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            self._counts[outcome] += 1
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.interval:
+                return
+            if sum(self._counts.values()) >= self.min_samples or self._counts[
+                OUTCOME_LOCAL
+            ]:
+                self._adjust(elapsed)
+                self._reset_window(now)
+
+    def _adjust(self, elapsed: float):
+        total = sum(self._counts.values())
+        throughput = total / elapsed
+        timeout_rate = self._counts[OUTCOME_TIMEOUT] / total
+        previous = self._previous
+        old_limit = self._limit
+
+        if self._counts[OUTCOME_LOCAL]:
+            new_limit = self._limit // 2
+            reason = f"{self._counts[OUTCOME_LOCAL]} local socket errors"
+        elif previous and timeout_rate > previous[1] + 0.10:
+            new_limit = int(self._limit * 0.75)
+            reason = f"timeout rate rose to {timeout_rate:.0%}"
+        elif previous and self._last_step > 0 and throughput < previous[0] * 1.02:
+            new_limit = self._limit - self._last_step
+            reason = f"throughput did not improve ({throughput:.1f}/s)"
+        else:
+            new_limit = self._limit + max(1, self._limit // 4)
+            reason = f"throughput {throughput:.1f}/s"
+
+        self._limit = max(self.minimum, min(new_limit, self.maximum))
+        self._last_step = self._limit - old_limit
+        self._previous = (throughput, timeout_rate)
+        if self._limit != old_limit:
+            logger.debug(
+                f"Concurrency {old_limit} -> {self._limit} ({reason})."
+            )
@@ -0,0 +1,123 @@
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+from proxyfinder.database import Proxy, iterate_due, select_due
+from proxyfinder.prefilter import TcpPrefilter
+from proxyfinder.proxyfinder import ProxyFinder
+from proxyfinder.utils import STOP_FLAG, unpack_proxy
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyDaemon:
+    """
+    Runs `find` and `check` in a loop with a single `ProxyFinder`, so the thread
+    pool, the HTTP session and the validated test URLs are kept between rounds.
+
+    Sources are scraped every `find_interval` seconds. New proxies are due for a
+    check as soon as they are saved, so they are checked in the next round along
+    with the rest of the pool, in the order of the recheck schedule (see
+    `next_check_delay`). Each round checks at most `batch_size` proxies and,
+    with a `rate`, rounds are spaced so that no more than `rate` checks per
+    second are started on average. Concurrency is the one of the `ProxyFinder`.
+
+    A round that fails, e.g. on a database error, is logged and the loop goes
+    on after `error_interval` seconds.
+
+    `STOP_FLAG` ends the loop: the checks in flight finish and are saved by the
+    `ResultWriter` of the round before `run` returns.
+    """
+
+    def __init__(
+        self,
+        finder: ProxyFinder,
+        find_interval: float = 3600,
+        batch_size: int = 1000,
+        rate: float = 0,
+        idle_interval: float = 30,
+        engine: str = "thread",
+        prefilter: Optional[TcpPrefilter] = None,
+        error_interval: float = 30,
+    ):
+        self.finder = finder
+        self.find_interval = find_interval
+        self.batch_size = batch_size
+        self.rate = rate
+        self.idle_interval = idle_interval
+        self.engine = engine
+        self.prefilter = prefilter
+        self.error_interval = error_interval
+        self.next_find_at = 0.0
+
+    def find(self) -> int:
+        """
+        Scrapes the sources once. Returns the number of new proxies. The next
+        find is scheduled first, so a failing one does not hold up the checks.
+        """
+        self.next_find_at = time.monotonic() + self.find_interval
+        keys = self.finder.get_proxies_from_multiple_sources()
+        count = Proxy.save_proxies(map(unpack_proxy, keys))
+        logger.info(f"Obtained {count} new proxies from multiple sources.")
+        return count
+
+    def check_due(self) -> int:
+        """Checks one batch of due proxies. Returns the number selected."""
+        now = datetime.now()
+        due = select_due(self.batch_size, now).count()
+        if due:
+            self.finder.check_proxies(
+                iterate_due(self.batch_size, now),
+                engine=self.engine,
+                prefilter=self.prefilter,
+                total=due,
+            )
+        return due
+
+    def _idle_time(self) -> float:
+        """Seconds until a proxy is due, capped by the next find and `idle_interval`."""
+        wait = min(self.idle_interval, self.next_find_at - time.monotonic())
+        next_check = (
+            Proxy.select(Proxy.next_check_at)
+            .where(Proxy.next_check_at.is_null(False))  # type: ignore
+            .order_by(Proxy.next_check_at)
+            .limit(1)
+            .scalar()
+        )
+        if next_check is not None:
+            wait = min(wait, (next_check - datetime.now()).total_seconds())
+        return max(wait, 0)
+
+    def run_round(self) -> float:
+        """Runs a find or a check round. Returns the seconds to wait after it."""
+        if time.monotonic() >= self.next_find_at:
+            self.find()
+            return 0
+
+        start_time = time.monotonic()
+        checked = self.check_due()
+        if checked:
+            # Keeps the average under `rate` checks per second.
+            wait = checked / self.rate if self.rate else 0
+            wait -= time.monotonic() - start_time
+            return min(wait, self.next_find_at - time.monotonic())
+        return self._idle_time()
+
+    def run(self):
+        logger.info(
+            f"Serving: find every {self.find_interval / 60:g} min, batches of "
+            f"{self.batch_size} proxies, rate: {self.rate or 'unlimited'} checks/s."
+        )
+        while not STOP_FLAG.is_set():
+            try:
+                wait = self.run_round()
+            except Exception:
+                logger.exception(
+                    f"Round failed, retrying in {self.error_interval:g} s."
+                )
+                wait = self.error_interval
+            if wait > 0:
+                logger.debug(f"Waiting {wait:.1f} s for the next round.")
+                STOP_FLAG.wait(wait)
+        logger.info("Daemon stopped.")
@@ -1,12 +1,50 @@
-from datetime import datetime
+import hashlib
+import logging
+import math
+import queue
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import peewee
-from playhouse.sqlite_ext import JSONField
 from playhouse.shortcuts import chunked
+from proxyfinder.metrics import METRICS
 from proxyfinder.utils import PROXIES_OUT_DIR
 
+logger = logging.getLogger(__name__)
+
 database_path = PROXIES_OUT_DIR / "proxies.db"
-db = peewee.SqliteDatabase(database_path)
+
+
+class ProxyDatabase(peewee.SqliteDatabase):
+    """
+    SQLite database that brings its schema up to date when a connection is
+    opened (see `setup_database`). Nothing is opened at import time: peewee
+    connects on the first query.
+    """
+
+    def _initialize_connection(self, conn):
+        super()._initialize_connection(conn)
+        setup_database(self)
+
+
+# WAL lets the result writer thread commit while other threads read pages.
+db = ProxyDatabase(
+    database_path, pragmas={"journal_mode": "wal", "synchronous": "normal"}
+)
+
+
+@db.func("proxy_shard", 2, deterministic=True)
+def proxy_shard(proxy: str, shard_count: int) -> int:
+    """
+    Shard of an "ip:port" among `shard_count`, from a hash that is the same in
+    every process and host.
+    """
+    digest = hashlib.blake2b(proxy.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % shard_count
 
 
 class Proxy(peewee.Model):
@@ -17,8 +55,26 @@ class Proxy(peewee.Model):
     created_at = peewee.DateTimeField(default=datetime.now)
     updated_at = peewee.DateTimeField(default=datetime.now)
     note = peewee.TextField(null=True)
-    location = JSONField(null=True)
     error = peewee.TextField(null=True)
+    # Rolling statistics of the checks, see `ResultWriter`.
+    success_ratio = peewee.FloatField(null=True)
+    ewma_latency = peewee.FloatField(null=True)
+    p95_latency = peewee.FloatField(null=True)
+    consecutive_failures = peewee.IntegerField(
+        default=0, constraints=[peewee.SQL("DEFAULT 0")]
+    )
+    # Recheck schedule, see `next_check_delay`.
+    last_success_at = peewee.DateTimeField(null=True)
+    next_check_at = peewee.DateTimeField(null=True, default=datetime.now, index=True)
+    # Detected by the checks, see `protocols.py`: "http", "socks4" or
+    # "socks5", and whether the proxy opened a tunnel to the test URL.
+    protocol = peewee.CharField(null=True)
+    supports_connect = peewee.BooleanField(null=True)
+    # Address the test URL saw the check come from, and the country and
+    # autonomous system of the proxy, looked up locally (see `geo.py`).
+    egress_ip = peewee.CharField(null=True)
+    country = peewee.CharField(max_length=2, null=True)
+    asn = peewee.IntegerField(null=True)
 
     class Meta:
         database = db
@@ -28,14 +84,31 @@ class Proxy(peewee.Model):
         return super().save(*args, **kwargs)
 
     @classmethod
-    def save_proxies(cls, proxies: list[str]) -> int:
-        existing = [i.proxy for i in Proxy.select().where(Proxy.proxy.in_(proxies))]  # type: ignore
-        new_items = [Proxy(proxy=i) for i in proxies if i not in existing]
-        if new_items:
-            with db.atomic():
-                for batch in chunked(new_items, 500):
-                    Proxy.bulk_create(batch)
-        return len(new_items)
+    def save_proxies(cls, proxies: Iterable[str], batch_size: int = 50000) -> int:
+        """
+        Inserts the proxies that are not in the table yet and returns how many
+        rows were really inserted.
+
+        Rows are written with INSERT OR IGNORE against the unique `proxy`
+        column, one transaction per `batch_size` candidates, so neither the
+        number of bound parameters nor memory grows with the input.
+        """
+        database = cls._meta.database
+        table = cls._meta.table_name
+        sql = (
+            f"INSERT OR IGNORE INTO {table} "
+            "(proxy, is_working, latency, is_checked, created_at, updated_at,"
+            " next_check_at) VALUES (?, 0, 0, 0, ?, ?, ?)"
+        )
+        now = str(datetime.now())
+        connection = database.connection()
+        changes = connection.total_changes
+        for batch in chunked(proxies, batch_size):
+            with database.atomic():
+                database.cursor().executemany(
+                    sql, [(i, now, now, now) for i in sorted(batch)]
+                )
+        return connection.total_changes - changes
 
     def to_dict(self):
         return {
@@ -46,13 +119,456 @@ class Proxy(peewee.Model):
             "created_at": self.created_at.strftime("%Y-%m-%d %H:%M"),
             "updated_at": self.updated_at.strftime("%Y-%m-%d %H:%M"),
             "note": self.note,
-            "location": self.location,
             "error": self.error,
+            "success_ratio": self.success_ratio,
+            "ewma_latency": self.ewma_latency,
+            "p95_latency": self.p95_latency,
+            "consecutive_failures": self.consecutive_failures,
+            "protocol": self.protocol,
+            "supports_connect": self.supports_connect,
+            "egress_ip": self.egress_ip,
+            "country": self.country,
+            "asn": self.asn,
+        }
+
+
+class ProxyCheck(peewee.Model):
+    """
+    Append-only history with one row per check of a proxy. `latency` is None
+    when the check failed.
+    """
+
+    proxy_id = peewee.IntegerField()
+    checked_at = peewee.IntegerField()  # unix time
+    latency = peewee.IntegerField(null=True)  # ms
+
+    class Meta:
+        database = db
+        table_name = "proxy_check"
+        primary_key = False
+        indexes = ((("proxy_id", "checked_at"), False), (("checked_at",), False))
+
+
+class ProxyCheckDaily(peewee.Model):
+    """Checks older than HISTORY_RAW_DAYS, merged into one row per proxy and day."""
+
+    proxy_id = peewee.IntegerField()
+    day = peewee.IntegerField()  # unix time of 00:00 UTC
+    checks = peewee.IntegerField()
+    successes = peewee.IntegerField()
+    mean_latency = peewee.FloatField(null=True)
+
+    class Meta:
+        database = db
+        table_name = "proxy_check_daily"
+        primary_key = peewee.CompositeKey("proxy_id", "day")
+        indexes = ((("day",), False),)
+
+
+# Statistics shown and sortable in `show` and `export`.
+STATS_FIELDS = [
+    "success_ratio",
+    "ewma_latency",
+    "p95_latency",
+    "consecutive_failures",
+]
+STATS_WINDOW = 20  # checks used for success_ratio and p95_latency
+EWMA_ALPHA = 0.3
+HISTORY_RAW_DAYS = 7
+HISTORY_KEEP_DAYS = 90
+
+# Recheck schedule, in seconds.
+RECHECK_WORKING = 30 * 60
+BACKOFF_BASE = 60 * 60  # failing proxy that worked in the last BACKOFF_MEMORY
+BACKOFF_BASE_DEAD = 6 * 60 * 60  # failing proxy that did not
+BACKOFF_MEMORY = 7 * 24 * 60 * 60
+BACKOFF_MAX = 30 * 24 * 60 * 60
+
+
+def next_check_delay(
+    is_working: bool,
+    failures: int,
+    last_success_at: Optional[datetime],
+    now: datetime,
+) -> timedelta:
+    """
+    Time until a proxy is worth checking again. A working proxy is rechecked
+    after RECHECK_WORKING. A failing one backs off exponentially with its
+    streak of `failures`, from BACKOFF_BASE if it worked recently or
+    BACKOFF_BASE_DEAD otherwise, up to BACKOFF_MAX. A +-10% jitter spreads the
+    rechecks of proxies that were checked together.
+    """
+    if is_working:
+        seconds = RECHECK_WORKING
+    else:
+        recent = (
+            last_success_at is not None
+            and (now - last_success_at).total_seconds() < BACKOFF_MEMORY
+        )
+        base = BACKOFF_BASE if recent else BACKOFF_BASE_DEAD
+        seconds = min(BACKOFF_MAX, base * 2 ** min(max(failures - 1, 0), 16))
+    return timedelta(seconds=seconds * random.uniform(0.9, 1.1))
+
+
+def in_shard(
+    query: peewee.ModelSelect, shard: Optional[Tuple[int, int]]
+) -> peewee.ModelSelect:
+    """
+    Restricts `query` to the proxies of `shard`, a `(shard_id, shard_count)`
+    pair (see `proxy_shard`). The shards of a count never overlap and
+    together cover the whole table.
+    """
+    if shard is None or shard[1] <= 1:
+        return query
+    shard_id, shard_count = shard
+    return query.where(peewee.fn.proxy_shard(Proxy.proxy, shard_count) == shard_id)
+
+
+def select_due(
+    limit: int,
+    now: Optional[datetime] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> peewee.ModelSelect:
+    """
+    The `limit` proxies whose `next_check_at` has passed, most overdue first.
+    Served by the index on `next_check_at`.
+    """
+    now = now or datetime.now()
+    query = Proxy.select().where(Proxy.next_check_at <= now)
+    return in_shard(query, shard).order_by(Proxy.next_check_at, Proxy.id).limit(limit)
+
+
+def iterate_due(
+    limit: int,
+    now: Optional[datetime] = None,
+    page_size: int = 1000,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[Proxy]:
+    """
+    Iterates over `select_due(limit, now)` `page_size` rows at a time, with
+    keyset pagination on (`next_check_at`, `id`). Checked proxies are
+    rescheduled after `now`, so they leave the range and are never read twice.
+    """
+    now = now or datetime.now()
+    last = None
+    remaining = limit
+    while remaining > 0:
+        query = select_due(min(page_size, remaining), now, shard)
+        if last is not None:
+            query = query.where(
+                (Proxy.next_check_at > last.next_check_at)
+                | ((Proxy.next_check_at == last.next_check_at) & (Proxy.id > last.id))
+            )
+        page = list(query)
+        if not page:
+            return
+        yield from page
+        remaining -= len(page)
+        last = page[-1]
+        if len(page) < page_size:
+            return
+
+
+def iterate_in_pages(query: peewee.ModelSelect, page_size: int = 1000):
+    """
+    Iterates over the rows of `query` reading `page_size` rows at a time.
+
+    Uses keyset pagination on the primary key instead of OFFSET, so rows that
+    stop matching the query while it is being consumed (e.g. unchecked proxies
+    that were just checked) do not make it skip rows.
+    """
+    model = query.model
+    last_id = 0
+    while True:
+        page = list(
+            query.where(model.id > last_id).order_by(model.id).limit(page_size)
+        )
+        if not page:
+            return
+        yield from page
+        last_id = page[-1].id
+        if len(page) < page_size:
+            return
+
+
+class ResultWriter(threading.Thread):
+    """
+    Single thread that persists checked proxies.
+
+    Results are queued with `put` and written by upserting on the unique
+    `proxy` column, in one transaction per `batch_size` rows or every
+    `flush_interval` seconds, whichever comes first. `close` writes whatever
+    is still queued and waits for the thread to finish.
+
+    Each check is also appended to `ProxyCheck`, and the rolling statistics
+    of the proxy are updated in the same transaction: `ewma_latency` and
+    `consecutive_failures` from their previous values, `success_ratio` and
+    `p95_latency` from the last STATS_WINDOW checks.
+
+    A batch whose transaction fails with an `OperationalError`, e.g. while
+    another process holds the database locked, is tried again up to
+    WRITE_ATTEMPTS times with a doubling delay. Batches that still fail are
+    dropped and counted in `METRICS`.
+
+    The time each row waited between `put` and its commit is recorded in
+    `METRICS` as the write lag.
+    """
+
+    FIELDS = [
+        "proxy",
+        "is_checked",
+        "is_working",
+        "latency",
+        "updated_at",
+        "egress_ip",
+        "error",
+        "protocol",
+        "supports_connect",
+    ]
+    ROWS_PER_STATEMENT = 100  # keeps every INSERT below SQLite's variable limit
+    WRITE_ATTEMPTS = 5
+    RETRY_DELAY = 0.1  # seconds before the second attempt, doubled after each
+
+    _CLOSE = object()
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0):
+        super().__init__(name="result-writer", daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=batch_size * 4)
+        self.written = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @classmethod
+    def row(cls, proxy: Proxy) -> tuple:
+        """What is written for a checked proxy, as a picklable tuple."""
+        return (
+            proxy.id,
+            tuple(getattr(proxy, field) for field in cls.FIELDS),
+            proxy.consecutive_failures,
+            proxy.last_success_at,
+        )
+
+    def put(self, proxy: Proxy):
+        """Queues a checked proxy. Blocks while the writer is too far behind."""
+        self.put_row(self.row(proxy))
+
+    def put_row(self, row: tuple):
+        """Same as `put` for a tuple made by `row`, e.g. in another process."""
+        self.queue.put((time.monotonic(), row))
+
+    def close(self):
+        self.queue.put(self._CLOSE)
+        self.join()
+
+    def run(self):
+        batch = []
+        deadline = 0.0
+        try:
+            while True:
+                timeout = max(0.0, deadline - time.monotonic()) if batch else None
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+                if item is self._CLOSE:
+                    break
+                if item is not None:
+                    if not batch:
+                        deadline = time.monotonic() + self.flush_interval
+                    batch.append(item)
+                if batch and (
+                    len(batch) >= self.batch_size or time.monotonic() >= deadline
+                ):
+                    self._write(batch)
+                    batch = []
+            if batch:
+                self._write(batch)
+        finally:
+            db.close()
+
+    def _write(self, items: list):
+        rows = [row for _, row in items]
+        fields = [getattr(Proxy, field) for field in self.FIELDS]
+        fields += [Proxy.last_success_at, Proxy.next_check_at]
+        preserve = fields[1:]
+        fields += [Proxy.ewma_latency, Proxy.consecutive_failures]
+        working = peewee.EXCLUDED.is_working == True
+        update = {
+            Proxy.ewma_latency: peewee.Case(
+                None,
+                [
+                    (
+                        working,
+                        peewee.fn.COALESCE(
+                            Proxy.ewma_latency * (1 - EWMA_ALPHA)
+                            + peewee.EXCLUDED.latency * EWMA_ALPHA,
+                            peewee.EXCLUDED.latency,
+                        ),
+                    )
+                ],
+                Proxy.ewma_latency,
+            ),
+            Proxy.consecutive_failures: peewee.Case(
+                None, [(working, 0)], Proxy.consecutive_failures + 1
+            ),
         }
+        values = []
+        history = []
+        for proxy_id, row, failures, last_success_at in rows:
+            is_working, latency, updated_at = row[2], row[3], row[4]
+            failures = 0 if is_working else (failures or 0) + 1
+            if is_working:
+                last_success_at = updated_at
+            next_check_at = updated_at + next_check_delay(
+                is_working, failures, last_success_at, updated_at
+            )
+            # A new row starts the statistics with this check.
+            values.append(
+                row
+                + (last_success_at, next_check_at)
+                + ((latency, 0) if is_working else (None, 1))
+            )
+            if proxy_id is not None:
+                history.append(
+                    (
+                        proxy_id,
+                        int(updated_at.timestamp()),
+                        round(latency) if is_working else None,
+                    )
+                )
+        delay = self.RETRY_DELAY
+        for attempt in range(1, self.WRITE_ATTEMPTS + 1):
+            try:
+                with db.atomic():
+                    for chunk in chunked(values, self.ROWS_PER_STATEMENT):
+                        Proxy.insert_many(chunk, fields=fields).on_conflict(
+                            conflict_target=[Proxy.proxy],
+                            preserve=preserve,
+                            update=update,
+                        ).execute()
+                    for chunk in chunked(history, self.ROWS_PER_STATEMENT):
+                        ProxyCheck.insert_many(
+                            chunk,
+                            fields=[
+                                ProxyCheck.proxy_id,
+                                ProxyCheck.checked_at,
+                                ProxyCheck.latency,
+                            ],
+                        ).execute()
+                    update_window_stats([proxy_id for proxy_id, *_ in history])
+            except peewee.OperationalError as e:
+                if attempt < self.WRITE_ATTEMPTS:
+                    logger.warning(
+                        f"Error saving {len(rows)} checked proxies, "
+                        f"retrying in {delay:g} s: {e}"
+                    )
+                    time.sleep(delay)
+                    delay *= 2
+                    continue
+                error = e
+            except peewee.PeeweeException as e:
+                error = e
+            else:
+                break
+            logger.error(f"Error saving {len(rows)} checked proxies, dropped: {error}")
+            METRICS.inc("proxyfinder_db_rows_dropped_total", len(rows))
+            return
+        self.written += len(rows)
+        committed_at = time.monotonic()
+        for queued_at, _ in items:
+            lag = committed_at - queued_at
+            METRICS.observe("proxyfinder_db_write_lag_seconds", lag)
+        METRICS.inc("proxyfinder_db_rows_written_total", len(rows))
+        logger.debug(f"Updated {len(rows)} proxies in the database.")
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of `values`, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def update_window_stats(proxy_ids: List[int], batch_size: int = 500):
+    """
+    Recomputes `success_ratio` and `p95_latency` of `proxy_ids` from their
+    last STATS_WINDOW rows in `ProxyCheck`.
+    """
+    for chunk in chunked(sorted(set(proxy_ids)), batch_size):
+        cursor = db.execute_sql(
+            "SELECT proxy_id, latency FROM ("
+            " SELECT proxy_id, latency, ROW_NUMBER() OVER ("
+            "  PARTITION BY proxy_id ORDER BY checked_at DESC, rowid DESC"
+            " ) AS position"
+            f" FROM proxy_check WHERE proxy_id IN ({', '.join('?' * len(chunk))})"
+            f") WHERE position <= {STATS_WINDOW}",
+            chunk,
+        )
+        windows = {}
+        for proxy_id, latency in cursor:
+            windows.setdefault(proxy_id, []).append(latency)
+        stats = []
+        for proxy_id, window in windows.items():
+            latencies = [latency for latency in window if latency is not None]
+            stats.append(
+                (
+                    round(len(latencies) / len(window), 4),
+                    percentile(latencies, 0.95),
+                    proxy_id,
+                )
+            )
+        db.cursor().executemany(
+            "UPDATE proxy SET success_ratio = ?, p95_latency = ? WHERE id = ?",
+            stats,
+        )
 
 
-db.connect()
-db.create_tables([Proxy], safe=True)
+def compact_history(now: Optional[float] = None) -> int:
+    """
+    Keeps the check history bounded: checks older than HISTORY_RAW_DAYS are
+    merged into `ProxyCheckDaily` and deleted, and daily rows older than
+    HISTORY_KEEP_DAYS are deleted. Returns the number of checks merged.
+    """
+    now = time.time() if now is None else now
+    raw_cutoff = int(now - HISTORY_RAW_DAYS * 86400)
+    raw_cutoff -= raw_cutoff % 86400  # only whole days are merged
+    keep_cutoff = int(now - HISTORY_KEEP_DAYS * 86400)
+    with db.atomic():
+        merged = (
+            ProxyCheck.select().where(ProxyCheck.checked_at < raw_cutoff).count()
+        )
+        if merged:
+            db.execute_sql(
+                "INSERT INTO proxy_check_daily"
+                " (proxy_id, day, checks, successes, mean_latency)"
+                " SELECT proxy_id, checked_at - checked_at % 86400, COUNT(*),"
+                " COUNT(latency), AVG(latency)"
+                " FROM proxy_check WHERE checked_at < ?"
+                " GROUP BY proxy_id, checked_at - checked_at % 86400"
+                " ON CONFLICT (proxy_id, day) DO UPDATE SET"
+                " mean_latency = CASE WHEN excluded.successes = 0 THEN mean_latency"
+                "  WHEN successes = 0 THEN excluded.mean_latency"
+                "  ELSE (mean_latency * successes"
+                "   + excluded.mean_latency * excluded.successes)"
+                "   / (successes + excluded.successes) END,"
+                " checks = checks + excluded.checks,"
+                " successes = successes + excluded.successes",
+                (raw_cutoff,),
+            )
+            ProxyCheck.delete().where(ProxyCheck.checked_at < raw_cutoff).execute()
+        ProxyCheckDaily.delete().where(ProxyCheckDaily.day < keep_cutoff).execute()
+    if merged:
+        logger.debug(f"Merged {merged} checks older than {HISTORY_RAW_DAYS} days.")
+    return merged
+
 
 new_columns = {
     "note": "TEXT",
@@ -60,8 +576,181 @@ new_columns = {
     "error": "TEXT",
 }
 
-for column, column_type in new_columns.items():
-    try:
-        db.execute_sql(f"ALTER TABLE proxy ADD COLUMN {column} {column_type};")
-    except peewee.OperationalError:
-        pass
+# Back the filters and sort orders of `show` and `export`.
+new_indexes = {
+    "proxy_status_latency": "is_checked, is_working, latency",
+    "proxy_updated_at": "updated_at",
+}
+
+
+def _add_columns(database: peewee.Database, table: str, new: dict):
+    """Adds the columns of `new` that `table` does not have yet."""
+    columns = {column.name for column in database.get_columns(table)}
+    for column, column_type in new.items():
+        if column not in columns:
+            database.execute_sql(
+                f"ALTER TABLE {table} ADD COLUMN {column} {column_type};"
+            )
+
+
+def _create_indexes(database: peewee.Database, table: str, indexes: dict):
+    for index, columns in indexes.items():
+        database.execute_sql(
+            f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({columns});"
+        )
+
+
+def _migrate_1(database: peewee.Database):
+    """Creates the tables, or adds the columns and indexes of older versions."""
+    database.create_tables([Proxy], safe=True)
+    _add_columns(database, "proxy", new_columns)
+    _create_indexes(database, "proxy", new_indexes)
+
+
+def _migrate_2(database: peewee.Database):
+    """Adds the check history and the rolling statistics."""
+    _add_columns(
+        database,
+        "proxy",
+        {
+            "success_ratio": "REAL",
+            "ewma_latency": "REAL",
+            "p95_latency": "REAL",
+            "consecutive_failures": "INTEGER NOT NULL DEFAULT 0",
+        },
+    )
+    _create_indexes(
+        database,
+        "proxy",
+        {
+            "proxy_status_success_ratio": "is_checked, is_working, success_ratio",
+            "proxy_status_ewma_latency": "is_checked, is_working, ewma_latency",
+        },
+    )
+    database.create_tables([ProxyCheck, ProxyCheckDaily], safe=True)
+
+
+def _migrate_3(database: peewee.Database):
+    """Adds the recheck schedule, starting from the last check of each proxy."""
+    _add_columns(
+        database,
+        "proxy",
+        {"last_success_at": "DATETIME", "next_check_at": "DATETIME"},
+    )
+    database.execute_sql(
+        "UPDATE proxy SET"
+        " last_success_at = CASE WHEN is_working THEN updated_at END,"
+        " next_check_at = CASE"
+        "  WHEN NOT is_checked THEN created_at"
+        "  WHEN is_working THEN datetime(updated_at, ?)"
+        "  ELSE datetime(updated_at, ?) END"
+        " WHERE next_check_at IS NULL;",
+        (f"+{RECHECK_WORKING} seconds", f"+{BACKOFF_BASE_DEAD} seconds"),
+    )
+    _create_indexes(database, "proxy", {"proxy_next_check_at": "next_check_at"})
+
+
+def _migrate_4(database: peewee.Database):
+    """
+    Adds the detected protocol. Working proxies were checked through an HTTP
+    CONNECT tunnel, so they start as HTTP proxies that support it.
+    """
+    _add_columns(
+        database,
+        "proxy",
+        {"protocol": "VARCHAR(255)", "supports_connect": "INTEGER"},
+    )
+    database.execute_sql(
+        "UPDATE proxy SET protocol = 'http', supports_connect = 1"
+        " WHERE is_checked AND is_working AND protocol IS NULL;"
+    )
+    _create_indexes(
+        database,
+        "proxy",
+        {"proxy_protocol_status": "protocol, is_checked, is_working, latency"},
+    )
+
+
+def _json_text(path: str) -> str:
+    return f"json_extract(location, '{path}')"
+
+
+def _json_asn(path: str) -> str:
+    """SQL of the AS number of a "AS15169 Google LLC" value of `location`."""
+    value = _json_text(path)
+    return (
+        f"CASE WHEN {value} LIKE 'AS%'"
+        f" THEN NULLIF(CAST(substr({value}, 3) AS INTEGER), 0) END"
+    )
+
+
+def _migrate_5(database: peewee.Database):
+    """
+    Replaces the `location` JSON, the answer of the geolocation service used
+    as test URL, by the egress IP of the check and the country and AS number
+    of the proxy, taken from the keys of the services used so far. The next
+    checks fill them in from the local IP dataset (see `geo.py`).
+    """
+    _add_columns(
+        database,
+        "proxy",
+        {"egress_ip": "VARCHAR(255)", "country": "VARCHAR(2)", "asn": "INTEGER"},
+    )
+    columns = {column.name for column in database.get_columns("proxy")}
+    if "location" in columns:
+        country = _json_text("$.country")
+        database.execute_sql(
+            "UPDATE proxy SET"
+            f" egress_ip = COALESCE({_json_text('$.ip')}, {_json_text('$.query')}),"
+            " country = upper(COALESCE("
+            f"  {_json_text('$.countryCode')},"
+            f"  {_json_text('$.country_code')},"
+            f"  {_json_text('$.location.country_code')},"
+            f"  CASE WHEN length({country}) = 2 THEN {country} END)),"
+            " asn = COALESCE("
+            f"  {_json_text('$.connection.asn')},"
+            f"  {_json_text('$.network.autonomous_system.asn')},"
+            f"  {_json_asn('$.as')}, {_json_asn('$.org')}, {_json_asn('$.isp.asn')})"
+            " WHERE location IS NOT NULL AND json_valid(location);"
+        )
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            database.execute_sql("ALTER TABLE proxy DROP COLUMN location;")
+        else:  # no DROP COLUMN before SQLite 3.35
+            database.execute_sql("UPDATE proxy SET location = NULL;")
+    _create_indexes(
+        database,
+        "proxy",
+        {
+            "proxy_country_status": "country, is_checked, is_working, latency",
+            "proxy_asn_status": "asn, is_checked, is_working, latency",
+        },
+    )
+
+
+# Migration N brings the schema from version N - 1 to N. Append new ones.
+MIGRATIONS = [_migrate_1, _migrate_2, _migrate_3, _migrate_4, _migrate_5]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(database: peewee.Database) -> int:
+    return database.execute_sql("PRAGMA user_version;").fetchone()[0]
+
+
+def setup_database(database: peewee.Database):
+    """
+    Applies the migrations that `database` is missing. The version reached is
+    stored in SQLite's `user_version`, so an up to date database costs one
+    PRAGMA per connection.
+    """
+    if get_schema_version(database) >= SCHEMA_VERSION:
+        return
+    # IMMEDIATE takes the write lock first, so two processes do not migrate
+    # at the same time; the version is read again under the lock.
+    with database.atomic("IMMEDIATE"):
+        version = get_schema_version(database)
+        if version >= SCHEMA_VERSION:
+            return
+        for number, migrate in enumerate(MIGRATIONS[version:], version + 1):
+            logger.debug(f"Migrating the database to version {number}.")
+            migrate(database)
+        database.execute_sql(f"PRAGMA user_version = {SCHEMA_VERSION};")
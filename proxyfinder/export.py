@@ -0,0 +1,250 @@
+import csv
+import gzip
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import peewee
+
+from proxyfinder.database import Proxy
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ["csv", "json", "jsonl", "txt"]
+CHUNK_SIZE = 1000
+
+# Columns written by each format, in order.
+CSV_FIELDS = [
+    "proxy",
+    "is_working",
+    "latency",
+    "is_checked",
+    "created_at",
+    "updated_at",
+    "note",
+    "success_ratio",
+    "ewma_latency",
+    "p95_latency",
+    "consecutive_failures",
+    "protocol",
+    "supports_connect",
+    "egress_ip",
+    "country",
+    "asn",
+]
+JSON_FIELDS = CSV_FIELDS + ["error"]
+TXT_FIELDS = ["proxy"]
+
+
+def detect_format(output: str) -> str:
+    """Returns the export format for `output` from its suffixes (".csv.gz" -> "csv")."""
+    suffixes = [suffix.lower() for suffix in Path(output).suffixes]
+    if suffixes and suffixes[-1] == ".gz":
+        suffixes.pop()
+    if not suffixes or suffixes[-1][1:] not in EXPORT_FORMATS:
+        raise ValueError(f"Invalid output format: {''.join(suffixes) or output}")
+    return suffixes[-1][1:]
+
+
+@contextmanager
+def open_output(output: str):
+    """Opens `output` for writing text: "-" is stdout and ".gz" is gzip."""
+    if output == "-":
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+    path = Path(output)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix.lower() == ".gz":
+        f = gzip.open(path, "wt", encoding="utf-8", newline="")
+    else:
+        f = open(path, "w", encoding="utf-8", newline="")
+    try:
+        yield f
+    finally:
+        f.close()
+
+
+def iter_rows(query: peewee.ModelSelect, fields: list) -> Iterator[tuple]:
+    """
+    Streams `fields` of the rows of `query` as raw SQLite tuples, `CHUNK_SIZE`
+    rows at a time. Values are not converted by peewee: booleans are 0/1,
+    datetimes are the stored text.
+    """
+    columns = [getattr(Proxy, field) for field in fields]
+    cursor = Proxy._meta.database.execute(query.select(*columns))
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def _chunks(lines: Iterable[str]) -> Iterator[str]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk.clear()
+    if chunk:
+        yield "".join(chunk)
+
+
+def _as_bool(value) -> Optional[bool]:
+    return None if value is None else bool(value)
+
+
+def _as_dict(row: tuple) -> dict:
+    """Same output as `Proxy.to_dict` for a raw row of JSON_FIELDS."""
+    (
+        proxy,
+        is_working,
+        latency,
+        is_checked,
+        created_at,
+        updated_at,
+        note,
+        success_ratio,
+        ewma_latency,
+        p95_latency,
+        consecutive_failures,
+        protocol,
+        supports_connect,
+        egress_ip,
+        country,
+        asn,
+        error,
+    ) = row
+    return {
+        "proxy": proxy,
+        "is_working": bool(is_working),
+        "latency": latency,
+        "is_checked": bool(is_checked),
+        "created_at": created_at[:16],  # stored as "%Y-%m-%d %H:%M:%S.%f"
+        "updated_at": updated_at[:16],
+        "note": note,
+        "error": error,
+        "success_ratio": success_ratio,
+        "ewma_latency": ewma_latency,
+        "p95_latency": p95_latency,
+        "consecutive_failures": consecutive_failures,
+        "protocol": protocol,
+        "supports_connect": _as_bool(supports_connect),
+        "egress_ip": egress_ip,
+        "country": country,
+        "asn": asn,
+    }
+
+
+def _write_csv(f, rows: Iterator[tuple]) -> int:
+    writer = csv.writer(f)
+    writer.writerow(CSV_FIELDS)
+    count = 0
+    chunk = []
+    for row in rows:
+        proxy, is_working, latency, is_checked, created_at, updated_at, *rest = row
+        *rest, supports_connect, egress_ip, country, asn = rest
+        chunk.append(
+            (
+                proxy,
+                bool(is_working),
+                latency,
+                bool(is_checked),
+                created_at,
+                updated_at,
+                *rest,
+                _as_bool(supports_connect),
+                egress_ip,
+                country,
+                asn,
+            )
+        )
+        if len(chunk) >= CHUNK_SIZE:
+            writer.writerows(chunk)
+            count += len(chunk)
+            chunk.clear()
+    writer.writerows(chunk)
+    return count + len(chunk)
+
+
+def _write_json(f, rows: Iterator[tuple]) -> int:
+    count = 0
+
+    def lines():
+        nonlocal count
+        for row in rows:
+            item = json.dumps(_as_dict(row), indent=4).replace("\n", "\n    ")
+            yield f"{',' if count else ''}\n    {item}"
+            count += 1
+
+    f.write("[")
+    for chunk in _chunks(lines()):
+        f.write(chunk)
+    f.write("\n]\n" if count else "]\n")
+    return count
+
+
+def _write_jsonl(f, rows: Iterator[tuple]) -> int:
+    count = 0
+
+    def lines():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield json.dumps(_as_dict(row)) + "\n"
+
+    for chunk in _chunks(lines()):
+        f.write(chunk)
+    return count
+
+
+def _write_txt(f, rows: Iterator[tuple]) -> int:
+    count = 0
+
+    def lines():
+        nonlocal count
+        for (proxy,) in rows:
+            count += 1
+            yield proxy + "\n"
+
+    for chunk in _chunks(lines()):
+        f.write(chunk)
+    return count
+
+
+WRITERS = {
+    "csv": (CSV_FIELDS, _write_csv),
+    "json": (JSON_FIELDS, _write_json),
+    "jsonl": (JSON_FIELDS, _write_jsonl),
+    "txt": (TXT_FIELDS, _write_txt),
+}
+
+
+def export_query(
+    query: peewee.ModelSelect, output: str, export_format: Optional[str] = None
+) -> int:
+    """
+    Streams the rows of `query` to `output` in `export_format` (detected from
+    the file name if not given, "txt" for stdout). Memory use does not depend
+    on the number of rows. Returns the number of rows written.
+    """
+    if export_format is None:
+        export_format = "txt" if output == "-" else detect_format(output)
+    if export_format not in WRITERS:
+        raise ValueError(f"Invalid output format: {export_format}")
+    fields, write = WRITERS[export_format]
+
+    start_time = time.time()
+    with open_output(output) as f:
+        count = write(f, iter_rows(query, fields))
+    elapsed = time.time() - start_time
+    logger.info(
+        f"Exported {count} proxies to {'stdout' if output == '-' else output} "
+        f"in {elapsed:.2f} s ({count / elapsed if elapsed else count:.0f} rows/s)"
+    )
+    return count
@@ -0,0 +1,255 @@
+import email.utils
+import gzip
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from proxyfinder.database import Proxy, db
+from proxyfinder.utils import PROXIES_OUT_DIR
+
+logger = logging.getLogger(__name__)
+
+# IPv4 ranges with their AS number and country, updated hourly and in the
+# public domain. Download it with `proxyfinder geo --download`.
+GEO_DATASET_URL = "https://iptoasn.com/data/ip2asn-v4.tsv.gz"
+GEO_DATASET_PATH = PROXIES_OUT_DIR / "ip2asn-v4.tsv.gz"
+ENRICH_PAGE_SIZE = 5000
+# Error of a check whose test URL did not answer with an IP address.
+INVALID_EGRESS_IP_ERROR = "Invalid egress IP response"
+
+Range = Tuple[int, int, int, str]
+
+
+def parse_egress_ip(body: bytes) -> Optional[str]:
+    """
+    The IP address in the answer of a test URL: JSON with an "ip" (or "query"
+    or "origin") key, or the bare address as text. None if there is none.
+    """
+    text = body.decode("utf-8", "replace").strip()
+    if text.startswith("{"):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        text = str(data.get("ip") or data.get("query") or data.get("origin") or "")
+    try:
+        # httpbin-like answers list the addresses of every hop.
+        return str(ipaddress.ip_address(text.split(",")[0].strip()))
+    except ValueError:
+        return None
+
+
+def ip_to_int(ip: str) -> Optional[int]:
+    """Integer of a dotted IPv4 address, or None. Faster than `ipaddress`."""
+    if ip.count(".") != 3:
+        return None
+    try:
+        return int.from_bytes(socket.inet_aton(ip), "big")
+    except OSError:
+        return None
+
+
+class GeoIndex:
+    """
+    Country and autonomous system of IPv4 addresses, from a dataset of IP
+    ranges in the TSV format of iptoasn.com: one range per line with its first
+    and last address, AS number, country code and AS description.
+
+    The ranges are kept sorted in flat arrays, with the countries as indexes
+    into a short list, so a lookup is one `bisect` and half a million ranges
+    take about 10 MB. Build it once per process with `load_geo_index`.
+    """
+
+    def __init__(self, ranges: Iterable[Range]):
+        self.starts = array("L")
+        self.ends = array("L")
+        self.asns = array("L")
+        self.country_ids = array("H")
+        self.countries = [""]
+        ids = {"": 0}
+        last_start = -1
+        ordered = True
+        for start, end, asn, country in ranges:
+            ordered = ordered and start > last_start
+            last_start = start
+            self.starts.append(start)
+            self.ends.append(end)
+            self.asns.append(asn)
+            if country not in ids:
+                ids[country] = len(self.countries)
+                self.countries.append(country)
+            self.country_ids.append(ids[country])
+        if not ordered:
+            self._sort()
+
+    def _sort(self):
+        order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+        for name in ("starts", "ends", "asns", "country_ids"):
+            values = getattr(self, name)
+            setattr(self, name, array(values.typecode, (values[i] for i in order)))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, ip: str) -> Tuple[Optional[str], Optional[int]]:
+        """`(country code, AS number)` of `ip`, None where it is unknown."""
+        value = ip_to_int(ip)
+        if value is None:
+            return None, None
+        position = bisect_right(self.starts, value) - 1
+        if position < 0 or value > self.ends[position]:
+            return None, None
+        country = self.countries[self.country_ids[position]]
+        return country or None, self.asns[position] or None
+
+    @staticmethod
+    def read_ranges(lines: Iterable[str]) -> Iterator[Range]:
+        """Parses the lines of the dataset. Unrouted ranges and IPv6 are skipped."""
+        for line in lines:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 4 or fields[2] == "0":
+                continue
+            start, end = ip_to_int(fields[0]), ip_to_int(fields[1])
+            if start is None or end is None:
+                continue
+            country = fields[3] if len(fields[3]) == 2 else ""
+            yield start, end, int(fields[2]), country.upper()
+
+    @classmethod
+    def from_file(cls, path: Path) -> "GeoIndex":
+        """Builds the index of a dataset file, gzipped if it ends in ".gz"."""
+        path = Path(path)
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            return cls(cls.read_ranges(f))
+
+
+_indexes: Dict[Path, Tuple[float, GeoIndex]] = {}
+_indexes_lock = threading.Lock()
+_missing_logged = False
+
+
+def load_geo_index(path: Optional[Path] = None) -> Optional[GeoIndex]:
+    """
+    The `GeoIndex` of the dataset at `path` (GEO_DATASET_PATH by default),
+    built on the first call and kept for the lifetime of the process, until
+    the file changes. None if there is no dataset.
+    """
+    global _missing_logged
+    path = Path(path or GEO_DATASET_PATH)
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        if not _missing_logged:
+            logger.info(
+                f"No IP dataset at {path}: country and ASN are not filled in. "
+                "Run `proxyfinder geo --download` to get it."
+            )
+            _missing_logged = True
+        return None
+    with _indexes_lock:
+        cached = _indexes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        start_time = time.perf_counter()
+        index = GeoIndex.from_file(path)
+        _indexes[path] = (mtime, index)
+    logger.debug(
+        f"Loaded {len(index)} IP ranges from {path} "
+        f"in {time.perf_counter() - start_time:.2f} s."
+    )
+    return index
+
+
+def download_dataset(
+    url: str = GEO_DATASET_URL, path: Optional[Path] = None, timeout: float = 30
+) -> bool:
+    """
+    Downloads the dataset to `path` (GEO_DATASET_PATH by default) unless the
+    server says it did not change since the copy there was saved. Returns True
+    if a new copy was saved.
+    """
+    import requests
+
+    path = Path(path or GEO_DATASET_PATH)
+    headers = {}
+    if path.exists():
+        headers["If-Modified-Since"] = email.utils.formatdate(
+            path.stat().st_mtime, usegmt=True
+        )
+    tmp_path = path.with_name(path.name + ".tmp")
+    with requests.get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304:
+            logger.info(f"The IP dataset at {path} is up to date.")
+            return False
+        response.raise_for_status()
+        size = 0
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(64 * 1024):
+                f.write(chunk)
+                size += len(chunk)
+    os.replace(tmp_path, path)
+    logger.info(f"Downloaded the IP dataset to {path} ({size / 1e6:.1f} MB).")
+    return True
+
+
+def enrich_proxies(
+    since: Optional[datetime] = None,
+    index: Optional[GeoIndex] = None,
+    page_size: int = ENRICH_PAGE_SIZE,
+) -> int:
+    """
+    Fills `country` and `asn` of the proxies updated since `since` (all of
+    them if None) from `index` (see `load_geo_index`), by their egress IP or,
+    for the ones without one, the address of the proxy. Reads `page_size` rows
+    at a time with keyset pagination and writes the changed ones in one
+    transaction per page. Returns how many rows changed.
+    """
+    index = index or load_geo_index()
+    if index is None:
+        return 0
+    start_time = time.perf_counter()
+    query = Proxy.select(
+        Proxy.id, Proxy.proxy, Proxy.egress_ip, Proxy.country, Proxy.asn
+    )
+    if since is not None:
+        query = query.where(Proxy.updated_at >= since)
+    changed = 0
+    last_id = 0
+    while True:
+        # Raw rows: converting them with peewee costs more than the lookups.
+        page = db.execute(
+            query.where(Proxy.id > last_id).order_by(Proxy.id).limit(page_size)
+        ).fetchall()
+        if not page:
+            break
+        rows = []
+        for proxy_id, address, egress_ip, country, asn in page:
+            found = index.lookup(egress_ip or address.rsplit(":", 1)[0])
+            if found != (country, asn):
+                rows.append(found + (proxy_id,))
+        if rows:
+            with db.atomic():
+                db.cursor().executemany(
+                    "UPDATE proxy SET country = ?, asn = ? WHERE id = ?", rows
+                )
+        changed += len(rows)
+        last_id = page[-1][0]
+        if len(page) < page_size:
+            break
+    logger.info(
+        f"Updated the country and ASN of {changed} proxies "
+        f"in {time.perf_counter() - start_time:.2f} s."
+    )
+    return changed
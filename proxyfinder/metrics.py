@@ -0,0 +1,489 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from proxyfinder.concurrency import OUTCOME_LOCAL, OUTCOME_OK, classify_error
+
+logger = logging.getLogger(__name__)
+
+# Phases of a proxy check, in seconds:
+# - connect: TCP connect to the proxy.
+# - tunnel: CONNECT request until the proxy answers (https test URLs), or
+#   SOCKS handshake.
+# - tls: TLS handshake with the test URL through the tunnel.
+# - ttfb: from the request sent until the head of the response is read.
+# - total: the whole check, from the first connect to the parsed body.
+PROBE_PHASES = ["connect", "tunnel", "tls", "ttfb", "total"]
+SECONDS_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Name: (type, help). Counters and histograms only, so that the values of
+# several processes can be added up (see `Metrics.merge`); the gauges are
+# derived from them when rendered.
+METRICS_HELP = {
+    "proxyfinder_probes_started_total": ("counter", "Proxy checks started."),
+    "proxyfinder_probes_total": (
+        "counter",
+        "Proxy checks finished, by outcome (ok, timeout, error, local).",
+    ),
+    "proxyfinder_probes_cancelled_total": (
+        "counter",
+        "Proxy checks cancelled in flight when the deadline of the run passed.",
+    ),
+    "proxyfinder_probe_errors_total": (
+        "counter",
+        "Failed proxy checks, by error class.",
+    ),
+    "proxyfinder_probe_phase_seconds": (
+        "histogram",
+        "Duration of each phase of the successful proxy checks.",
+    ),
+    "proxyfinder_protocol_fallbacks_total": (
+        "counter",
+        "Proxies probed again with another protocol in the same check.",
+    ),
+    "proxyfinder_protocols_detected_total": (
+        "counter",
+        "Proxies whose protocol was detected or changed, by protocol.",
+    ),
+    "proxyfinder_prefilter_rejected_total": (
+        "counter",
+        "Proxies rejected by the TCP connect prefilter.",
+    ),
+    "proxyfinder_db_rows_written_total": (
+        "counter",
+        "Checked proxies saved in the database.",
+    ),
+    "proxyfinder_db_rows_dropped_total": (
+        "counter",
+        "Checked proxies not saved because their batch failed to be written.",
+    ),
+    "proxyfinder_db_write_lag_seconds": (
+        "histogram",
+        "Time from a check result being queued to being committed.",
+    ),
+    "proxyfinder_source_fetches_total": (
+        "counter",
+        "Source pages fetched, by result (miss, hit, error).",
+    ),
+    "proxyfinder_source_fetch_seconds": (
+        "histogram",
+        "Time to download and parse a source page.",
+    ),
+    "proxyfinder_source_bytes_total": ("counter", "Bytes downloaded from the sources."),
+    "proxyfinder_source_proxies_total": (
+        "counter",
+        "Proxies extracted from the sources, before deduplication.",
+    ),
+}
+
+# Error class: markers of the error messages of both checking engines. The
+# first class with a marker in the message wins.
+ERROR_CLASSES = [
+    ("tls", ["SSLError", "SSL:", "_ssl.c", "handshake"]),
+    ("connect_timeout", ["connect timeout", "ConnectTimeout"]),
+    ("read_timeout", ["Read timed out", "read timeout"]),
+    ("refused", ["Connection refused", "[Errno 111]", "[WinError 10061]"]),
+    (
+        "reset",
+        [
+            "Connection reset",
+            "[Errno 104]",
+            "Connection aborted",
+            "RemoteDisconnected",
+            "Remote end closed",
+        ],
+    ),
+    ("tunnel", ["Tunnel connection failed", "Unable to connect to proxy"]),
+    ("socks", ["SOCKS4", "SOCKS5", "not a SOCKS"]),
+    ("http_status", ["for url"]),
+    ("invalid_response", ["Invalid", "Expecting value", "BadStatusLine", "JSON"]),
+]
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_probe = threading.local()
+
+
+def error_class(message: str) -> str:
+    """Classifies the error of a failed check, more finely than `classify_error`."""
+    if classify_error(message) == OUTCOME_LOCAL:
+        return "local"
+    for name, markers in ERROR_CLASSES:
+        if any(marker in message for marker in markers):
+            return name
+    return "other"
+
+
+@contextmanager
+def probe_phases() -> Iterator[Dict[str, float]]:
+    """
+    Collects in a dict the phases recorded with `record_phase` by the code
+    that runs in this thread, e.g. the connections of `ProxyPoolAdapter`.
+    """
+    phases: Dict[str, float] = {}
+    _probe.phases = phases
+    try:
+        yield phases
+    finally:
+        _probe.phases = None
+
+
+def record_phase(phase: str, seconds: float):
+    phases = getattr(_probe, "phases", None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+def _labels_text(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _quantile(counts: List[float], fraction: float) -> Optional[float]:
+    """Estimates a quantile from the bucket counts of a histogram, in seconds."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = total * fraction
+    seen = 0.0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if index == len(SECONDS_BUCKETS):
+                return SECONDS_BUCKETS[-1]
+            lower = SECONDS_BUCKETS[index - 1] if index else 0.0
+            upper = SECONDS_BUCKETS[index]
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return SECONDS_BUCKETS[-1]
+
+
+class Metrics:
+    """
+    Counters and histograms of the checks and scrapes of this process, in the
+    Prometheus data model. Thread-safe.
+
+    A histogram is stored as the count of each bucket of SECONDS_BUCKETS (the
+    last one is +Inf) followed by the sum of the observed values.
+    `snapshot`, `difference` and `merge` work on plain dicts, so the values
+    of a run, or of another process, can be computed and added up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Key, float] = {}
+        self._histograms: Dict[Key, List[float]] = {}
+        self.started_at = time.monotonic()
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect_left(SECONDS_BUCKETS, seconds)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0.0] * (len(SECONDS_BUCKETS) + 2)
+            values[index] += 1
+            values[-1] += seconds
+
+    def probe_started(self):
+        self.inc("proxyfinder_probes_started_total")
+
+    def probe_finished(
+        self, error: Optional[str], phases: Dict[str, float], total: float
+    ):
+        """Records the outcome of a check and, if it worked, its phases."""
+        if error is None:
+            self.inc("proxyfinder_probes_total", outcome=OUTCOME_OK)
+            for phase, seconds in phases.items():
+                self.observe("proxyfinder_probe_phase_seconds", seconds, phase=phase)
+            self.observe("proxyfinder_probe_phase_seconds", total, phase="total")
+        else:
+            self.inc("proxyfinder_probes_total", outcome=classify_error(error))
+            self.inc("proxyfinder_probe_errors_total", error_class=error_class(error))
+
+    def probe_cancelled(self):
+        self.inc("proxyfinder_probes_cancelled_total")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {
+                    key: list(values) for key, values in self._histograms.items()
+                },
+            }
+
+    @staticmethod
+    def difference(after: dict, before: dict) -> dict:
+        """The values recorded between two snapshots."""
+        return {
+            "counters": {
+                key: value - before["counters"].get(key, 0)
+                for key, value in after["counters"].items()
+                if value != before["counters"].get(key, 0)
+            },
+            "histograms": {
+                key: [
+                    value - previous
+                    for value, previous in zip(
+                        values,
+                        before["histograms"].get(key, [0.0] * len(values)),
+                    )
+                ]
+                for key, values in after["histograms"].items()
+                if values != before["histograms"].get(key)
+            },
+        }
+
+    def merge(self, values: dict):
+        """Adds the values of a snapshot or difference, e.g. of a worker process."""
+        with self._lock:
+            for key, value in values["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, histogram in values["histograms"].items():
+                current = self._histograms.setdefault(
+                    key, [0.0] * (len(SECONDS_BUCKETS) + 2)
+                )
+                for index, value in enumerate(histogram):
+                    current[index] += value
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        values = self.snapshot()
+        counters = values["counters"]
+        uptime = time.monotonic() - self.started_at
+        finished = sum(
+            value
+            for (name, _), value in counters.items()
+            if name == "proxyfinder_probes_total"
+        )
+        started = counters.get(("proxyfinder_probes_started_total", ()), 0)
+        started -= counters.get(("proxyfinder_probes_cancelled_total", ()), 0)
+        lines = [
+            "# HELP proxyfinder_uptime_seconds Seconds since the metrics were created.",
+            "# TYPE proxyfinder_uptime_seconds gauge",
+            f"proxyfinder_uptime_seconds {uptime:.3f}",
+            "# HELP proxyfinder_probes_in_flight Proxy checks not finished yet.",
+            "# TYPE proxyfinder_probes_in_flight gauge",
+            f"proxyfinder_probes_in_flight {max(started - finished, 0):g}",
+            "# HELP proxyfinder_probes_per_second Average proxy checks per second.",
+            "# TYPE proxyfinder_probes_per_second gauge",
+            f"proxyfinder_probes_per_second {finished / uptime if uptime else 0:.3f}",
+        ]
+        for name, (kind, text) in METRICS_HELP.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(f"{name}{_labels_text(labels)} {value:g}")
+                continue
+            for (key_name, labels), histogram in sorted(values["histograms"].items()):
+                if key_name != name:
+                    continue
+                cumulative = 0.0
+                for bound, count in zip(SECONDS_BUCKETS + ["+Inf"], histogram):
+                    cumulative += count
+                    bucket_labels = labels + (("le", str(bound)),)
+                    lines.append(
+                        f"{name}_bucket{_labels_text(bucket_labels)} {cumulative:g}"
+                    )
+                lines.append(f"{name}_sum{_labels_text(labels)} {histogram[-1]:.6f}")
+                lines.append(f"{name}_count{_labels_text(labels)} {cumulative:g}")
+        return "\n".join(lines) + "\n"
+
+    def check_summary(self, since: dict, elapsed: float) -> str:
+        """One line with the checks recorded after the snapshot `since`."""
+        values = self.difference(self.snapshot(), since)
+        counters = values["counters"]
+        outcomes = {
+            dict(labels)["outcome"]: value
+            for (name, labels), value in counters.items()
+            if name == "proxyfinder_probes_total"
+        }
+        errors = sorted(
+            (
+                (value, dict(labels)["error_class"])
+                for (name, labels), value in counters.items()
+                if name == "proxyfinder_probe_errors_total"
+            ),
+            reverse=True,
+        )
+        finished = sum(outcomes.values())
+        parts = [
+            f"{finished:g} probes ({finished / elapsed if elapsed else 0:.1f}/s)",
+            ", ".join(f"{name}: {value:g}" for name, value in sorted(outcomes.items()))
+            or "no results",
+        ]
+        rejected = counters.get(("proxyfinder_prefilter_rejected_total", ()))
+        if rejected:
+            parts.append(f"prefilter rejected: {rejected:g}")
+        cancelled = counters.get(("proxyfinder_probes_cancelled_total", ()))
+        if cancelled:
+            parts.append(f"cancelled: {cancelled:g}")
+        if errors:
+            parts.append(
+                "errors: " + ", ".join(f"{name} {value:g}" for value, name in errors)
+            )
+        phases = []
+        for phase in PROBE_PHASES:
+            histogram = values["histograms"].get(
+                ("proxyfinder_probe_phase_seconds", (("phase", phase),))
+            )
+            if histogram:
+                p50 = _quantile(histogram[:-1], 0.5) or 0
+                p95 = _quantile(histogram[:-1], 0.95) or 0
+                phases.append(f"{phase} {p50 * 1000:.0f}/{p95 * 1000:.0f}")
+        if phases:
+            parts.append("p50/p95 ms: " + ", ".join(phases))
+        lag = values["histograms"].get(("proxyfinder_db_write_lag_seconds", ()))
+        if lag:
+            parts.append(f"DB write lag p95: {_quantile(lag[:-1], 0.95):.2f} s")
+        dropped = counters.get(("proxyfinder_db_rows_dropped_total", ()))
+        if dropped:
+            parts.append(f"DB rows dropped: {dropped:g}")
+        return "; ".join(parts)
+
+    def find_summary(self, since: dict) -> str:
+        """One line with the source fetches recorded after the snapshot `since`."""
+        values = self.difference(self.snapshot(), since)
+        counters = values["counters"]
+        results = {
+            dict(labels)["result"]: value
+            for (name, labels), value in counters.items()
+            if name == "proxyfinder_source_fetches_total"
+        }
+        size = counters.get(("proxyfinder_source_bytes_total", ()), 0)
+        found = counters.get(("proxyfinder_source_proxies_total", ()), 0)
+        by_result = ", ".join(
+            f"{result}: {value:g}" for result, value in sorted(results.items())
+        )
+        parts = [
+            f"{sum(results.values()):g} sources ({by_result or 'none'})",
+            f"{size / 1024 / 1024:.1f} MB",
+            f"{found:g} proxies",
+        ]
+        fetch = [
+            histogram
+            for (name, _), histogram in values["histograms"].items()
+            if name == "proxyfinder_source_fetch_seconds"
+        ]
+        if fetch:
+            counts = [sum(column) for column in zip(*fetch)][:-1]
+            parts.append(f"fetch p95: {_quantile(counts, 0.95):.2f} s")
+        return ", ".join(parts)
+
+
+# The metrics of this process, recorded by the checkers, the prefilter, the
+# `ResultWriter` and the source fetches.
+METRICS = Metrics()
+
+
+class MetricsExporter:
+    """
+    Exposes `metrics` while a command runs: rewritten every `interval`
+    seconds to the file `path` (atomically, for the textfile collector of the
+    Prometheus node exporter) and/or served at `http://127.0.0.1:port/metrics`.
+    The file is written a last time when the exporter stops.
+    """
+
+    def __init__(
+        self,
+        metrics: Metrics = METRICS,
+        path: Optional[str] = None,
+        port: Optional[int] = None,
+        interval: float = 5,
+        host: str = "127.0.0.1",
+    ):
+        self.metrics = metrics
+        self.path = Path(path) if path else None
+        self.port = port
+        self.interval = interval
+        self.host = host
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def write(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        temporary.write_text(self.metrics.render(), encoding="utf-8")
+        os.replace(temporary, self.path)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logger.error(f"Error writing the metrics to {self.path}: {e}")
+
+    def start(self):
+        if self.path is not None:
+            thread = threading.Thread(
+                target=self._write_loop, name="metrics-writer", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        if self.port is not None:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?", 1)[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header(
+                        "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                    )
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    logger.debug(f"Metrics request: {format % args}")
+
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self._server.daemon_threads = True
+            thread = threading.Thread(
+                target=self._server.serve_forever, name="metrics-server", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+            logger.info(f"Metrics served at http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        try:
+            self.write()
+        except OSError as e:
+            logger.error(f"Error writing the metrics to {self.path}: {e}")
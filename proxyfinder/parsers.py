@@ -0,0 +1,257 @@
+import codecs
+import re
+from array import array
+from collections import deque
+from html.entities import html5
+from html.parser import HTMLParser
+from typing import List, Optional
+
+from proxyfinder.utils import (
+    REGEX_PROXY_PARTS,
+    new_proxy_keys,
+    pack_proxy,
+    pack_proxy_parts,
+)
+
+PARSER_TYPES = ["table", "plain"]
+
+# An "ip:port" at the start of a line, after optional blanks.
+REGEX_PLAIN_LINE = re.compile(r"^[^\S\n]*" + REGEX_PROXY_PARTS.pattern, re.MULTILINE)
+
+# Tags handled the same way as the "html.parser" builder of BeautifulSoup: void
+# elements are closed as soon as they are opened, and text inside the string
+# containers is not part of the text of their ancestors.
+EMPTY_ELEMENT_TAGS = {
+    "area",
+    "base",
+    "basefont",
+    "bgsound",
+    "br",
+    "col",
+    "command",
+    "embed",
+    "frame",
+    "hr",
+    "image",
+    "img",
+    "input",
+    "isindex",
+    "keygen",
+    "link",
+    "menuitem",
+    "meta",
+    "nextid",
+    "param",
+    "source",
+    "spacer",
+    "track",
+    "wbr",
+}
+STRING_CONTAINER_TAGS = {"rt", "rp", "style", "script", "template"}
+
+
+def _decoder(encoding: Optional[str]):
+    return codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+
+
+class PlainProxyParser:
+    """
+    Extracts proxies from a plain list with one "ip:port" per line.
+
+    Bytes are passed to `feed` as they are downloaded; only the last incomplete
+    line is kept between calls. `close` returns the packed keys in the order
+    they appear.
+    """
+
+    def __init__(self, encoding: Optional[str] = None):
+        self.keys = new_proxy_keys()
+        self._decoder = _decoder(encoding)
+        self._pending = ""
+
+    def _parse(self, text: str):
+        self.keys.extend(
+            key
+            for match in REGEX_PLAIN_LINE.finditer(text)
+            if (key := pack_proxy_parts(match.groups())) is not None
+        )
+
+    def feed(self, data: bytes):
+        text = self._pending + self._decoder.decode(data)
+        end = text.rfind("\n") + 1
+        self._parse(text[:end])
+        self._pending = text[end:]
+
+    def close(self) -> "array[int]":
+        self._parse(self._pending + self._decoder.decode(b"", final=True))
+        self._pending = ""
+        return self.keys
+
+
+class _Row:
+    __slots__ = ("cells", "done")
+
+    def __init__(self):
+        self.cells: List[List[str]] = []
+        self.done = False
+
+
+class TableProxyParser(HTMLParser):
+    """
+    Extracts proxies from the first `<table>` of an HTML page: the text of the
+    first two `<td>` of every `<tr>` but the first one, joined with ":".
+
+    The page is tokenized once, as it is downloaded, without building a tree.
+    Tags are opened and closed as BeautifulSoup does with "html.parser", so the
+    result is the same as searching the parsed page, and everything after the
+    end of the table is skipped.
+    """
+
+    def __init__(self, encoding: Optional[str] = None):
+        super().__init__(convert_charrefs=False)
+        self.keys = new_proxy_keys()
+        self._decoder = _decoder(encoding)
+        self._stack = []  # (tag, kind, payload) of the open elements
+        self._open_counts = {}
+        self._closed_empty = []
+        self._containers = 0
+        self._in_table = False
+        self._finished = False
+        self._row_count = 0
+        self._rows = deque()  # rows not yet emitted, in document order
+        self._open_rows = []
+        self._open_cells = []
+
+    def feed(self, data: bytes):  # type: ignore
+        # Nothing after the end of the table is used: stop tokenizing.
+        if not self._finished:
+            super().feed(self._decoder.decode(data))
+
+    def close(self) -> "array[int]":  # type: ignore
+        if not self._finished:
+            super().feed(self._decoder.decode(b"", final=True))
+            super().close()
+        for row in self._rows:
+            row.done = True
+        self._emit_rows()
+        self._finished = True
+        return self.keys
+
+    def _emit_rows(self):
+        rows = self._rows
+        while rows and rows[0].done:
+            cells = rows.popleft().cells
+            if len(cells) >= 2:
+                proxy = f"{''.join(cells[0]).strip()}:{''.join(cells[1]).strip()}"
+                if (key := pack_proxy(proxy)) is not None:
+                    self.keys.append(key)
+
+    def _open(self, tag: str):
+        kind = payload = None
+        if self._in_table:
+            if tag == "tr":
+                self._row_count += 1
+                if self._row_count > 1:  # the first row is the header
+                    kind = payload = _Row()
+                    self._rows.append(payload)
+                    self._open_rows.append(payload)
+            elif tag == "td":
+                kind = "td"
+                payload = []
+                for row in self._open_rows:
+                    if len(row.cells) < 2:
+                        cell = []
+                        row.cells.append(cell)
+                        payload.append(cell)
+                self._open_cells.extend(payload)
+        elif tag == "table" and not self._finished:
+            self._in_table = True
+            kind = "table"
+        self._stack.append((tag, kind, payload))
+        self._open_counts[tag] = self._open_counts.get(tag, 0) + 1
+        if tag in STRING_CONTAINER_TAGS:
+            self._containers += 1
+
+    def _close(self, tag: str):
+        if not self._open_counts.get(tag):
+            return
+        while self._stack:
+            name, kind, payload = self._stack.pop()
+            self._open_counts[name] -= 1
+            if name in STRING_CONTAINER_TAGS:
+                self._containers -= 1
+            if kind == "td":
+                if payload:
+                    del self._open_cells[-len(payload) :]
+            elif kind == "table":
+                self._in_table = False
+                self._finished = True
+            elif kind is not None:
+                payload.done = True
+                self._open_rows.pop()
+                self._emit_rows()
+            if name == tag:
+                break
+
+    def handle_starttag(self, tag, attrs):
+        self._open(tag)
+        if tag in EMPTY_ELEMENT_TAGS:
+            self._close(tag)
+            self._closed_empty.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._open(tag)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._closed_empty:
+            self._closed_empty.remove(tag)
+        else:
+            self._close(tag)
+
+    def handle_data(self, data):
+        if self._open_cells and not self._containers:
+            for cell in self._open_cells:
+                cell.append(data)
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA[") and self._open_cells:
+            for cell in self._open_cells:
+                cell.append(data[len("CDATA[") :])
+
+    def handle_charref(self, name):
+        number = int(name[1:], 16) if name[:1] in ("x", "X") else int(name)
+        data = None
+        if number < 256:
+            # Like BeautifulSoup: low references are read as windows-1252.
+            try:
+                data = bytes([number]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(number)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_entityref(self, name):
+        self.handle_data(html5.get(f"{name};", f"&{name}"))
+
+
+PARSERS = {"table": TableProxyParser, "plain": PlainProxyParser}
+
+
+def new_parser(parser_type: str, encoding: Optional[str] = None):
+    """Returns an incremental parser with `feed(bytes)` and `close() -> keys`."""
+    if parser_type not in PARSERS:
+        raise ValueError(f"Invalid parser type: {parser_type}")
+    return PARSERS[parser_type](encoding)
+
+
+def parse_proxies(
+    content: bytes, parser_type: str, encoding: Optional[str] = None
+) -> "array[int]":
+    """Parses a whole downloaded page at once. See `new_parser`."""
+    parser = new_parser(parser_type, encoding)
+    parser.feed(content)
+    return parser.close()
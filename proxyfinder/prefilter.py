@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import queue
+import threading
+from datetime import datetime
+from typing import Iterable, Iterator, Tuple
+
+from proxyfinder.concurrency import OUTCOME_LOCAL, classify_error
+from proxyfinder.database import Proxy
+from proxyfinder.metrics import METRICS
+from proxyfinder.utils import STOP_FLAG
+
+logger = logging.getLogger(__name__)
+
+PREFILTER_ERROR_PREFIX = "'prefilter:"
+
+
+class TcpPrefilter:
+    """
+    First stage of a check: a raw TCP connect to `ip:port` with a short
+    timeout. Proxies that do not accept the connection are marked as broken
+    (the reason is stored in `Proxy.error` prefixed with "prefilter:") and never
+    reach the HTTP check.
+    """
+
+    def __init__(self, timeout: float = 3, concurrency: int = 1000, buffer: int = 1000):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.buffer = buffer
+
+    async def probe(self, proxy: Proxy) -> bool:
+        """
+        Returns True if the proxy accepted the connection. Otherwise the proxy
+        is marked as checked and not working, and False is returned.
+        """
+        ip, port = proxy.proxy.rsplit(":", 1)  # type: ignore
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, int(port)), self.timeout
+            )
+        except asyncio.TimeoutError:
+            error = f"Connection to {ip} timed out. (connect timeout={self.timeout})"
+        except OSError as e:
+            error = str(e)
+            if classify_error(error) == OUTCOME_LOCAL:
+                # The failure is ours, not the proxy's: let the full check decide.
+                logger.debug(f"Prefilter skipped for {proxy.proxy}: {error}")
+                return True
+        else:
+            writer.close()
+            return True
+
+        proxy.is_checked = True  # type: ignore
+        proxy.is_working = False  # type: ignore
+        proxy.updated_at = datetime.now()
+        proxy.error = f"{PREFILTER_ERROR_PREFIX} {error}'"  # type: ignore
+        METRICS.inc("proxyfinder_prefilter_rejected_total")
+        logger.debug(f"Proxy {proxy.proxy} rejected by the prefilter.")
+        return False
+
+    async def probe_item(self, proxy: Proxy) -> Tuple[Proxy, bool]:
+        """
+        Same as `probe`, returning the proxy with the result so it can be
+        identified when the probe is awaited with others (`asyncio.wait`).
+        """
+        return proxy, await self.probe(proxy)
+
+    async def _produce(
+        self,
+        proxies: Iterable[Proxy],
+        results: "queue.Queue",
+        closed: threading.Event,
+    ):
+        iterator = iter(proxies)
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                while (
+                    not exhausted
+                    and len(pending) < self.concurrency
+                    and not STOP_FLAG.is_set()
+                    and not closed.is_set()
+                ):
+                    proxy = next(iterator, None)
+                    if proxy is None:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(self.probe_item(proxy)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    # Waits without blocking the loop while the consumer is behind.
+                    while not closed.is_set():
+                        try:
+                            results.put_nowait(task.result())
+                            break
+                        except queue.Full:
+                            await asyncio.sleep(0.05)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def filter(self, proxies: Iterable[Proxy]) -> Iterator[Tuple[Proxy, bool]]:
+        """
+        Runs the prefilter over `proxies` on an event loop in a background
+        thread. Yields `(proxy, accepted)` pairs in completion order.
+        """
+        results = queue.Queue(maxsize=self.buffer)
+        closed = threading.Event()
+        done = object()
+
+        def run():
+            try:
+                asyncio.run(self._produce(proxies, results, closed))
+            except Exception as e:
+                logger.error(f"Error in the TCP prefilter: {e}")
+            finally:
+                results.put(done)
+
+        thread = threading.Thread(target=run, name="tcp-prefilter", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            closed.set()
+            while thread.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,198 @@
+import ipaddress
+import socket
+import struct
+from functools import lru_cache
+from typing import Generator, List, Optional, Tuple
+
+from proxyfinder.metrics import METRICS
+
+PROTOCOL_HTTP = "http"
+PROTOCOL_SOCKS4 = "socks4"
+PROTOCOL_SOCKS5 = "socks5"
+# Order in which a proxy of unknown protocol is probed. Most public proxies
+# are HTTP, and an HTTP proxy waits for the end of a head that a SOCKS
+# greeting never sends, while SOCKS servers hang up at once on a request
+# that does not start with their version byte. SOCKS5 goes before SOCKS4
+# because most SOCKS4 servers also speak SOCKS5.
+#
+# Each protocol is probed on a new connection. The first message of all three
+# is read from the start of the stream, so once a proxy has read the request
+# of another protocol as its own, even if it keeps the socket open, the bytes
+# that follow are not read as the start of a new message.
+PROTOCOLS = [PROTOCOL_HTTP, PROTOCOL_SOCKS5, PROTOCOL_SOCKS4]
+
+# Markers of the errors that mean the proxy does not speak the protocol it was
+# probed with: it hung up or answered something else. Errors of both checking
+# engines and of `socks_handshake`.
+MISMATCH_MARKERS = [
+    "Remote end closed connection without response",
+    "BadStatusLine",
+    "Invalid HTTP response",
+    "not a SOCKS",
+]
+# The proxy answered in its protocol but did not open the tunnel to the test URL.
+TUNNEL_REFUSED_MARKERS = [
+    "Tunnel connection failed",
+    "SOCKS4 connect failed",
+    "SOCKS5 connect failed",
+]
+
+SOCKS5_ERRORS = {
+    1: "general failure",
+    2: "not allowed by ruleset",
+    3: "network unreachable",
+    4: "host unreachable",
+    5: "connection refused",
+    6: "TTL expired",
+    7: "command not supported",
+    8: "address type not supported",
+}
+
+Handshake = Generator[Tuple[bytes, int], bytes, None]
+
+
+class SocksError(OSError):
+    """Error of a SOCKS handshake."""
+
+
+def probe_order(known: Optional[str]) -> List[str]:
+    """
+    The protocols to probe a proxy with, in order: only the one stored from a
+    previous check if there is one, otherwise all of PROTOCOLS.
+    """
+    return [known] if known in PROTOCOLS else list(PROTOCOLS)
+
+
+def is_mismatch(error: str) -> bool:
+    return any(marker in error for marker in MISMATCH_MARKERS)
+
+
+def detect(
+    protocol: str, error: Optional[str], tunnel: bool
+) -> Tuple[Optional[str], Optional[bool]]:
+    """
+    What a probe with `protocol` says about the proxy, from its `error` (None
+    if it worked): the protocol the proxy speaks and whether it opened a
+    tunnel to the test URL, None where the probe does not tell. `tunnel` is
+    whether the probe went through one (https test URL or SOCKS).
+    """
+    if error is None or "for url" in error:
+        return protocol, True if tunnel else None
+    if any(marker in error for marker in TUNNEL_REFUSED_MARKERS):
+        return protocol, False
+    if "authentication required" in error:
+        return protocol, None
+    return None, None
+
+
+def record_detection(proxy, protocol: str, error: Optional[str], tunnel: bool):
+    """
+    Stores on `proxy` what the last probe of its check, with `protocol`,
+    found (see `detect`). A stored protocol that no longer answers is
+    forgotten, so the next check detects it again.
+    """
+    detected, supports_connect = detect(protocol, error, tunnel)
+    if detected is None:
+        if error is not None and is_mismatch(error) and proxy.protocol == protocol:
+            proxy.protocol = None
+            proxy.supports_connect = None
+        return
+    if detected != proxy.protocol:
+        METRICS.inc("proxyfinder_protocols_detected_total", protocol=detected)
+    proxy.protocol = detected
+    if supports_connect is not None:
+        proxy.supports_connect = supports_connect
+
+
+def proxy_url(protocol: str, address: str) -> str:
+    """URL of the proxy at "ip:port" for `requests`, e.g. "socks5://1.2.3.4:1080"."""
+    return f"{protocol}://{address}"
+
+
+@lru_cache(maxsize=256)
+def resolve_ipv4(host: str) -> str:
+    """IPv4 address of `host`, which SOCKS4 needs. Cached: test URLs are few."""
+    return socket.gethostbyname(host)
+
+
+def _expect(data: bytes, size: int, error: str):
+    if len(data) < size:
+        raise SocksError(f"{error}: connection closed")
+
+
+def socks_handshake(
+    protocol: str, host: str, port: int, ip: Optional[str] = None
+) -> Handshake:
+    """
+    Opens a tunnel to `host:port` through a SOCKS4 or SOCKS5 proxy, without
+    doing any I/O: yields `(data to send, bytes to read)` and is sent back
+    what was read, which is shorter when the proxy hung up. SOCKS4 connects to
+    `ip`, the IPv4 address of `host`; SOCKS5 lets the proxy resolve `host`.
+    Raises `SocksError`.
+    """
+    if protocol == PROTOCOL_SOCKS5:
+        reply = yield b"\x05\x01\x00", 2  # version 5, one method: no auth
+        _expect(reply, 2, "not a SOCKS5 proxy")
+        if reply[0] != 5:
+            raise SocksError("not a SOCKS5 proxy")
+        if reply[1] != 0:
+            raise SocksError("SOCKS5 authentication required")
+
+        try:
+            address = ipaddress.ip_address(host)
+            kind = b"\x01" if address.version == 4 else b"\x04"
+            destination = kind + address.packed
+        except ValueError:
+            name = host.encode("idna")
+            destination = b"\x03" + bytes([len(name)]) + name
+        request = b"\x05\x01\x00" + destination + struct.pack(">H", port)
+        # Version, reply code, reserved, address type and the first byte of
+        # the bound address, which gives the length of a domain name.
+        reply = yield request, 5
+        _expect(reply, 5, "SOCKS5 connect failed")
+        if reply[0] != 5:
+            raise SocksError("not a SOCKS5 proxy")
+        if reply[1] != 0:
+            reason = SOCKS5_ERRORS.get(reply[1], f"error {reply[1]}")
+            raise SocksError(f"SOCKS5 connect failed: {reason}")
+        # The rest of the bound address and its port are not needed, but must
+        # not be read as data.
+        remaining = {1: 3 + 2, 3: reply[4] + 2, 4: 15 + 2}.get(reply[3])
+        if remaining is None:
+            raise SocksError("SOCKS5 connect failed: invalid reply")
+        bound = yield b"", remaining
+        _expect(bound, remaining, "SOCKS5 connect failed")
+    elif protocol == PROTOCOL_SOCKS4:
+        request = (
+            b"\x04\x01"
+            + struct.pack(">H", port)
+            + socket.inet_aton(ip or host)
+            + b"\x00"  # empty user id
+        )
+        reply = yield request, 8
+        _expect(reply, 8, "not a SOCKS4 proxy")
+        # The version of the reply is 0, or 4 for some servers.
+        if reply[0] not in (0, 4) or not 0x5A <= reply[1] <= 0x5D:
+            raise SocksError("not a SOCKS4 proxy")
+        if reply[1] != 0x5A:
+            raise SocksError(f"SOCKS4 connect failed: code {reply[1]:#x}")
+    else:
+        raise ValueError(f"Not a SOCKS protocol: {protocol}")
+
+
+def run_handshake(sock: socket.socket, handshake: Handshake):
+    """Runs a `socks_handshake` on a connected blocking socket."""
+    try:
+        data, size = next(handshake)
+        while True:
+            if data:
+                sock.sendall(data)
+            reply = b""
+            while len(reply) < size:
+                chunk = sock.recv(size - len(reply))
+                if not chunk:
+                    break
+                reply += chunk
+            data, size = handshake.send(reply)
+    except StopIteration:
+        pass
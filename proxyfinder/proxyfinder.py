@@ -1,54 +1,76 @@
+import asyncio
 import importlib.resources
 import json
 import logging
 import random
 import time
-from concurrent.futures import ThreadPoolExecutor
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from typing import List, Union
+from typing import Iterable, Iterator, List, Optional, Union
 
+import peewee
 import requests
-from bs4 import BeautifulSoup, Tag
 
-from proxyfinder.database import Proxy
-from proxyfinder.utils import STOP_FLAG
+from proxyfinder.adapters import ProxyPoolAdapter, abort_connections
+from proxyfinder.aiochecker import AsyncChecker
+from proxyfinder.concurrency import OUTCOME_OK, ConcurrencyController, classify_error
+from proxyfinder.database import (
+    Proxy,
+    ResultWriter,
+    compact_history,
+    iterate_in_pages,
+)
+from proxyfinder.geo import (
+    INVALID_EGRESS_IP_ERROR,
+    enrich_proxies,
+    parse_egress_ip,
+)
+from proxyfinder.metrics import METRICS, probe_phases
+from proxyfinder.parsers import PARSERS, new_parser
+from proxyfinder.prefilter import TcpPrefilter
+from proxyfinder.protocols import (
+    PROTOCOL_HTTP,
+    is_mismatch,
+    probe_order,
+    proxy_url,
+    record_detection,
+)
+from proxyfinder.sourcecache import SourceCache
+from proxyfinder.utils import (
+    DEADLINE_FLAG,
+    PROXIES_OUT_DIR,
+    STOP_FLAG,
+    ResourceMonitor,
+    dedupe_proxy_keys,
+    new_proxy_keys,
+    raise_open_files_limit,
+)
 import re
 
-REGEX_GET_PROXY = re.compile(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}:\d{1,5})")
 REGEX_GET_HTTP_ERROR = re.compile(r"Caused by .*, ('.*')")
+REGEX_GET_SOCKS_ERROR = re.compile(r"((?:not a )?SOCKS[45] [^\"']*)")
 logger = logging.getLogger(__name__)
 
 
 class ProxyFinderUtils:
-    TIMEOUT = 12
+    # Seconds to connect to a proxy (including the CONNECT tunnel and the TLS
+    # handshake) and to wait for each read of its answer. A dead proxy only
+    # costs the connect timeout.
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 10
+    # Same for the requests that go straight to the sources and test URLs.
+    FETCH_CONNECT_TIMEOUT = 10
+    FETCH_READ_TIMEOUT = 30
+    # Endpoints that answer with the IP address the request came from, and
+    # little else: the country and ASN of the proxies are looked up locally
+    # (see `proxyfinder.geo`). The answer is parsed by `parse_egress_ip`.
     TEST_URLS = [
-        {
-            "url": "https://demo.ip-api.com/json/",
-            "params": {
-                "fields": "66842623",
-                "lang": "en",
-            },
-            "headers": {
-                "Origin": "https://ip-api.com",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36",
-            },
-        },
-        {
-            "url": "https://ipwhois.io/widget",
-            "params": {
-                "ip": "",
-                "lang": "en",
-            },
-            "headers": {
-                "referer": "https://ipwhois.io/",
-                "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36",
-            },
-        },
-        {
-            "url": "https://api.ipquery.io/?format=json",
-        },
-        {"url": "https://ipinfo.io/json"},
-        {"url": "https://ip.guide/frontend/api"},
+        {"url": "https://api.ipify.org/", "params": {"format": "json"}},
+        {"url": "https://api.ipquery.io/"},
+        {"url": "https://ipinfo.io/ip"},
+        {"url": "https://checkip.amazonaws.com/"},
+        {"url": "https://icanhazip.com/"},
     ]
     USER_AGENTS = [
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
@@ -56,35 +78,62 @@ class ProxyFinderUtils:
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0",
     ]
 
-    def __init__(self, concurrency=10):
-        self.session = requests.Session()
-        self.concurrency = concurrency
+    DEFAULT_MAX_CONCURRENCY = 500
+    TEST_URLS_TTL = 15 * 60
+    FETCH_CHUNK_SIZE = 64 * 1024
+    DEADLINE_POLL_INTERVAL = 0.5
+
+    def __init__(
+        self,
+        concurrency: Union[int, str] = 10,
+        max_concurrency=None,
+        use_source_cache: bool = True,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        fetch_connect_timeout: Optional[float] = None,
+        fetch_read_timeout: Optional[float] = None,
+    ):
+        """
+        `concurrency` is the number of checks in flight, or "auto" to let a
+        `ConcurrencyController` adapt it up to `max_concurrency`.
+        `use_source_cache` enables the `SourceCache` of fetched sources.
+        The timeouts default to the constants of the class.
+        """
+        self.timeout = (
+            connect_timeout or self.CONNECT_TIMEOUT,
+            read_timeout or self.READ_TIMEOUT,
+        )
+        self.fetch_timeout = (
+            fetch_connect_timeout or self.FETCH_CONNECT_TIMEOUT,
+            fetch_read_timeout or self.FETCH_READ_TIMEOUT,
+        )
+        self.source_cache = (
+            SourceCache(PROXIES_OUT_DIR / "sources_cache") if use_source_cache else None
+        )
+        if concurrency == "auto":
+            maximum = max_concurrency or self.DEFAULT_MAX_CONCURRENCY
+            self.controller = ConcurrencyController(
+                limit=min(10, maximum), maximum=maximum, adaptive=True
+            )
+        else:
+            self.controller = ConcurrencyController(
+                limit=int(concurrency),
+                maximum=min(int(concurrency), max_concurrency or int(concurrency)),
+            )
+        self.concurrency = self.controller.maximum
         self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        # One pool per test URL host with room for every thread, and at most
+        # a few proxy managers per thread (see `ProxyPoolAdapter`).
+        self.adapter = ProxyPoolAdapter(
+            max_proxies=self.concurrency * 2,
+            pool_maxsize=self.concurrency,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self._test_urls_checked_at = float("-inf")
         logger.debug(f"ProxyFinder initialized. {self.__dict__}")
 
-    def _parse_proxies(self, content: str, parser_type: str) -> List[str]:
-        """Parses proxies depending on the source type."""
-        proxies = []
-        if parser_type == "table":
-            soup = BeautifulSoup(content, "html.parser")
-            table = soup.find("table")
-            if isinstance(table, Tag):
-                rows = table.find_all("tr")[1:]
-                for row in rows:
-                    if (
-                        isinstance(row, Tag)
-                        and (cols := row.find_all("td"))
-                        and len(cols) >= 2
-                    ):
-                        proxies.append(f"{cols[0].text.strip()}:{cols[1].text.strip()}")
-        elif parser_type == "plain":
-            proxies = [
-                line.strip()
-                for line in content.split("\n")
-                if ":" in line and "." in line.split(":")[0]
-            ]
-        return proxies
-
     def get_user_agent(self) -> str:
         return random.choice(self.USER_AGENTS)
 
@@ -94,50 +143,92 @@ class ProxyFinderUtils:
     def __exit__(self, exc_type, exc_val, exc_tb):
         logger.debug("Closing the thread pool...")
         self.executor.shutdown(wait=True)
+        self.session.close()
         logger.debug("Thread pool closed.")
 
     def _check_proxy(self, proxy: Proxy) -> Union[Proxy, None]:
         """
-        Verifies if a proxy is functional.
+        Verifies if a proxy is functional, and detects the protocol it speaks
+        (see `probe_order`): a proxy that hangs up or answers something else
+        than the protocol it was probed with is probed again with the next
+        one, on a new connection (see `PROTOCOLS`). The connection that
+        answered carries the whole check.
         """
         if STOP_FLAG.is_set():
             return None
 
         logger.debug(f"Checking proxy: {proxy.proxy}")
-        proxies = {"http": f"http://{proxy.proxy}", "https": f"http://{proxy.proxy}"}
-        headers = {"User-Agent": self.get_user_agent()}
         config = random.choice(self.TEST_URLS)
         test_url = config["url"]
         params = config.get("params")
         headers = config.get("headers")
 
-        try:
-            start_time = time.time()
-            proxy.is_checked = True  # type: ignore
-            proxy.updated_at = datetime.now()
-            response = self.session.get(
-                test_url,
-                proxies=proxies,
-                headers=headers,
-                timeout=self.TIMEOUT,
-                params=params,
-            )
-            response.raise_for_status()
-            proxy.latency = round((time.time() - start_time) * 1000, 2)  # type: ignore
-            proxy.is_working = True  # type: ignore
-            proxy.location = response.json()
-            logger.info(
-                f"Proxy {proxy.proxy} is working ({proxy.latency} ms) status: {response.status_code}"
-            )
-
-            return proxy
-        except requests.RequestException as e:
-            proxy.is_working = False  # type: ignore
-            match = REGEX_GET_HTTP_ERROR.search(str(e))
-            if match:
-                proxy.error = match.group(1)  # type: ignore
-            logger.debug(f"Proxy {proxy.proxy} connection failed.")
-            return proxy
+        METRICS.probe_started()
+        proxy.is_checked = True  # type: ignore
+        proxy.updated_at = datetime.now()
+        with probe_phases() as phases:
+            check_start = time.perf_counter()
+            protocols = probe_order(proxy.protocol)  # type: ignore
+            for attempt, protocol in enumerate(protocols):
+                url = proxy_url(protocol, proxy.proxy)  # type: ignore
+                tunnel = protocol != PROTOCOL_HTTP or test_url.startswith("https")
+                if attempt:
+                    METRICS.inc("proxyfinder_protocol_fallbacks_total")
+                    phases.clear()  # only the phases of the last attempt count
+                try:
+                    start_time = time.perf_counter()
+                    with self.session.get(
+                        test_url,
+                        proxies={"http": url, "https": url},
+                        headers=headers,
+                        timeout=self.timeout,
+                        params=params,
+                    ) as response:
+                        response.raise_for_status()
+                        elapsed = time.perf_counter() - start_time
+                        proxy.latency = round(elapsed * 1000, 2)  # type: ignore
+                        egress_ip = parse_egress_ip(response.content)
+                        if egress_ip is None:
+                            raise requests.RequestException(INVALID_EGRESS_IP_ERROR)
+                        proxy.is_working = True  # type: ignore
+                        proxy.egress_ip = egress_ip  # type: ignore
+                        proxy.error = None  # type: ignore
+                    record_detection(proxy, protocol, None, tunnel)
+                    logger.info(
+                        f"Proxy {proxy.proxy} is working ({proxy.latency} ms, {protocol}) status: {response.status_code}"
+                    )
+                    self.controller.record(OUTCOME_OK)
+                    elapsed = time.perf_counter() - check_start
+                    METRICS.probe_finished(None, phases, elapsed)
+                    return proxy
+                except requests.RequestException as e:
+                    if DEADLINE_FLAG.is_set():
+                        # Interrupted by `abort_connections`: not a result.
+                        METRICS.probe_cancelled()
+                        return None
+                    error = str(e)
+                    if (
+                        is_mismatch(error)
+                        and attempt + 1 < len(protocols)
+                        and not STOP_FLAG.is_set()
+                    ):
+                        continue
+                    record_detection(proxy, protocol, error, tunnel)
+                    proxy.is_working = False  # type: ignore
+                    self.controller.record(classify_error(error))
+                    elapsed = time.perf_counter() - check_start
+                    METRICS.probe_finished(error, phases, elapsed)
+                    match = REGEX_GET_HTTP_ERROR.search(error)
+                    if match:
+                        proxy.error = match.group(1)  # type: ignore
+                    elif match := REGEX_GET_SOCKS_ERROR.search(error):
+                        proxy.error = f"'{match.group(1)}'"  # type: ignore
+                    elif error == INVALID_EGRESS_IP_ERROR:
+                        proxy.error = f"'{error}'"  # type: ignore
+                    logger.debug(f"Proxy {proxy.proxy} connection failed.")
+                    return proxy
+                finally:
+                    self.adapter.release(url)
 
     def _check_url(self, config):
         url = config["url"]
@@ -145,7 +236,7 @@ class ProxyFinderUtils:
         headers = config.get("headers")
         try:
             response = self.session.get(
-                url, params=params, headers=headers, timeout=self.TIMEOUT
+                url, params=params, headers=headers, timeout=self.fetch_timeout
             )
             response.raise_for_status()
             logger.debug(f"URL {config['url']} is working.")
@@ -155,25 +246,31 @@ class ProxyFinderUtils:
             return
 
     def _check_urls(self) -> None:
+        """
+        Keeps in `self.TEST_URLS` the test URLs of the class that are up. They
+        are checked again at most every `TEST_URLS_TTL` seconds, so a
+        long-running instance picks up URLs that come back.
+        """
+        if time.monotonic() - self._test_urls_checked_at < self.TEST_URLS_TTL:
+            return
         logger.debug("Checking Test URLs...")
-        futures = {
-            self.executor.submit(self._check_url, config): config
-            for config in self.TEST_URLS.copy()
-        }
-        self.TEST_URLS.clear()
-        for future in futures:
-            config = future.result()
-            if config:
-                self.TEST_URLS.append(config)
+        futures = [
+            self.executor.submit(self._check_url, config)
+            for config in type(self).TEST_URLS
+        ]
+        self.TEST_URLS = [config for future in futures if (config := future.result())]
+        self._test_urls_checked_at = time.monotonic()
 
 
 class ProxyFinder(ProxyFinderUtils):
     def fetch_proxies_from_source(
         self, url: str, parser_type: str = "table"
-    ) -> List[str]:
+    ) -> "array[int]":
         """
-        Obtains proxies from a specific source.
+        Obtains proxies from a specific source, as packed keys (see `pack_proxy`).
         """
+        if STOP_FLAG.is_set():
+            return new_proxy_keys()
         logger.debug(f"Fetching proxies from: {url} (type: {parser_type})")
         headers = headers = {
             "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
@@ -192,33 +289,94 @@ class ProxyFinder(ProxyFinderUtils):
             "user-agent": self.get_user_agent(),
         }
 
+        if parser_type not in PARSERS:
+            logging.error(f"Invalid parser type for {url}: {parser_type}")
+            return new_proxy_keys()
+
+        cache = self.source_cache
+        entry = cache.load(url, parser_type) if cache else None
+        headers.update(SourceCache.conditional_headers(entry))
+
+        start_time = time.perf_counter()
+        size = 0
+        hasher = SourceCache.new_hasher()
+        result = "error"
         try:
-            response = requests.get(url, headers=headers, timeout=self.TIMEOUT)
-            response.raise_for_status()
+            with requests.get(
+                url, headers=headers, timeout=self.fetch_timeout, stream=True
+            ) as response:
+                if response.status_code == 304 and entry:
+                    keys = cache.load_keys(url)  # type: ignore
+                    result = "hit (not modified)"
+                else:
+                    response.raise_for_status()
+                    # The page is hashed as it is downloaded. Without a cached
+                    # hash to compare with it is parsed at the same time;
+                    # otherwise it is kept and only parsed if it changed.
+                    parser = None
+                    if not entry:
+                        parser = new_parser(parser_type, response.encoding)
+                    chunks = []
+                    for chunk in response.iter_content(self.FETCH_CHUNK_SIZE):
+                        if DEADLINE_FLAG.is_set():
+                            logger.info(f"Deadline reached while fetching {url}.")
+                            return new_proxy_keys()
+                        size += len(chunk)
+                        hasher.update(chunk)
+                        if parser is None:
+                            chunks.append(chunk)
+                        else:
+                            parser.feed(chunk)
+                    content_hash = hasher.hexdigest()
+                    if entry and entry["sha256"] == content_hash:
+                        keys = cache.load_keys(url)  # type: ignore
+                        result = "hit (same content)"
+                        cache.save(url, parser_type, response.headers, content_hash)  # type: ignore
+                    else:
+                        if parser is None:
+                            parser = new_parser(parser_type, response.encoding)
+                            for chunk in chunks:
+                                parser.feed(chunk)
+                        chunks.clear()
+                        keys = parser.close()
+                        result = "miss"
+                        if cache:
+                            cache.save(
+                                url, parser_type, response.headers, content_hash, keys
+                            )
         except requests.RequestException as e:
             logging.error(f"Error fetching proxies from {url}: {e}")
-            return []
+            return new_proxy_keys()
+        finally:
+            elapsed = time.perf_counter() - start_time
+            kind = result.split(" ", 1)[0]
+            METRICS.inc("proxyfinder_source_fetches_total", result=kind)
+            METRICS.observe("proxyfinder_source_fetch_seconds", elapsed, result=kind)
+            METRICS.inc("proxyfinder_source_bytes_total", size)
 
-        proxies = self._parse_proxies(response.text, parser_type)
-        proxies_cleaned = [
-            match.group()
-            for proxy in proxies
-            if (match := REGEX_GET_PROXY.match(proxy))
-        ]
-        logger.info(f"Extracted {len(proxies_cleaned)} proxies from {url}")
-        return proxies_cleaned
+        METRICS.inc("proxyfinder_source_proxies_total", len(keys))
+        logger.info(
+            f"Extracted {len(keys)} proxies from {url} "
+            f"({result}, {size} bytes in {elapsed:.2f} s)"
+        )
+        return keys
 
-    def get_proxies_from_multiple_sources(self) -> List[str]:
+    def get_proxies_from_multiple_sources(self) -> "array[int]":
         """
         Obtains proxies from multiple public sources.
+
+        Returns an array of unique packed keys; use `unpack_proxy` to get the
+        "ip:port" strings back.
         """
         logger.info("Fetching proxies from multiple sources.")
+        start_time = time.monotonic()
+        before = METRICS.snapshot()
         try:
             with importlib.resources.open_text("proxyfinder", "sources.json") as f:
                 sources = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError) as e:
             logging.error(f"Error loading sources.json: {e}")
-            return []
+            return new_proxy_keys()
 
         all_proxies = []
         futures = {
@@ -229,56 +387,169 @@ class ProxyFinder(ProxyFinderUtils):
         }
         for future in futures:
             try:
-                proxies = future.result()
-                all_proxies.extend(proxies)
+                all_proxies.append(future.result())
             except Exception as e:
                 logging.error(f"Error in source {futures[future]}: {e}")
 
-        unique_proxies = list(set(all_proxies))
+        unique_proxies = dedupe_proxy_keys(all_proxies)
         logger.info(f"Total unique proxies obtained: {len(unique_proxies)}")
+        logger.info(
+            f"Find finished in {time.monotonic() - start_time:.1f} s: "
+            f"{METRICS.find_summary(before)}."
+        )
         return unique_proxies
 
-    def check_proxies(self, proxies: List[Proxy]):
+    def _iter_checked(
+        self, proxies: Iterable[Proxy], prefilter: Optional[TcpPrefilter] = None
+    ) -> Iterator[Optional[Proxy]]:
         """
-        Verifies a list of proxies in parallel.
+        Checks the proxies in the thread pool keeping at most
+        `controller.limit` checks in flight. Yields results in completion order.
+        When DEADLINE_FLAG is set, the checks in flight are aborted and the
+        iteration ends.
+
+        With a `prefilter`, proxies go through it first and the ones it rejects
+        are yielded without being submitted.
         """
-        logger.info(f"Checking {len(proxies)} proxies.")
+        if prefilter:
+            candidates = prefilter.filter(proxies)
+        else:
+            candidates = ((proxy, True) for proxy in proxies)
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                while (
+                    not exhausted
+                    and len(pending) < self.controller.limit
+                    and not STOP_FLAG.is_set()
+                ):
+                    item = next(candidates, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    proxy, accepted = item
+                    if not accepted:
+                        yield proxy
+                        continue
+                    pending.add(self.executor.submit(self._check_proxy, proxy))
+                if not pending:
+                    break
+                done, pending = wait(
+                    pending,
+                    timeout=self.DEADLINE_POLL_INTERVAL,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    yield future.result()
+                if pending and DEADLINE_FLAG.is_set():
+                    logger.info(
+                        f"Deadline reached: cancelling {len(pending)} checks in flight."
+                    )
+                    abort_connections()
+                    # Checks that finished meanwhile are still results.
+                    for future in pending:
+                        if future.done() and not future.cancelled():
+                            yield future.result()
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            if prefilter:
+                candidates.close()
 
+    def _iter_checked_async(
+        self, proxies: Iterable[Proxy], prefilter: Optional[TcpPrefilter] = None
+    ) -> Iterator[Optional[Proxy]]:
+        """
+        Same as `_iter_checked` but runs the checks with `AsyncChecker` on a
+        private event loop, which is driven one result at a time.
+        """
+        checker = AsyncChecker(
+            self.TEST_URLS,
+            self.USER_AGENTS,
+            connect_timeout=self.timeout[0],
+            read_timeout=self.timeout[1],
+            controller=self.controller,
+        )
+        loop = asyncio.new_event_loop()
+        results = checker.check_proxies(proxies, prefilter=prefilter)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.close()
+
+    def check_results(
+        self,
+        proxies: Iterable[Proxy],
+        engine: str = "thread",
+        prefilter: Optional[TcpPrefilter] = None,
+    ) -> Iterator[Optional[Proxy]]:
+        """
+        Checks `proxies` with `engine` and yields them in completion order,
+        without saving them (None for checks cancelled by `STOP_FLAG`).
+        """
         self._check_urls()
 
-        to_save = []
+        if prefilter or engine == "async":
+            raise_open_files_limit()
+        if engine == "async":
+            return self._iter_checked_async(proxies, prefilter=prefilter)
+        return self._iter_checked(proxies, prefilter=prefilter)
 
-        futures = {
-            self.executor.submit(self._check_proxy, proxy): proxy for proxy in proxies
-        }
+    def check_proxies(
+        self,
+        proxies: Union[peewee.Query, List[Proxy], Iterable[Proxy]],
+        engine: str = "thread",
+        prefilter: Optional[TcpPrefilter] = None,
+        total: Optional[int] = None,
+    ):
+        """
+        Verifies proxies in parallel.
 
-        for index, future in enumerate(futures, 1):
-            proxy = future.result()
-            if proxy is None:
-                continue
-            # logger.info(f"Processed proxy {index}/{len(futures)}")
-            if proxy:
-                to_save.append(proxy)
-
-            if index % 10 == 0 and to_save:
-                Proxy.bulk_update(
-                    to_save,
-                    [
-                        "is_checked",
-                        "is_working",
-                        "latency",
-                        "updated_at",
-                        "location",
-                        "error",
-                    ],
-                )
-                logger.debug(f"Updated {len(to_save)} proxies in the database.")
-                to_save.clear()
-            if index % random.randint(5, 10) == 0:
-                logger.info(f"Processed {index}/{len(futures)} proxies.")
-
-        if to_save:
-            Proxy.bulk_update(
-                to_save, ["is_checked", "is_working", "latency", "updated_at"]
-            )
-            logger.debug(f"Updated {len(to_save)} remaining proxies in the database.")
+        A query is read lazily in pages and only `controller.limit` checks are in
+        flight at any time, so memory does not grow with the size of the table.
+        Results are saved in the order they complete.
+
+        `engine` selects how the checks are run: "thread" uses the thread pool
+        and `requests`, "async" uses `AsyncChecker` on an asyncio event loop.
+        `prefilter` adds a cheap TCP-connect stage in front of either engine.
+        Other iterables than a query or a list must come with their `total`.
+        """
+        if isinstance(proxies, peewee.Query):
+            total = proxies.count()
+            proxies = iterate_in_pages(proxies)
+        elif total is None:
+            total = len(proxies)  # type: ignore
+        logger.info(f"Checking {total} proxies.")
+
+        start_time = time.monotonic()
+        checked_since = datetime.now()
+        before = METRICS.snapshot()
+        results = self.check_results(proxies, engine=engine, prefilter=prefilter)
+        monitor = ResourceMonitor()
+        with ResultWriter() as writer:
+            for index, proxy in enumerate(results, 1):
+                if proxy is not None:
+                    writer.put(proxy)
+                monitor.sample()
+                if index % random.randint(5, 10) == 0:
+                    logger.info(
+                        f"Processed {index}/{total} proxies. (concurrency: {self.controller.limit})"
+                    )
+        logger.debug(f"Saved {writer.written} checked proxies in the database.")
+        logger.info(
+            f"Check finished: {monitor.summary()}, "
+            f"proxy pools evicted: {self.adapter.evictions}."
+        )
+        logger.info(
+            f"Check metrics: "
+            f"{METRICS.check_summary(before, time.monotonic() - start_time)}."
+        )
+        compact_history()
+        enrich_proxies(since=checked_since)
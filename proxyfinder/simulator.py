@@ -0,0 +1,345 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import random
+import socket
+import struct
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from proxyfinder.utils import raise_open_files_limit
+
+logger = logging.getLogger(__name__)
+
+# How the proxies of a farm behave:
+# - ok: forwards the request to the judge after a delay from the latency
+#   distribution (lognormal around `latency_ms`).
+# - slow: same, around SLOW_LATENCY_MS.
+# - error: answers 502 Bad Gateway.
+# - refused: nothing listens on its port.
+# - reset: accepts the connection and resets it.
+# - blackhole: accepts the connection and never answers.
+# - slowloris: sends its status line one byte per second, then hangs up. It
+#   never exceeds a read timeout between two bytes.
+# - socks4, socks5: SOCKS proxies (no auth) that tunnel to the judge like ok.
+#   They hang up on a request that does not start with their version byte.
+FARM_BEHAVIORS = [
+    "ok",
+    "slow",
+    "error",
+    "refused",
+    "reset",
+    "blackhole",
+    "slowloris",
+    "socks4",
+    "socks5",
+]
+DEFAULT_FARM_MIX = {
+    "ok": 0.2,
+    "socks4": 0.02,
+    "socks5": 0.03,
+    "slow": 0.05,
+    "error": 0.1,
+    "refused": 0.3,
+    "reset": 0.1,
+    "blackhole": 0.15,
+    "slowloris": 0.05,
+}
+DEFAULT_LATENCY_MS = 150
+LATENCY_SIGMA = 0.6
+SLOW_LATENCY_MS = 4000
+MAX_HEAD_SIZE = 64 * 1024
+
+
+async def _read_head(reader: asyncio.StreamReader) -> Optional[bytes]:
+    try:
+        return await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+        return None
+
+
+async def _handle_judge(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answers like an IP-info API, with the address the request came from."""
+    if await _read_head(reader) is not None:
+        ip = writer.get_extra_info("peername")[0]
+        body = json.dumps(
+            {
+                "status": "success",
+                "query": ip,
+                "ip": ip,
+                "country": "Simulated",
+                "countryCode": "ZZ",
+                "city": "Localhost",
+                "isp": "proxyfinder farm",
+                "as": "AS64512 proxyfinder farm",
+            }
+        ).encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body
+        )
+    await _close(writer)
+
+
+async def _close(writer: asyncio.StreamWriter):
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while data := await reader.read(64 * 1024):
+            writer.write(data)
+            await writer.drain()
+    except OSError:
+        pass
+    finally:
+        await _close(writer)
+
+
+async def _handle_proxy(
+    behavior: str,
+    delay: float,
+    judge_port: int,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+):
+    try:
+        await _behave(behavior, delay, judge_port, reader, writer)
+    except asyncio.CancelledError:  # the farm is stopping
+        writer.transport.abort()
+
+
+async def _socks(
+    version: int, judge_port: int, reader: asyncio.StreamReader, writer
+) -> Optional[tuple]:
+    """
+    Server side of a SOCKS handshake. Returns the connection to the judge,
+    whatever the requested address, or None if the client is not speaking
+    SOCKS `version`.
+    """
+    first = await reader.read(1)
+    if first != bytes([version]):
+        return None
+    if version == 5:
+        methods = await reader.readexactly((await reader.readexactly(1))[0])
+        if 0 not in methods:
+            writer.write(b"\x05\xff")
+            return None
+        writer.write(b"\x05\x00")
+        kind = (await reader.readexactly(4))[3]
+        size = {1: 4, 4: 16}.get(kind) or (await reader.readexactly(1))[0]
+        await reader.readexactly(size + 2)
+    else:
+        await reader.readexactly(7)
+        await reader.readuntil(b"\x00")  # user id
+    judge = await asyncio.open_connection("127.0.0.1", judge_port)
+    if version == 5:
+        writer.write(b"\x05\x00\x00\x01\x7f\x00\x00\x01" + struct.pack(">H", 0))
+    else:
+        writer.write(b"\x00\x5a" + b"\x00" * 6)
+    return judge
+
+
+async def _behave(
+    behavior: str,
+    delay: float,
+    judge_port: int,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+):
+    if behavior == "reset":
+        # SO_LINGER with a zero timeout makes close() send a RST.
+        sock = writer.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        writer.transport.abort()
+        return
+
+    if behavior in ("socks4", "socks5"):
+        await asyncio.sleep(delay)
+        try:
+            judge = await _socks(int(behavior[-1]), judge_port, reader, writer)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            judge = None
+        if judge is None:
+            await _close(writer)
+            return
+        judge_reader, judge_writer = judge
+        await asyncio.gather(_pipe(reader, judge_writer), _pipe(judge_reader, writer))
+        return
+
+    head = await _read_head(reader)
+    if head is None:
+        await _close(writer)
+        return
+
+    if behavior == "blackhole":
+        while await reader.read(1024):
+            pass
+    elif behavior == "slowloris":
+        try:
+            for byte in b"HTTP/1.1 200 OK\r\n":
+                writer.write(bytes([byte]))
+                await writer.drain()
+                await asyncio.sleep(1)
+        except OSError:
+            pass
+    elif behavior == "error":
+        writer.write(
+            b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+        )
+    else:
+        await asyncio.sleep(delay)
+        try:
+            judge_reader, judge_writer = await asyncio.open_connection(
+                "127.0.0.1", judge_port
+            )
+        except OSError:
+            await _close(writer)
+            return
+        if head.startswith(b"CONNECT "):
+            writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        else:
+            judge_writer.write(head)
+        await asyncio.gather(
+            _pipe(reader, judge_writer), _pipe(judge_reader, writer)
+        )
+        return
+    await _close(writer)
+
+
+def _refusing_socket() -> socket.socket:
+    """A socket bound to a local port but not listening: connections are refused."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def farm_plan(
+    count: int,
+    mix: Optional[Dict[str, float]] = None,
+    latency_ms: float = DEFAULT_LATENCY_MS,
+    seed: int = 0,
+) -> List[Tuple[str, float]]:
+    """The `(behavior, delay in seconds)` of every proxy of a farm."""
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_FARM_MIX
+    behaviors = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    plan = []
+    for behavior in behaviors:
+        median = SLOW_LATENCY_MS if behavior == "slow" else latency_ms
+        delay = rng.lognormvariate(0, LATENCY_SIGMA) * median / 1000
+        plan.append((behavior, delay))
+    return plan
+
+
+async def _serve_farm(plan: List[Tuple[str, float]], connection):
+    judge = await asyncio.start_server(_handle_judge, "127.0.0.1", 0)
+    judge_port = judge.sockets[0].getsockname()[1]
+    servers = []
+    refusing = []
+    ports = []
+    for behavior, delay in plan:
+        if behavior == "refused":
+            refusing.append(_refusing_socket())
+            ports.append(refusing[-1].getsockname()[1])
+            continue
+        server = await asyncio.start_server(
+            partial(_handle_proxy, behavior, delay, judge_port),
+            "127.0.0.1",
+            0,
+            limit=MAX_HEAD_SIZE,
+            backlog=1024,
+        )
+        servers.append(server)
+        ports.append(server.sockets[0].getsockname()[1])
+    connection.send((judge_port, ports))
+    # Runs until the parent asks to stop or goes away.
+    while not connection.poll(0.2):
+        await asyncio.sleep(0.2)
+    for server in servers + [judge]:
+        server.close()
+    for sock in refusing:
+        sock.close()
+
+
+def _run_farm(plan: List[Tuple[str, float]], connection):
+    raise_open_files_limit()
+    try:
+        asyncio.run(_serve_farm(plan, connection))
+    except (EOFError, OSError) as e:
+        logger.debug(f"Proxy farm stopped: {e}")
+
+
+class ProxyFarm:
+    """
+    Local fake proxies and a judge endpoint, served by asyncio in a separate
+    process so they do not take CPU from the checker being measured.
+
+    Every proxy listens on its own port of 127.0.0.1 and behaves as planned by
+    `farm_plan` (see FARM_BEHAVIORS). The same `seed` gives the same farm. The
+    judge answers any request with IP-info JSON, like the test URLs of
+    `ProxyFinderUtils.TEST_URLS`.
+    """
+
+    def __init__(
+        self,
+        count: int,
+        mix: Optional[Dict[str, float]] = None,
+        latency_ms: float = DEFAULT_LATENCY_MS,
+        seed: int = 0,
+    ):
+        self.plan = farm_plan(count, mix, latency_ms, seed)
+        self.judge_port = 0
+        self.ports: List[int] = []
+        self._connection = None
+        self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self._connection, child = context.Pipe()
+        self._process = context.Process(
+            target=_run_farm, args=(self.plan, child), name="proxy-farm", daemon=True
+        )
+        self._process.start()
+        self.judge_port, self.ports = self._connection.recv()
+        logger.debug(f"Proxy farm of {len(self.ports)} proxies started.")
+
+    def stop(self):
+        if self._process is None:
+            return
+        try:
+            self._connection.send(None)  # type: ignore
+        except OSError:
+            pass
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+
+    @property
+    def judge_url(self) -> str:
+        return f"http://127.0.0.1:{self.judge_port}/json"
+
+    @property
+    def proxies(self) -> List[str]:
+        return [f"127.0.0.1:{port}" for port in self.ports]
+
+    def expected_working(self, timeout: float) -> int:
+        """Proxies that forward to the judge in less than `timeout` seconds."""
+        return sum(
+            1
+            for behavior, delay in self.plan
+            if behavior in ("ok", "slow", "socks4", "socks5") and delay < timeout
+        )
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+from array import array
+from pathlib import Path
+from typing import Optional
+
+from proxyfinder.utils import new_proxy_keys
+
+logger = logging.getLogger(__name__)
+
+# Bump when parsing changes, so cached results of the old parser are not reused.
+PARSER_VERSION = 2
+
+
+class SourceCache:
+    """
+    Per-source cache of the last fetch of each URL in `sources.json`.
+
+    For every source it keeps the validators sent by the server (ETag and
+    Last-Modified), a SHA-256 of the body and the packed proxy keys that were
+    parsed from it. A 304 response reuses the cached keys without downloading
+    the page again, and a body with the same hash does not rewrite them.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, url: str):
+        name = hashlib.sha1(url.encode()).hexdigest()[:20]
+        return self.directory / f"{name}.json", self.directory / f"{name}.keys"
+
+    def load(self, url: str, parser_type: str) -> Optional[dict]:
+        """Returns the cached metadata of `url`, or None if it cannot be reused."""
+        meta_path, keys_path = self._paths(url)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            entry.get("url") != url
+            or entry.get("parser_type") != parser_type
+            or entry.get("parser_version") != PARSER_VERSION
+            or not keys_path.exists()
+        ):
+            return None
+        return entry
+
+    def load_keys(self, url: str) -> "array[int]":
+        _, keys_path = self._paths(url)
+        keys = new_proxy_keys()
+        with open(keys_path, "rb") as f:
+            keys.frombytes(f.read())
+        return keys
+
+    @staticmethod
+    def conditional_headers(entry: Optional[dict]) -> dict:
+        """Request headers that let the server answer 304 Not Modified."""
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    @staticmethod
+    def new_hasher():
+        """Hash of the body, updated chunk by chunk while it is downloaded."""
+        return hashlib.sha256()
+
+    def save(
+        self,
+        url: str,
+        parser_type: str,
+        response_headers,
+        content_hash: str,
+        keys: Optional["array[int]"] = None,
+    ):
+        """
+        Stores the validators and hash of a fetch. `keys` may be omitted when
+        the body did not change, to keep the keys already stored.
+        """
+        meta_path, keys_path = self._paths(url)
+        entry = {
+            "url": url,
+            "parser_type": parser_type,
+            "parser_version": PARSER_VERSION,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "sha256": content_hash,
+        }
+        try:
+            if keys is not None:
+                tmp_path = keys_path.with_suffix(".keys.tmp")
+                with open(tmp_path, "wb") as f:
+                    f.write(keys.tobytes())
+                os.replace(tmp_path, keys_path)
+            tmp_path = meta_path.with_suffix(".json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, meta_path)
+        except OSError as e:
+            logger.error(f"Error saving the cache of {url}: {e}")
@@ -1,13 +1,24 @@
-import curses
 import logging
 import os
+import re
+import signal
+import sys
 import threading
+import time
+from array import array
 from enum import Enum
 from pathlib import Path
+from typing import Iterable, Optional
 
 PROXIES_OUT_DIR = Path(os.getenv("APPDATA") or Path.home() / ".config") / "proxyfinder"
 PROXIES_OUT_DIR.mkdir(parents=True, exist_ok=True)
 STOP_FLAG = threading.Event()
+# Set with STOP_FLAG when the time budget of a run (`--deadline`) runs out: no
+# new work is scheduled and the checks in flight are cancelled, not awaited.
+DEADLINE_FLAG = threading.Event()
+# Above this many keys, `dedupe_proxy_keys` buckets them to save memory.
+DEDUPE_SET_MAX_KEYS = 250_000
+REGEX_PROXY_PARTS = re.compile(r"(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3}):(\d{1,5})")
 
 
 class ProxyStatus(Enum):
@@ -39,55 +50,173 @@ def logger_formatter() -> "logging.Formatter":
     return formatter
 
 
-def signal_handler(sig, frame):
-    """Maneja la señal SIGINT (Ctrl+C)."""
-    logging.info("\n\nSIGINT signal received. Please wait... closing threads...\n\n")
-    STOP_FLAG.set()
+def setup_logging():
+    """Logs to the console and to `proxyfinder.log` in PROXIES_OUT_DIR."""
+    formatter = logger_formatter()
+    logging.basicConfig(
+        level=logging.DEBUG,
+        handlers=[
+            handler_stream(formatter),
+            handler_file(PROXIES_OUT_DIR / "proxyfinder.log", formatter),
+        ],
+    )
+    logging.getLogger("urllib3").setLevel(logging.CRITICAL)
+    logging.getLogger("peewee").setLevel(logging.CRITICAL)
+
+
+def pack_proxy(address: str) -> Optional[int]:
+    """
+    Packs an "ip:port" string at the start of `address` into a 48-bit integer
+    key: the IPv4 address in the high 32 bits and the port in the low 16.
+    Returns None if `address` does not start with a valid IPv4 "ip:port".
+    """
+    match = REGEX_PROXY_PARTS.match(address)
+    if not match:
+        return None
+    return pack_proxy_parts(match.groups())
+
+
+def pack_proxy_parts(parts) -> Optional[int]:
+    """
+    Same as `pack_proxy` for the five groups of a `REGEX_PROXY_PARTS` match
+    (the four octets and the port, as strings).
+    """
+    a, b, c, d, port = map(int, parts)
+    if a > 255 or b > 255 or c > 255 or d > 255 or not 0 < port < 65536:
+        return None
+    return (a << 40) | (b << 32) | (c << 24) | (d << 16) | port
+
+
+def unpack_proxy(key: int) -> str:
+    """Inverse of `pack_proxy`."""
+    ip = f"{key >> 40}.{key >> 32 & 255}.{key >> 24 & 255}.{key >> 16 & 255}"
+    return f"{ip}:{key & 0xFFFF}"
+
+
+def new_proxy_keys(keys: Iterable[int] = ()) -> "array[int]":
+    """Returns a compact array of packed proxy keys (8 bytes per entry)."""
+    return array("Q", keys)
+
+
+def dedupe_proxy_keys(groups: Iterable["array[int]"]) -> "array[int]":
+    """
+    Merges several groups of packed keys into one array without duplicates.
+
+    Up to DEDUPE_SET_MAX_KEYS keys, they go into one set, filled group by group
+    in C. Above that, the set of Python integers would take tens of MB, so the
+    keys are first spread over 256 compact buckets by the last octet of the IP
+    and each bucket is deduplicated on its own: only one bucket at a time is
+    held as a set. Boxing every key into an int still costs more than hashing
+    the "ip:port" strings, so the gain is memory, not time (see `bench dedupe`).
+    """
+    groups = list(groups)
+    if sum(map(len, groups)) <= DEDUPE_SET_MAX_KEYS:
+        unique_keys = set()
+        for keys in groups:
+            unique_keys.update(keys)
+        return new_proxy_keys(unique_keys)
+
+    buckets = [new_proxy_keys() for _ in range(256)]
+    appends = [bucket.append for bucket in buckets]
+    for keys in groups:
+        for key in keys:
+            appends[key >> 16 & 255](key)
+
+    unique = new_proxy_keys()
+    for index, bucket in enumerate(buckets):
+        unique.extend(set(bucket))
+        buckets[index] = None  # type: ignore
+    return unique
+
+
+def raise_open_files_limit():
+    """
+    Raises the soft limit of open file descriptors to the hard limit, so that
+    thousands of sockets can be open at once. Does nothing where the
+    `resource` module is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def count_open_fds() -> Optional[int]:
+    """Open file descriptors of this process, or None if it cannot be known."""
+    for path in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process in MB, or None on Windows."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class ResourceMonitor:
+    """
+    Tracks the peak number of open file descriptors of a run, sampled at most
+    every `interval` seconds, to be reported with the peak RSS at its end.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.peak_fds: Optional[int] = None
+        self._next_sample = 0.0
+
+    def sample(self):
+        now = time.monotonic()
+        if now < self._next_sample:
+            return
+        self._next_sample = now + self.interval
+        fds = count_open_fds()
+        if fds is not None and (self.peak_fds is None or fds > self.peak_fds):
+            self.peak_fds = fds
+
+    def summary(self) -> str:
+        self._next_sample = 0.0
+        self.sample()
+        rss = peak_rss_mb()
+        fds = count_open_fds()
+        return (
+            f"peak RSS: {f'{rss:.0f} MB' if rss is not None else 'n/a'}, "
+            f"open files: {fds if fds is not None else 'n/a'} "
+            f"(peak: {self.peak_fds if self.peak_fds is not None else 'n/a'})"
+        )
 
 
-class ProxyDisplay:
-    def __init__(self, stdscr: curses.window, proxies):
-        self.stdscr = stdscr
-        self.proxies = list(proxies)
-        self.bottom_message_space = 2
-        self.max_visible_proxies = curses.LINES - self.bottom_message_space
-        self.start_index = 0
-        curses.start_color()
-        curses.init_pair(1, curses.COLOR_GREEN, curses.COLOR_BLACK)
-
-    def display_proxies(self):
-        self.stdscr.clear()
-
-        end = min(self.start_index + self.max_visible_proxies, len(self.proxies))
-        visible_proxies = self.proxies[self.start_index : end]
-
-        for i, proxy in enumerate(visible_proxies):
-            line = f"{proxy.proxy} - Working: {proxy.is_working} - Latency: {proxy.latency} ms - updated: {proxy.updated_at.strftime('%Y-%m-%d %H:%M')}"
-            if proxy.is_working:
-                self.stdscr.addstr(i, 0, line, curses.color_pair(1))
-            else:
-                self.stdscr.addstr(i, 0, line)
-
-        self.stdscr.addstr(
-            self.max_visible_proxies + 1,
-            0,
-            f"({end}/{len(self.proxies)}) Press q to quit, j/k to scroll",
-        )
-        self.stdscr.refresh()
-
-    def navigate(self):
-        self.display_proxies()
-
-        while True:
-            key = self.stdscr.getch()
-
-            if key == ord("q"):
-                break
-            elif key == ord("j"):  # Flecha abajo
-                if self.start_index + self.max_visible_proxies < len(self.proxies):
-                    self.start_index += 1
-                    self.display_proxies()
-            elif key == ord("k"):  # Flecha arriba
-                if self.start_index > 0:
-                    self.start_index -= 1
-                    self.display_proxies()
+def start_deadline(seconds: float) -> threading.Timer:
+    """Sets DEADLINE_FLAG and STOP_FLAG in `seconds` seconds."""
+
+    def expire():
+        logging.info(f"Deadline of {seconds:g} s reached. Stopping...")
+        DEADLINE_FLAG.set()
+        STOP_FLAG.set()
+
+    timer = threading.Timer(seconds, expire)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def signal_handler(sig, frame):
+    """Maneja las señales SIGINT (Ctrl+C) y SIGTERM."""
+    logging.info(
+        f"\n\n{signal.Signals(sig).name} signal received. Please wait... closing threads...\n\n"
+    )
+    STOP_FLAG.set()
@@ -0,0 +1,256 @@
+import curses
+from typing import List, Optional, Tuple
+
+import peewee
+
+from proxyfinder.database import STATS_FIELDS, Proxy
+
+Key = Tuple[object, int]
+
+
+class ProxyPager:
+    """
+    Reads the proxies of `query` in the order of `show` (`sort_by`, then id,
+    proxies without statistics last) a few rows at a time, with keyset
+    pagination: a page starts after or before the `(sort value, id)` of a row
+    already read, so it costs the same at any depth and only the rows on
+    screen are kept. `limit` caps the number of proxies, like `show --limit`.
+    """
+
+    def __init__(
+        self,
+        query: peewee.ModelSelect,
+        sort_by: str = "latency",
+        reverse: bool = False,
+        limit: Optional[int] = None,
+    ):
+        self.query = query
+        self.sort_by = sort_by
+        self.field = getattr(Proxy, sort_by)
+        self.reverse = reverse
+        self.limit = limit
+        self.nulls_last = sort_by in STATS_FIELDS
+
+    def count(self) -> int:
+        total = self.query.order_by().count()
+        return min(total, self.limit) if self.limit else total
+
+    def key(self, proxy: Proxy) -> Key:
+        return getattr(proxy, self.sort_by), proxy.id  # type: ignore
+
+    def _order(self, backwards: bool) -> list:
+        """ORDER BY of the display order, or of its opposite if `backwards`."""
+        nulls = None
+        if self.nulls_last:
+            nulls = "FIRST" if backwards else "LAST"
+        if self.reverse != backwards:
+            return [self.field.desc(nulls=nulls), Proxy.id.desc()]
+        return [self.field.asc(nulls=nulls), Proxy.id.asc()]
+
+    def _beyond(self, key: Key, backwards: bool, inclusive: bool = False):
+        """Condition of the rows after `key` in the display order, or before it."""
+        value, proxy_id = key
+        greater = self.reverse == backwards
+        operator = {
+            (True, False): ">",
+            (True, True): ">=",
+            (False, False): "<",
+            (False, True): "<=",
+        }[greater, inclusive]
+        if value is None:
+            # Rows without a value go last, in the order of their id.
+            beyond_id = peewee.Expression(Proxy.id, operator, proxy_id)
+            if backwards:
+                return self.field.is_null(False) | (self.field.is_null() & beyond_id)
+            return self.field.is_null() & beyond_id
+        # A row value comparison, which SQLite can seek in an index.
+        condition = peewee.Expression(
+            peewee.Tuple(self.field, Proxy.id),
+            operator,
+            peewee.Tuple(self.field.db_value(value), proxy_id),
+        )
+        if self.nulls_last and not backwards:
+            condition |= self.field.is_null()
+        return condition
+
+    def _page(self, size: int, backwards: bool = False, condition=None) -> list:
+        if size <= 0:
+            return []
+        query = self.query.order_by(*self._order(backwards)).limit(size)
+        if condition is not None:
+            query = query.where(condition)
+        rows = list(query)
+        return rows[::-1] if backwards else rows
+
+    def first(self, size: int) -> List[Proxy]:
+        return self._page(min(size, self.limit or size))
+
+    def last(self, size: int) -> List[Proxy]:
+        if self.limit:
+            # The end of a limited list is not the end of the query.
+            total = self.count()
+            query = self.query.order_by(*self._order(False))
+            return list(query.offset(max(0, total - size)).limit(min(size, total)))
+        return self._page(size, backwards=True)
+
+    def after(self, key: Key, size: int, inclusive: bool = False) -> List[Proxy]:
+        """The `size` rows after `key` (from it if `inclusive`)."""
+        return self._page(size, condition=self._beyond(key, False, inclusive))
+
+    def before(self, key: Key, size: int) -> List[Proxy]:
+        """The `size` rows before `key`, in the display order."""
+        return self._page(size, backwards=True, condition=self._beyond(key, True))
+
+
+class ProxyDisplay:
+    """
+    Terminal view of the proxies of a `ProxyPager`. Only the rows on screen
+    are kept, read when they scroll in, and each frame only writes the lines
+    that changed since the previous one. With `refresh`, the rows on screen
+    are read again every `refresh` seconds, e.g. while a check runs.
+
+    Keys: j/k or arrows scroll, PgDn/PgUp (space/b) page, g/G (Home/End) go
+    to the start or the end, r reads the rows again and q quits.
+    """
+
+    def __init__(
+        self, stdscr: curses.window, pager: ProxyPager, refresh: Optional[float] = None
+    ):
+        self.stdscr = stdscr
+        self.pager = pager
+        self.refresh = refresh
+        self.bottom_message_space = 2
+        self.max_visible_proxies = max(1, curses.LINES - self.bottom_message_space)
+        self.position = 0  # index of the first row on screen
+        self.total = pager.count()
+        self.rows = pager.first(self.max_visible_proxies)
+        self.lines: List[Tuple[str, int]] = []  # last frame
+        curses.start_color()
+        curses.init_pair(1, curses.COLOR_GREEN, curses.COLOR_BLACK)
+        stdscr.idlok(True)
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+
+    @staticmethod
+    def format_line(proxy: Proxy) -> str:
+        line = f"{proxy.proxy} - Working: {proxy.is_working} - Latency: {proxy.latency} ms - updated: {proxy.updated_at.strftime('%Y-%m-%d %H:%M')}"
+        if proxy.protocol is not None:
+            line += f" - {proxy.protocol}"
+        if proxy.country is not None or proxy.asn is not None:
+            line += f" - {proxy.country or '??'} AS{proxy.asn or '?'}"
+        if proxy.success_ratio is not None:
+            line += f" - success: {proxy.success_ratio:.0%} (p95: {proxy.p95_latency} ms)"
+        return line
+
+    def frame(self) -> List[Tuple[str, int]]:
+        lines = [
+            (self.format_line(proxy), curses.color_pair(1) if proxy.is_working else 0)
+            for proxy in self.rows
+        ]
+        lines += [("", 0)] * (self.max_visible_proxies + 1 - len(lines))
+        message = (
+            f"({self.position + len(self.rows)}/{self.total}) Press q to quit, "
+            "j/k to scroll, PgUp/PgDn to page, g/G to go to the start/end"
+        )
+        if self.refresh:
+            message += f" (refreshed every {self.refresh:g} s)"
+        lines.append((message, 0))
+        return lines
+
+    def display_proxies(self):
+        """Writes the lines of the frame that changed since the last one."""
+        width = max(1, curses.COLS - 1)
+        lines = self.frame()
+        for i, (text, attr) in enumerate(lines):
+            if i < len(self.lines) and self.lines[i] == (text, attr):
+                continue
+            self.stdscr.move(i, 0)
+            self.stdscr.clrtoeol()
+            if text:
+                self.stdscr.addnstr(i, 0, text, width, attr)
+        self.lines = lines
+        self.stdscr.refresh()
+
+    def scroll_down(self, count: int):
+        if not self.rows:
+            return
+        remaining = self.total - self.position - len(self.rows)
+        new = self.pager.after(self.pager.key(self.rows[-1]), min(count, remaining))
+        rows = (self.rows + new)[-self.max_visible_proxies :]
+        self.position += len(self.rows) + len(new) - len(rows)
+        self.rows = rows
+
+    def scroll_up(self, count: int):
+        if not self.rows or self.position == 0:
+            return
+        new = self.pager.before(self.pager.key(self.rows[0]), count)
+        self.rows = (new + self.rows)[: self.max_visible_proxies]
+        self.position = max(0, self.position - len(new))
+
+    def go_to_start(self):
+        self.rows = self.pager.first(self.max_visible_proxies)
+        self.position = 0
+
+    def go_to_end(self):
+        self.rows = self.pager.last(self.max_visible_proxies)
+        self.position = max(0, self.total - len(self.rows))
+
+    def reload(self):
+        """Reads the rows on screen again, from the first one."""
+        self.total = self.pager.count()
+        if not self.rows:
+            self.go_to_start()
+            return
+        self.position = min(self.position, self.total)
+        size = min(self.max_visible_proxies, self.total - self.position)
+        rows = self.pager.after(self.pager.key(self.rows[0]), size, inclusive=True)
+        if len(rows) < self.max_visible_proxies:
+            if not rows:
+                self.go_to_end()
+                return
+            # The end of the list moved up: fill the screen from above.
+            missing = self.max_visible_proxies - len(rows)
+            above = self.pager.before(self.pager.key(rows[0]), missing)
+            rows = above + rows
+            self.position = max(0, self.position - len(above))
+        self.rows = rows
+
+    def resize(self):
+        curses.update_lines_cols()
+        self.max_visible_proxies = max(1, curses.LINES - self.bottom_message_space)
+        self.lines = []
+        self.stdscr.clear()
+        self.reload()
+
+    def navigate(self):
+        if self.refresh:
+            self.stdscr.timeout(int(self.refresh * 1000))
+        self.display_proxies()
+
+        while True:
+            key = self.stdscr.getch()
+            page = self.max_visible_proxies
+
+            if key == ord("q"):
+                break
+            elif key in (ord("j"), curses.KEY_DOWN):
+                self.scroll_down(1)
+            elif key in (ord("k"), curses.KEY_UP):
+                self.scroll_up(1)
+            elif key in (ord(" "), curses.KEY_NPAGE):
+                self.scroll_down(page)
+            elif key in (ord("b"), curses.KEY_PPAGE):
+                self.scroll_up(page)
+            elif key in (ord("g"), curses.KEY_HOME):
+                self.go_to_start()
+            elif key in (ord("G"), curses.KEY_END):
+                self.go_to_end()
+            elif key == curses.KEY_RESIZE:
+                self.resize()
+            elif key in (ord("r"), -1):  # -1: the refresh timeout
+                self.reload()
+            else:
+                continue
+            self.display_proxies()
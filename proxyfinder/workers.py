@@ -0,0 +1,256 @@
+import logging
+import multiprocessing
+import queue
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Tuple
+
+from proxyfinder.database import (
+    Proxy,
+    ResultWriter,
+    compact_history,
+    in_shard,
+    iterate_due,
+    iterate_in_pages,
+    select_due,
+)
+from proxyfinder.geo import enrich_proxies
+from proxyfinder.metrics import METRICS, Metrics
+from proxyfinder.prefilter import PREFILTER_ERROR_PREFIX, TcpPrefilter
+from proxyfinder.utils import (
+    DEADLINE_FLAG,
+    STOP_FLAG,
+    ProxyStatus,
+    ResourceMonitor,
+    setup_logging,
+)
+
+logger = logging.getLogger(__name__)
+
+# Results are sent to the writer process in batches of this size, or sooner
+# when the oldest one has waited `WORKER_FLUSH_INTERVAL` seconds.
+WORKER_BATCH_SIZE = 100
+WORKER_FLUSH_INTERVAL = 1.0
+
+
+def check_candidates(
+    status: ProxyStatus = ProxyStatus.UNCHECKED,
+    older_than: int = 0,
+    budget: Optional[int] = None,
+    now: Optional[datetime] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Tuple[Iterable[Proxy], int]:
+    """
+    The proxies that `check` works on, and how many they are: the `budget`
+    most overdue ones if given, otherwise the ones with `status`. `shard` is a
+    `(shard_id, shard_count)` pair (see `in_shard`).
+    """
+    if budget is not None:
+        now = now or datetime.now()
+        return (
+            iterate_due(budget, now, shard=shard),
+            select_due(budget, now, shard=shard).count(),
+        )
+
+    if status == ProxyStatus.WORKING:
+        proxies = Proxy.select().where(
+            Proxy.is_working == True,
+            Proxy.is_checked == True,
+        )
+    elif status == ProxyStatus.BROKEN:
+        proxies = Proxy.select().where(
+            Proxy.is_working == False,
+            Proxy.is_checked == True,
+            (
+                Proxy.error.contains("connect timeout")
+                | Proxy.error.startswith(PREFILTER_ERROR_PREFIX)
+            ),
+        )
+    elif status == ProxyStatus.UNCHECKED:
+        proxies = Proxy.select().where(Proxy.is_checked == False)
+    elif status == ProxyStatus.ALL:
+        proxies = Proxy.select()
+    else:
+        raise ValueError(f"Invalid status: {status}")
+
+    if older_than > 0:
+        cutoff = datetime.now() - timedelta(days=older_than)
+        proxies = proxies.where(Proxy.updated_at < cutoff)  # type: ignore
+
+    proxies = in_shard(proxies, shard)
+    return iterate_in_pages(proxies), proxies.count()
+
+
+def _run_worker(
+    shard: Tuple[int, int],
+    candidates: dict,
+    finder_options: dict,
+    engine: str,
+    prefilter_options: Optional[dict],
+    results: "multiprocessing.Queue",
+    stop: "multiprocessing.synchronize.Event",
+    deadline: "multiprocessing.synchronize.Event",
+):
+    """
+    Body of a worker process: checks the proxies of its `shard` with its own
+    `ProxyFinder` and sends the results to the parent in batches, each with
+    the `METRICS` recorded since the previous one. It does not write to the
+    database. Ends with a None in `results`.
+    """
+    from proxyfinder.proxyfinder import ProxyFinder
+
+    # Ctrl+C reaches the whole process group: the parent handles it and sets
+    # `stop`, which stops the worker the same way as STOP_FLAG. `deadline`
+    # does the same with DEADLINE_FLAG.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging()
+
+    def forward(event, flags):
+        event.wait()
+        for flag in flags:
+            flag.set()
+
+    threading.Thread(
+        target=forward, args=(stop, [STOP_FLAG]), name="stop-watcher", daemon=True
+    ).start()
+    threading.Thread(
+        target=forward,
+        args=(deadline, [DEADLINE_FLAG, STOP_FLAG]),
+        name="deadline-watcher",
+        daemon=True,
+    ).start()
+
+    try:
+        proxies, _ = check_candidates(shard=shard, **candidates)
+        prefilter = TcpPrefilter(**prefilter_options) if prefilter_options else None
+        monitor = ResourceMonitor()
+        sent = METRICS.snapshot()
+
+        def send(batch: list):
+            nonlocal sent
+            current = METRICS.snapshot()
+            results.put((batch, Metrics.difference(current, sent)))
+            sent = current
+
+        with ProxyFinder(**finder_options) as pf:
+            batch = []
+            flush_at = 0.0
+            for proxy in pf.check_results(proxies, engine=engine, prefilter=prefilter):
+                monitor.sample()
+                if proxy is not None:
+                    if not batch:
+                        flush_at = time.monotonic() + WORKER_FLUSH_INTERVAL
+                    batch.append(ResultWriter.row(proxy))
+                if batch and (
+                    len(batch) >= WORKER_BATCH_SIZE or time.monotonic() >= flush_at
+                ):
+                    send(batch)
+                    batch = []
+            send(batch)
+        logger.info(f"Worker of shard {shard[0]}/{shard[1]}: {monitor.summary()}.")
+    except Exception as e:
+        logger.error(f"Error in the worker of shard {shard[0]}/{shard[1]}: {e}")
+    finally:
+        results.put(None)
+
+
+def check_in_workers(
+    workers: int,
+    concurrency,
+    status: ProxyStatus = ProxyStatus.UNCHECKED,
+    older_than: int = 0,
+    budget: Optional[int] = None,
+    engine: str = "thread",
+    max_concurrency=None,
+    prefilter_options: Optional[dict] = None,
+    shard: Tuple[int, int] = (0, 1),
+    connect_timeout: Optional[float] = None,
+    read_timeout: Optional[float] = None,
+):
+    """
+    Checks the candidates of `shard` in `workers` processes, each with its own
+    thread pool or event loop and `concurrency` checks in flight. The shard is
+    split again between the workers with `proxy_shard`, and their results
+    are saved by a single `ResultWriter` in this process. The metrics of the
+    workers are added to the `METRICS` of this process.
+    """
+    shard_id, shard_count = shard
+    now = datetime.now()
+    start_time = time.monotonic()
+    before = METRICS.snapshot()
+    _, total = check_candidates(status, older_than, budget, now, shard)
+    logger.info(f"Checking {total} proxies in {workers} worker processes.")
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue(maxsize=workers * 8)
+    stop = context.Event()
+    deadline = context.Event()
+    processes = []
+    for index in range(workers):
+        worker_budget = None
+        if budget is not None:
+            worker_budget = budget // workers + (index < budget % workers)
+        process = context.Process(
+            target=_run_worker,
+            name=f"check-worker-{index}",
+            args=(
+                (shard_id + shard_count * index, shard_count * workers),
+                {
+                    "status": status,
+                    "older_than": older_than,
+                    "budget": worker_budget,
+                    "now": now,
+                },
+                {
+                    "concurrency": concurrency,
+                    "max_concurrency": max_concurrency,
+                    "connect_timeout": connect_timeout,
+                    "read_timeout": read_timeout,
+                },
+                engine,
+                prefilter_options,
+                results,
+                stop,
+                deadline,
+            ),
+        )
+        process.start()
+        processes.append(process)
+
+    running = workers
+    processed = 0
+    with ResultWriter() as writer:
+        while running:
+            if STOP_FLAG.is_set():
+                stop.set()
+            if DEADLINE_FLAG.is_set():
+                deadline.set()
+            try:
+                message = results.get(timeout=0.5)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    logger.error("Worker processes exited without finishing.")
+                    break
+                continue
+            if message is None:
+                running -= 1
+                continue
+            rows, metrics = message
+            METRICS.merge(metrics)
+            for row in rows:
+                writer.put_row(row)
+            processed += len(rows)
+            if random.randint(0, 4) == 0:
+                logger.info(f"Processed {processed}/{total} proxies.")
+    for process in processes:
+        process.join()
+    logger.debug(f"Saved {writer.written} checked proxies in the database.")
+    logger.info(
+        f"Check metrics: "
+        f"{METRICS.check_summary(before, time.monotonic() - start_time)}."
+    )
+    compact_history()
+    enrich_proxies(since=now)
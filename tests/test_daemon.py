@@ -0,0 +1,30 @@
+import pytest
+
+from proxyfinder.daemon import ProxyDaemon
+
+
+class FailingFinder:
+    def get_proxies_from_multiple_sources(self):
+        raise RuntimeError("source down")
+
+
+class RecordingDaemon(ProxyDaemon):
+    def __init__(self):
+        super().__init__(FailingFinder(), find_interval=3600, idle_interval=0)
+        self.check_rounds = 0
+
+    def check_due(self) -> int:
+        self.check_rounds += 1
+        return 0
+
+    def _idle_time(self) -> float:
+        return 0
+
+
+def test_failed_find_does_not_block_check_rounds():
+    daemon = RecordingDaemon()
+    with pytest.raises(RuntimeError):
+        daemon.run_round()
+
+    daemon.run_round()
+    assert daemon.check_rounds == 1